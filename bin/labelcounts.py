@@ -23,6 +23,7 @@ Give the histogram of labels in a project file.
 """
 import sys
 import os
+import zlib
 import h5py
 import numpy
 
@@ -50,6 +51,32 @@ def print_bincounts(label_names, bins_list, image_name):
         print ("{:" + str(max_name_len) + "} : {}").format( name, count )
     print ""
 
+def label_blocks(group):
+    """
+    Yield the label blocks of one image, as stored by SerialBlockSlot:
+    either one compressed journal ('blockdata' and 'blockindex'),
+    where later entries for a block supersede the earlier ones,
+    or (in older projects) one dataset per block.
+    """
+    if 'blockindex' not in group:
+        for block in group.values():
+            yield block[:]
+        return
+
+    dtype = numpy.dtype( group.attrs['dtype'] )
+    blockindex = group['blockindex'][...]
+    blockdata = group['blockdata'][...]
+    if 'blockstart' in blockindex.dtype.names:
+        # Only the latest entry of each block counts, and it may be a deletion
+        latest = {}
+        for i, entry in enumerate(blockindex):
+            key = tuple(entry['blockstart']) + tuple(entry['blockstop'])
+            latest[key] = i
+        blockindex = blockindex[ sorted( i for i in latest.values() if blockindex[i]['nbytes'] >= 0 ) ]
+    for entry in blockindex:
+        data = blockdata[entry['offset']:entry['offset'] + entry['nbytes']]
+        yield numpy.fromstring( zlib.decompress( data.tostring() ), dtype=dtype )
+
 if __name__ == "__main__":
     all_bins = []
     num_bins = 0
@@ -59,8 +86,7 @@ if __name__ == "__main__":
         for image_index, group in enumerate(f['PixelClassification/LabelSets'].values()):
             # For each label block
             this_img_bins = []
-            for block in group.values():
-                data = block[:]
+            for data in label_blocks(group):
                 nonzero_coords = numpy.nonzero(data)
                 bins = numpy.bincount(data[nonzero_coords].flat)
                 this_img_bins.append( bins )
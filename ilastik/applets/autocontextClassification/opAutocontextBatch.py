@@ -18,34 +18,117 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+import threading
+from functools import partial
+
+import numpy
+
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
+from lazyflow.request import Request, RequestPool
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 from lazyflow.operators import OpValueCache, OpTrainRandomForestBlocked, \
-                               OpPredictRandomForest, OpSlicedBlockedArrayCache, OpMultiArraySlicer2, \
+                               OpPredictRandomForest, OpMultiArraySlicer2, \
                                OpPrecomputedInput, Op50ToMulti, OpArrayPiper, OpMultiArrayStacker
                                
 from opAutocontextClassification import createAutocontextFeatureOperators
 
 
+class OpBlockFeatureBuffer( Operator ):
+    """
+    Passes the pixel features through, but serves every request which lies
+    within a registered buffer from that buffer instead of the input.
+    OpAutocontextBatch registers the features of each block (with the halo
+    of all stages) while the block is predicted, so the stages share one
+    read of the features instead of requesting them again, each with its
+    own halo.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockFeatureBuffer, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._buffers = {}
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+
+    def fill(self, start, stop):
+        """
+        Read the input for the given roi and serve it from memory until
+        release() is called with the returned key.
+        """
+        data = self.Input( start, stop ).wait()
+        key = object()
+        with self._lock:
+            self._buffers[key] = ( numpy.array(start), numpy.array(stop), data )
+        return key
+
+    def release(self, key):
+        with self._lock:
+            self._buffers.pop( key, None )
+
+    def execute(self, slot, subindex, roi, result):
+        start, stop = numpy.array(roi.start), numpy.array(roi.stop)
+        with self._lock:
+            buffers = list( self._buffers.values() )
+        for bufferStart, bufferStop, data in buffers:
+            if (bufferStart <= start).all() and (stop <= bufferStop).all():
+                result[:] = data[ roiToSlice( start - bufferStart, stop - bufferStart ) ]
+                return result
+        self.Input( roi.start, roi.stop ).writeInto( result ).wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        # The buffered features are stale now
+        with self._lock:
+            self._buffers.clear()
+        self.Output.setDirty( roi.start, roi.stop )
+
+
 class OpAutocontextBatch( Operator ):
+    """
+    Predicts all autocontext stages block by block.
+
+    The stages are chained without caches: a request for a block of the
+    final predictions requests the context features of the previous stage
+    for that block, which request the previous stage's predictions for the
+    block plus the context features' halo, and so on. Each block is thus
+    pushed through all stages at once (with the halo growing by one context
+    radius per stage), and no stage is ever held for the whole volume.
+    The blocks of a request are processed in parallel.
+
+    The pixel features of a block are read only once: before the stages
+    run, the features for the block plus the halo of all stages are read
+    into an OpBlockFeatureBuffer, which serves the requests of every stage
+    for that block. The buffer is dropped when the block is done.
+    """
     
     Classifiers = InputSlot(level=1)
     FeatureImage = InputSlot()
     MaxLabelValue = InputSlot()
     AutocontextIterations = InputSlot()
     
-    PredictionProbabilities = OutputSlot()
+    PredictionProbabilities = OutputSlot() # The predictions of the last stage
     #PixelOnlyPredictions = OutputSlot()
+
+    #: Extent of the blocks along x and y, and along z.
+    #: (The halo which is added to each block grows with the number of stages.)
+    BlockEdge = 256
+    BlockDepth = 32
     
     def __init__(self, *args, **kwargs):
         super(OpAutocontextBatch, self).__init__(*args, **kwargs)
-        self.prediction_caches = None
         self.predictors = None
         #self.AutocontextIterations.notifyDirty(self.setupOperators)
         
     def setupOperators(self, *args, **kwargs):
     
         self.predictors = []
-        self.prediction_caches = []
+
+        # All stages read the pixel features through the per-block buffer
+        self._opFeatureBuffer = OpBlockFeatureBuffer(parent=self)
+        self._opFeatureBuffer.Input.connect( self.FeatureImage )
         
         #niter = len(self.Classifiers)
         niter = self.AutocontextIterations.value
@@ -53,14 +136,10 @@ class OpAutocontextBatch( Operator ):
             #predict = OperatorWrapper(OpPredictRandomForest, parent=self, parent=self)
             predict = OpPredictRandomForest(parent=self)
             self.predictors.append(predict)
-            #prediction_cache = OperatorWrapper( OpSlicedBlockedArrayCache, parent=self, parent=self ) 
-            prediction_cache = OpSlicedBlockedArrayCache( parent=self ) 
-            self.prediction_caches.append(prediction_cache)
         
         # Setup autocontext features
         self.autocontextFeatures = []
         self.autocontextFeaturesMulti = []
-        self.autocontext_caches = []
         self.featureStackers = []
         
         for i in range(niter-1):
@@ -72,101 +151,100 @@ class OpAutocontextBatch( Operator ):
             opStacker.inputs["AxisFlag"].setValue("c")
             opStacker.inputs["AxisIndex"].setValue(3)
             self.featureStackers.append(opStacker)
-            autocontext_cache = OpSlicedBlockedArrayCache(parent=self )
-            self.autocontext_caches.append(autocontext_cache)
         
         # connect the features to predictors
         for i in range(niter-1):
             for ifeat, feat in enumerate(self.autocontextFeatures[i]):
-                feat.inputs['Input'].connect( self.prediction_caches[i].Output)
-                print "Multi: Connecting an output", "Input%.2d"%(ifeat)
+                feat.inputs['Input'].connect( self.predictors[i].PMaps )
                 self.autocontextFeaturesMulti[i].inputs["Input%.2d"%(ifeat)].connect(feat.outputs["Output"])
             # connect the pixel features to the same multislot
-            print "Multi: Connecting an output", "Input%.2d"%(len(self.autocontextFeatures[i]))
-            self.autocontextFeaturesMulti[i].inputs["Input%.2d"%(len(self.autocontextFeatures[i]))].connect(self.FeatureImage)
+            self.autocontextFeaturesMulti[i].inputs["Input%.2d"%(len(self.autocontextFeatures[i]))].connect(self._opFeatureBuffer.Output)
             # stack the autocontext features with pixel features
             self.featureStackers[i].inputs["Images"].connect(self.autocontextFeaturesMulti[i].outputs["Outputs"])
-            # cache the stacks
-            self.autocontext_caches[i].inputs["Input"].connect(self.featureStackers[i].outputs["Output"])                                                  
-            self.autocontext_caches[i].inputs["fixAtCurrent"].setValue(False)    
         
         for i in range(niter):        
 
             self.predictors[i].inputs['Classifier'].connect(self.Classifiers[i])
             self.predictors[i].inputs['LabelsCount'].connect(self.MaxLabelValue)
             
-            self.prediction_caches[i].inputs["fixAtCurrent"].setValue(False)
-            self.prediction_caches[i].inputs["Input"].connect(self.predictors[i].PMaps)
-            
-        self.predictors[0].inputs['Image'].connect(self.FeatureImage)
+        self.predictors[0].inputs['Image'].connect(self._opFeatureBuffer.Output)
         for i in range(1, niter):
-            self.predictors[i].inputs['Image'].connect(self.autocontext_caches[i-1].outputs["Output"])
-        
-        #self.PixelOnlyPredictions.connect(self.predictors[-1].PMaps)    
-        self.PredictionProbabilities.connect(self.predictors[0].PMaps)
+            self.predictors[i].inputs['Image'].connect(self.featureStackers[i-1].outputs["Output"])
         
     def setupOutputs(self):
-        print "calling setupOutputs"
-        
         if self.AutocontextIterations.ready() and self.predictors is None:
             self.setupOperators()
-            
-        
-        # Set the blockshapes for each input image separately, depending on which axistags it has.
-        axisOrder = [ tag.key for tag in self.FeatureImage.meta.axistags ]
-        ## Pixel Cache blocks
-        blockDimsX = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (128,256),
-                       'x' : (5,5),
-                       'c' : (1000,1000) }
-
-        blockDimsY = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (5,5),
-                       'x' : (128,256),
-                       'c' : (1000,1000) }
-
-        blockDimsZ = { 't' : (1,1),
-                       'z' : (5,5),
-                       'y' : (128,256),
-                       'x' : (128,256),
-                       'c' : (1000,1000) }
-
-        innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-        outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-
-        innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-        outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-
-        innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-        outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-
-        for cache in self.prediction_caches:
-            cache.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            cache.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-    
-        for cache in self.autocontext_caches:     
-            cache.innerBlockShape.setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            cache.outerBlockShape.setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-            
-    '''
+        self.PredictionProbabilities.meta.assignFrom( self.predictors[-1].PMaps.meta )
+
+    def _blockShape(self):
+        meta = self.PredictionProbabilities.meta
+        edges = { 'x' : self.BlockEdge, 'y' : self.BlockEdge, 'z' : self.BlockDepth }
+        blockShape = []
+        for key, size in zip( meta.getAxisKeys(), meta.shape ):
+            if key == 'c':
+                blockShape.append( size )
+            else:
+                blockShape.append( min( size, edges.get(key, 1) ) )
+        return tuple(blockShape)
+
     def execute(self, slot, subindex, roi, result):
-        if slot==self.PredictionProbabilities:
-            #we shouldn't be here, it's for testing
-            print "opBatchPredict, who is not ready?"
-            print self.Classifiers.ready(), self.FeatureImage.ready(), self.AutocontextIterations.ready(), self.MaxLabelValue.ready()
-            return
-    '''
-    
+        assert slot == self.PredictionProbabilities
+        shape = self.PredictionProbabilities.meta.shape
+        blockShape = self._blockShape()
+        pool = RequestPool()
+        for blockStart in getIntersectingBlocks( blockShape, (roi.start, roi.stop) ):
+            blockRoi = getBlockBounds( shape, blockShape, blockStart )
+            start, stop = getIntersection( blockRoi, (roi.start, roi.stop) )
+            pool.add( Request( partial(self._predictBlock, start, stop, roi, result) ) )
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _featureHalo(self):
+        """
+        The halo which the context features of all stages add to a block,
+        per axis of the feature image. (The radii are given as [x, y, z].)
+        """
+        maxRadii = numpy.zeros( 3, dtype=int )
+        for features in self.autocontextFeatures:
+            for feat in features:
+                radii = numpy.array( feat.inputs["Radii"].value ).reshape( -1, 3 )
+                maxRadii += radii.max( axis=0 )
+        halo = []
+        for key in self.FeatureImage.meta.getAxisKeys():
+            if key in 'xyz':
+                halo.append( maxRadii['xyz'.index(key)] )
+            else:
+                halo.append( 0 )
+        return numpy.array( halo )
+
+    def _predictBlock(self, start, stop, roi, result):
+        destination = result[ roiToSlice( start - roi.start, stop - roi.start ) ]
+
+        # Read the block's pixel features once, with the halo of all stages
+        shape = self.FeatureImage.meta.shape
+        halo = self._featureHalo()
+        featureStart = numpy.maximum( numpy.array(start) - halo, 0 )
+        featureStop = numpy.minimum( numpy.array(stop) + halo, shape )
+        channelIndex = self.FeatureImage.meta.getAxisKeys().index('c')
+        featureStart[channelIndex] = 0
+        featureStop[channelIndex] = shape[channelIndex]
+
+        key = self._opFeatureBuffer.fill( featureStart, featureStop )
+        try:
+            self.predictors[-1].PMaps( start, stop ).writeInto( destination ).wait()
+        finally:
+            self._opFeatureBuffer.release( key )
+
     def setInSlot(self, slot, subindex, roi, value):
         # Nothing to do here: All inputs that support __setitem__
         #   are directly connected to internal operators.
         pass
 
     def propagateDirty(self, inputSlot, subindex, key):
-        # Nothing to do here: All outputs are directly connected to 
-        #  internal operators that handle their own dirty propagation.
-        pass
+        # Any change to the classifiers or the features affects all stages
+        #  (and the context features reach beyond the dirty region anyway).
+        if inputSlot != self.AutocontextIterations:
+            self.PredictionProbabilities.setDirty( slice(None) )
         
     
\ No newline at end of file
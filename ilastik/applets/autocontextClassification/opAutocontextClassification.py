@@ -22,6 +22,8 @@ from functools import partial
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 
 from ilastik.utility.operatorSubView import OperatorSubView
+from ilastik.utility.cacheGeometry import configureSlicedCache, laneSlot, ALL_CHANNELS
+from ilastik.applets.dataSelection.internalStorage import OpChunkCache, chunkShape
 from lazyflow.operators import OpBlockedSparseLabelArray, OpValueCache, OpTrainRandomForestBlocked, \
                                OpPredictRandomForest, OpSlicedBlockedArrayCache, OpMultiArraySlicer2, \
                                OpPrecomputedInput, Op50ToMulti, OpArrayPiper, OpMultiArrayStacker
@@ -81,6 +83,9 @@ class OpAutocontextClassification( Operator ):
     # GUI-only (not part of the pipeline, but saved to the project)
     LabelNames = OutputSlot()
     LabelColors = OutputSlot()
+
+    #: Memory for each cache of intermediate results (per image)
+    IntermediateCacheBytes = 512*2**20
     
     def __init__( self, *args, **kwargs ):
         """
@@ -104,19 +109,25 @@ class OpAutocontextClassification( Operator ):
 
         self.predictors = []
         self.prediction_caches = []
-        self.prediction_caches_gui = []
         
         #FIXME: we should take it from the input slot
         niter = self.AutocontextIterations.value
         
+        # There is one prediction cache per stage.
+        # The predictions of the first and the last stage are shown, so they are kept completely.
+        #  The predictions of the stages in between are only read by the next stage,
+        #  so they are kept in a cache with a fixed budget.
+        # The last stage is only cached for the GUI (the exports stream it block by block).
         for i in range(niter):
             predict = OperatorWrapper( OpPredictRandomForest, parent=self )
-            prediction_cache = OperatorWrapper( OpSlicedBlockedArrayCache, parent=self ) 
-            prediction_cache_gui = OperatorWrapper( OpSlicedBlockedArrayCache, parent=self )
+            if 0 < i < niter-1:
+                prediction_cache = OperatorWrapper( OpChunkCache, parent=self )
+                prediction_cache.MaxBytes.setValue( self.IntermediateCacheBytes )
+            else:
+                prediction_cache = OperatorWrapper( OpSlicedBlockedArrayCache, parent=self )
             
             self.predictors.append(predict)
             self.prediction_caches.append(prediction_cache)
-            self.prediction_caches_gui.append(prediction_cache_gui)
         
         #We only display the last prediction layer
          
@@ -166,7 +177,11 @@ class OpAutocontextClassification( Operator ):
             opStacker.inputs["AxisFlag"].setValue("c")
             opStacker.inputs["AxisIndex"].setValue(3)
             self.featureStackers.append(opStacker)
-            autocontext_cache = OperatorWrapper( OpSlicedBlockedArrayCache, parent=self )
+            # The stacked features are read once by the next stage's predictor,
+            #  whose output is cached.  Don't keep them any longer than that.
+            autocontext_cache = OperatorWrapper( OpChunkCache, parent=self )
+            autocontext_cache.MaxBytes.setValue( self.IntermediateCacheBytes )
+            autocontext_cache.EvictConsumed.setValue( True )
             self.autocontext_caches.append(autocontext_cache)
         
         # connect the features to predictors
@@ -182,7 +197,6 @@ class OpAutocontextClassification( Operator ):
             self.featureStackers[i].inputs["Images"].connect(self.autocontextFeaturesMulti[i].outputs["Outputs"])
             # cache the stacks
             self.autocontext_caches[i].inputs["Input"].connect(self.featureStackers[i].outputs["Output"])                                                  
-            self.autocontext_caches[i].inputs["fixAtCurrent"].setValue(False)
 
         ##
         # training
@@ -216,13 +230,25 @@ class OpAutocontextClassification( Operator ):
             self.predictors[i].inputs['Classifier'].connect(self.classifier_caches[i].outputs["Output"])
             self.predictors[i].inputs['LabelsCount'].connect(self.opMaxLabel.Output)
             
-            self.prediction_caches[i].inputs["fixAtCurrent"].setValue(False)
             self.prediction_caches[i].inputs["Input"].connect(self.predictors[i].PMaps)
-            
-            
-            self.prediction_caches_gui[i].name = "PredictionCache"
-            self.prediction_caches_gui[i].inputs["fixAtCurrent"].connect( self.FreezePredictions )
-            self.prediction_caches_gui[i].inputs["Input"].connect(self.predictors[i].PMaps)
+
+        # The cache of the last stage is frozen along with the GUI.
+        self.prediction_caches[-1].name = "PredictionCache"
+        self.prediction_caches[-1].inputs["fixAtCurrent"].connect( self.FreezePredictions )
+        if niter > 1:
+            # The first stage is also read for training the later stages, so it must not be frozen.
+            # The GUI gets a frozen copy, which is filled from the shared cache.
+            pixelPredictions = self.prediction_caches[0].Output
+            self.prediction_caches[0].inputs["fixAtCurrent"].setValue(False)
+            self.pixel_prediction_cache_gui = OperatorWrapper( OpSlicedBlockedArrayCache, parent=self )
+            self.pixel_prediction_cache_gui.name = "PixelPredictionCache"
+            self.pixel_prediction_cache_gui.inputs["fixAtCurrent"].connect( self.FreezePredictions )
+            self.pixel_prediction_cache_gui.inputs["Input"].connect( self.prediction_caches[0].Output )
+            pixelPredictionsGui = self.pixel_prediction_cache_gui.Output
+        else:
+            self.pixel_prediction_cache_gui = None
+            pixelPredictions = self.predictors[0].PMaps
+            pixelPredictionsGui = self.prediction_caches[0].Output
         
         self.predictors[0].inputs['Image'].connect(self.CachedFeatureImages)
         for i in range(1, niter):
@@ -230,16 +256,16 @@ class OpAutocontextClassification( Operator ):
             
         # The serializer uses these operators to provide prediction data directly from the project file
         # if the predictions haven't become dirty since the project file was opened.
-        self.precomputed_predictions.SlowInput.connect( self.prediction_caches[-1].Output )
+        self.precomputed_predictions.SlowInput.connect( self.predictors[-1].PMaps )
         self.precomputed_predictions.PrecomputedInput.connect( self.PredictionsFromDisk )
         
-        self.precomputed_predictions_pixel.SlowInput.connect( self.prediction_caches[0].Output )
+        self.precomputed_predictions_pixel.SlowInput.connect( pixelPredictions )
         self.precomputed_predictions_pixel.PrecomputedInput.connect( self.PredictionsFromDisk )
 
         # !!! here we can change which prediction step we show:
-        self.precomputed_predictions_gui.SlowInput.connect( self.prediction_caches_gui[-1].Output )
+        self.precomputed_predictions_gui.SlowInput.connect( self.prediction_caches[-1].Output )
         self.precomputed_predictions_gui.PrecomputedInput.connect( self.PredictionsFromDisk )
-        self.precomputed_predictions_pixel_gui.SlowInput.connect( self.prediction_caches_gui[0].Output)
+        self.precomputed_predictions_pixel_gui.SlowInput.connect( pixelPredictionsGui )
         self.precomputed_predictions_pixel_gui.PrecomputedInput.connect( self.PredictionsFromDisk )
         
 
@@ -333,80 +359,27 @@ class OpAutocontextClassification( Operator ):
         blockShape = tuple( blockDims[k] for k in axisOrder )
         self.opLabelArray.blockShape.setValue( blockShape )
 
-        thinCache = 5
-
-        ## Pixel Cache blocks
-        blockDimsX = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (128,256),
-                       'x' : (thinCache,thinCache),
-                       'c' : (1000,1000) }
-
-        blockDimsY = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (thinCache,thinCache),
-                       'x' : (128,256),
-                       'c' : (1000,1000) }
-
-        blockDimsZ = { 't' : (1,1),
-                       'z' : (thinCache,thinCache),
-                       'y' : (128,256),
-                       'x' : (128,256),
-                       'c' : (1000,1000) }
-
-        innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-        outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-
-        innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-        outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-
-        innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-        outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-
-        for cache in self.prediction_caches:
-            cache.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            cache.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-
-        for cache in self.prediction_caches_gui:
-            cache.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            cache.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-
-
-        #Copy-paste from features
-        blockDimsX = { 't' : (1,1),
-                        'z' : (128,256),
-                        'y' : (128,256),
-                        'x' : (thinCache,thinCache),
-                        'c' : (1000,1000) } # Overestimate number of feature channels: Cache block dimensions will be clipped to the size of the actual feature image
-        
-        blockDimsY = { 't' : (1,1),
-                        'z' : (128,256),
-                        'y' : (thinCache,thinCache),
-                        'x' : (128,256),
-                        'c' : (1000,1000) }
-        
-        blockDimsZ = { 't' : (1,1),
-                        'z' : (thinCache,thinCache),
-                        'y' : (128,256),
-                        'x' : (128,256),
-                        'c' : (1000,1000) }
-        innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-        outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-
-        innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-        outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-
-        innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-        outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-
-        # Configure the cache   
-        for cache in self.autocontext_caches:     
-            cache.innerBlockShape.setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            cache.outerBlockShape.setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
+        # Plan the cache blocks for the data they actually cache, if it's known yet
+        def cachedMeta(cache):
+            if len(cache.Input) > imageIndex and cache.Input[imageIndex].ready():
+                return cache.Input[imageIndex].meta
+            return inputSlot.meta
 
+        thinCache = 5
+        shownCaches = self.prediction_caches[:1] + self.prediction_caches[1:][-1:]
+        if self.pixel_prediction_cache_gui is not None:
+            shownCaches.append( self.pixel_prediction_cache_gui )
+        for cache in shownCaches:
+            configureSlicedCache( cache, cachedMeta(cache), thinEdge=thinCache, laneIndex=imageIndex )
+
+        # The intermediate results are read blockwise (with halos), so their chunks are isotropic
+        for cache in self.prediction_caches[1:-1] + self.autocontext_caches:
+            meta = cachedMeta(cache)
+            chunks = list( chunkShape( meta.getAxisKeys(), meta.shape ) )
+            chunks[ meta.getAxisKeys().index('c') ] = ALL_CHANNELS
+            # Only this lane's chunks: the other lanes may have different shapes
+            laneSlot( cache.ChunkShape, imageIndex ).setValue( tuple(chunks) )
 
-    
-    
     def setInSlot(self, slot, subindex, roi, value):
         # Nothing to do here: All inputs that support __setitem__
         #   are directly connected to internal operators.
@@ -29,6 +29,7 @@ from lazyflow.operators import OpBlockedArrayCache
 from lazyflow.operators.ioOperators import OpH5WriterBigDataset
 from lazyflow.utility.pathHelpers import PathComponents
 from lazyflow.rtype import SubRegion
+from ilastik.utility.cacheGeometry import planBlockShapes
 logger = logging.getLogger(__name__)
 
 class ExportFormat():
@@ -138,39 +139,13 @@ class OpBatchIoSelective(Operator):
         self.setupCaches()
     
     def setupCaches(self):
-        # Set the blockshapes for each input image separately, depending on which axistags it has.
-        axisOrder = [ tag.key for tag in self.ImageToExport.meta.axistags ]
-
-        ## Pixel Cache blocks
-        blockDimsX = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (128,256),
-                       'x' : (1,1),
-                       'c' : (100, 100) }
-
-        blockDimsY = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (1,1),
-                       'x' : (128,256),
-                       'c' : (100,100) }
-
-        blockDimsZ = { 't' : (1,1),
-                       'z' : (1,1),
-                       'y' : (128,256),
-                       'x' : (128,256),
-                       'c' : (100,100) }
-
-        innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-        outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-
-        innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-        outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-
-        innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-        outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-
-        self.ImageCache.inputs["innerBlockShape"].setValue( innerBlockShapeZ )
-        self.ImageCache.inputs["outerBlockShape"].setValue(  outerBlockShapeZ )
+        # The export requests whole z-slices, so use the blocks
+        #  which are thin along z, planned for such requests.
+        meta = self.ImageToExport.meta
+        sliceShape = [ 1 if key == 'z' else size for key, size in zip(meta.getAxisKeys(), meta.shape) ]
+        inner, outer = planBlockShapes( meta, thinEdge=1, requestShapes=[sliceShape] )
+        self.ImageCache.inputs["innerBlockShape"].setValue( inner[2] )
+        self.ImageCache.inputs["outerBlockShape"].setValue( outer[2] )
 
     def propagateDirty(self, slot, subindex, roi):
         # Out input data changed, so we have work to do when we get executed.
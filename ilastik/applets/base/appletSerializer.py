@@ -27,14 +27,20 @@ from ilastik.config import cfg as ilastik_config
 from ilastik.utility.simpleSignal import SimpleSignal
 from ilastik.utility.maybe import maybe
 import os
+import re
+import zlib
 import tempfile
+import threading
+import uuid
 import vigra
 import h5py
 import numpy
 import warnings
 import cPickle as pickle
+from functools import partial
 
 from lazyflow.roi import TinyVector, roiToSlice, sliceToRoi
+from lazyflow.request import Request, RequestPool
 from lazyflow.utility import timeLogged
 
 #######################
@@ -88,8 +94,28 @@ def stringToSlicing(strSlicing):
     return slicing
 
 
+def parseRoiString(roiString):
+    """Parse a block roi from its string representation, e.g.
+    '[(0, 0, 0), (10, 10, 10)]', into a (start, stop) pair of tuples.
+
+    Any formatting of the numbers is accepted, as long as the string
+    lists all start coordinates, followed by all stop coordinates.
+
+    """
+    coords = map(int, re.findall(r'-?\d+', roiString))
+    assert len(coords) % 2 == 0, "Not a valid roi: {}".format(roiString)
+    ndim = len(coords) // 2
+    return tuple(coords[:ndim]), tuple(coords[ndim:])
+
+
 class SerialSlot(object):
     """Implements the logic for serializing a slot."""
+
+    #: Whether loading this slot may be deferred in a lazy project load
+    #: (see AppletSerializer.deserializeFromHdf5Deferred). Set for slots
+    #: which hold bulk data.
+    deferrable = False
+
     def __init__(self, slot, inslot=None, name=None, subname=None,
                  default=None, depends=None, selfdepends=True):
         """
@@ -339,7 +365,40 @@ class SerialListSlot(SerialSlot):
         self.dirty = False
 
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    For each subslot, all blocks are stored in a single chunked dataset
+    ('blockdata'), each one compressed separately, and a table of their
+    rois and positions within that dataset ('blockindex').  The blocks are
+    compressed and decompressed on multiple threads.
+
+    Both datasets are an append-only journal: when only some blocks have
+    changed since the last save, just those blocks are appended (or
+    recorded as deleted, if they are all zero now), and later entries for
+    a block supersede the earlier ones.  Once most of the blockdata is
+    superseded, the journal is compacted, i.e. rewritten with the live
+    blocks only.  HDF5 reuses the space of the old journal only while the
+    project file is open; the file itself shrinks when the ProjectManager
+    repacks it on close.
+
+    Projects which stored each block in its own dataset can still be
+    loaded.
+
+    """
+    deferrable = True
+
+    #: zlib compression level of the blocks
+    COMPRESSION_LEVEL = 1
+
+    #: chunk size (in bytes) of the blockdata dataset
+    CHUNK_BYTES = 2**20
+
+    #: compact the journal when this fraction of the blockdata is superseded
+    COMPACTION_THRESHOLD = 0.5
+
+    #: beyond this many dirty rois per subslot, only keep their bounding box
+    MAX_DIRTY_ROIS = 100
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
                  default=None, depends=None, selfdepends=True, shrink_to_bb=False):
         """
@@ -348,13 +407,93 @@ class SerialBlockSlot(SerialSlot):
                              its nonzero bounding box before feeding saving it.
 
         """
+        # Journal state, see serialize()
+        self._journalId = None
+        self._dirtyRois = {}
+        self._rewriteAll = True
+
         super(SerialBlockSlot, self).__init__(
             slot, inslot, name, subname, default, depends, selfdepends
         )
         self.blockslot = blockslot
-        self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
 
+    def _bind(self, slot=None):
+        """In addition to the dirty flag, remember which parts of each
+        subslot have changed, so that only those need to be saved.
+
+        """
+        super(SerialBlockSlot, self)._bind(slot)
+        slot = maybe(slot, self.slot)
+
+        def bindSubslot(slot, index, size):
+            slot[index].notifyDirty(self._recordDirtyRoi)
+            slot[index].notifyValueChanged(self._forgetJournal)
+            self._forgetJournal()
+
+        slot.notifyInserted(bindSubslot)
+        slot.notifyRemoved(self._forgetJournal)
+        for index in range(len(slot)):
+            slot[index].notifyDirty(self._recordDirtyRoi)
+            slot[index].notifyValueChanged(self._forgetJournal)
+
+    def _recordDirtyRoi(self, subslot, roi):
+        if self.ignoreDirty:
+            return
+        self.dirty = True
+        for index, s in enumerate(self.slot):
+            if s is subslot:
+                break
+        else:
+            self._forgetJournal()
+            return
+        start, stop = sliceToRoi( roiToSlice(roi.start, roi.stop), subslot.meta.shape )
+        # Don't modify the dict in place: copies of this object share it (see ProjectManager.saveProjectSnapshot)
+        rois = self._dirtyRois.get(index, []) + [(numpy.array(start), numpy.array(stop))]
+        if len(rois) > self.MAX_DIRTY_ROIS:
+            rois = [( numpy.min([r[0] for r in rois], axis=0), numpy.max([r[1] for r in rois], axis=0) )]
+        self._dirtyRois = dict(self._dirtyRois)
+        self._dirtyRois[index] = rois
+
+    def _forgetJournal(self, *args):
+        """The stored blocks can't be updated incrementally anymore."""
+        if not self.ignoreDirty:
+            self._rewriteAll = True
+
+    def _canAppend(self, group):
+        """Whether the blocks stored in group can be updated by appending
+        the changed blocks, i.e. whether they were written (or read) by
+        us and we know everything that has changed since.
+
+        """
+        if self._rewriteAll or self._journalId is None or not self._dirtyRois:
+            return False
+        if self.name not in group:
+            return False
+        mygroup = group[self.name]
+        return ( mygroup.attrs.get('journalId') == self._journalId and
+                 len(mygroup) == len(self.blockslot) == len(self.slot) )
+
+    def serialize(self, group):
+        if not self.shouldSerialize(group):
+            return
+        if self.slot.ready() and self._canAppend(group):
+            self._appendChanges(group[self.name])
+        else:
+            deleteIfPresent(group, self.name)
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
+        self._dirtyRois = {}
+        self._rewriteAll = False
+        self.dirty = False
+
+    def deserialize(self, group):
+        super(SerialBlockSlot, self).deserialize(group)
+        if self.name in group:
+            self._journalId = group[self.name].attrs.get('journalId')
+            self._dirtyRois = {}
+            self._rewriteAll = False
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
@@ -363,27 +502,153 @@ class SerialBlockSlot(SerialSlot):
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                block = self.slot[index][slicing].wait()
-                blockName = 'block{:04d}'.format(blockIndex)
-
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                subgroup.create_dataset(blockName, data=block)
-                subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+            blocks = self._compressBlocks(index, self.blockslot[index].value)
+            self._writeBlocks(subgroup, blocks, self.slot[index].meta.dtype, len(self.slot[index].meta.shape))
+        self._journalId = uuid.uuid4().hex
+        mygroup.attrs['journalId'] = self._journalId
+
+    @timeLogged(logger, logging.DEBUG)
+    def _appendChanges(self, mygroup):
+        logger.debug("Appending changed blocks of BlockSlot: {}".format( self.name ))
+        for index, dirtyRois in self._dirtyRois.items():
+            subgroup = mygroup[self.subname.format(index)]
+            def isDirty(start, stop):
+                return any( (start < dirtyStop).all() and (dirtyStart < stop).all()
+                            for dirtyStart, dirtyStop in dirtyRois )
+
+            shape = self.slot[index].meta.shape
+            nonZeroBlocks = {}
+            for slicing in self.blockslot[index].value:
+                start, stop = sliceToRoi( slicing, shape )
+                if isDirty(numpy.array(start), numpy.array(stop)):
+                    nonZeroBlocks[_blockKey(start, stop)] = slicing
+            blocks = self._compressBlocks(index, nonZeroBlocks.values())
+
+            # Blocks that used to be stored, but are all zero now
+            for entry in self._liveEntries( subgroup['blockindex'][...] ):
+                key = _blockKey(entry['blockstart'], entry['blockstop'])
+                if key not in nonZeroBlocks and isDirty(entry['blockstart'], entry['blockstop']):
+                    blocks.append( (numpy.array([entry['blockstart'], entry['blockstop']]), None, None) )
+
+            self._appendBlocks(subgroup, blocks)
+            self._compactIfNecessary(subgroup)
+
+    def _compressBlocks(self, index, slicings):
+        """Return (blockRoi, roi, compressed data) for each slicing, in order."""
+        blocks = [None] * len(slicings)
+        pool = RequestPool()
+        for blockIndex, slicing in enumerate(slicings):
+            pool.add( Request( partial(self._compressBlock, index, slicing, blocks, blockIndex) ) )
+        pool.wait()
+        pool.clean()
+        return blocks
+
+    def _compressBlock(self, index, slicing, blocks, blockIndex):
+        block = self.slot[index][slicing].wait()
+        roi = sliceToRoi( slicing, self.slot[index].meta.shape )
+        blockRoi = roi
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = roi[0]
+                block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+                block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+
+                # Overwrite the vars that are written to the file
+                roi = bounding_box_roi
+                block = block[block_slicing]
+
+        # zlib releases the GIL, so the blocks really are compressed in parallel
+        data = zlib.compress( numpy.ascontiguousarray(block).data, self.COMPRESSION_LEVEL )
+        blocks[blockIndex] = (blockRoi, roi, data)
+
+    @staticmethod
+    def _indexDtype(ndim):
+        return [('blockstart', numpy.int64, (ndim,)),
+                ('blockstop', numpy.int64, (ndim,)),
+                ('start', numpy.int64, (ndim,)),
+                ('stop', numpy.int64, (ndim,)),
+                ('offset', numpy.int64),
+                ('nbytes', numpy.int64)]
+
+    @staticmethod
+    def _makeIndex(blocks, offset, ndim):
+        """Index entries for the given blocks, whose data starts at
+        offset. Blocks without data are recorded as deleted.
+
+        """
+        index = numpy.zeros( (len(blocks),), dtype=SerialBlockSlot._indexDtype(ndim) )
+        for blockIndex, (blockRoi, roi, data) in enumerate(blocks):
+            if data is None:
+                index[blockIndex] = (blockRoi[0], blockRoi[1], blockRoi[0], blockRoi[0], offset, -1)
+            else:
+                index[blockIndex] = (blockRoi[0], blockRoi[1], roi[0], roi[1], offset, len(data))
+                offset += len(data)
+        blockdata = numpy.fromstring( "".join( data for _, _, data in blocks if data is not None ), dtype=numpy.uint8 )
+        return index, blockdata
+
+    def _writeBlocks(self, subgroup, blocks, dtype, ndim):
+        index, blockdata = self._makeIndex(blocks, 0, ndim)
+        chunks = min( max(len(blockdata), 2**16), self.CHUNK_BYTES )
+        subgroup.create_dataset( 'blockdata', data=blockdata, chunks=(chunks,), maxshape=(None,) )
+        subgroup.create_dataset( 'blockindex', data=index, chunks=True, maxshape=(None,) )
+        subgroup.attrs['dtype'] = numpy.dtype(dtype).str
+
+    def _appendBlocks(self, subgroup, blocks):
+        if not blocks:
+            return
+        blockdataset = subgroup['blockdata']
+        indexdataset = subgroup['blockindex']
+        offset = len(blockdataset)
+        index, blockdata = self._makeIndex(blocks, offset, indexdataset.dtype['start'].shape[0])
+
+        blockdataset.resize( (offset + len(blockdata),) )
+        blockdataset[offset:] = blockdata
+        nentries = len(indexdataset)
+        indexdataset.resize( (nentries + len(index),) )
+        indexdataset[nentries:] = index
+
+    def _compactIfNecessary(self, subgroup):
+        """Fold the journal: rewrite the live blocks only, if enough of
+        the stored data has been superseded.
+
+        """
+        blockindex = subgroup['blockindex'][...]
+        live = self._liveEntries(blockindex)
+        totalBytes = len(subgroup['blockdata'])
+        liveBytes = live['nbytes'].sum()
+        if totalBytes == 0 or totalBytes - liveBytes <= self.COMPACTION_THRESHOLD * totalBytes:
+            return
+
+        logger.debug("Compacting BlockSlot: {} ({} of {} bytes in use)".format( self.name, liveBytes, totalBytes ))
+        blockdata = subgroup['blockdata'][...]
+        blocks = [ ( numpy.array([e['blockstart'], e['blockstop']]),
+                     numpy.array([e['start'], e['stop']]),
+                     blockdata[e['offset']:e['offset'] + e['nbytes']].tostring() )
+                   for e in live ]
+        dtype = subgroup.attrs['dtype']
+        del subgroup['blockdata']
+        del subgroup['blockindex']
+        self._writeBlocks(subgroup, blocks, dtype, blockindex.dtype['start'].shape[0])
+
+    @staticmethod
+    def _liveEntries(blockindex):
+        """The entries of a blockindex which are not superseded by
+        later entries for the same block, and are not deletions.
+
+        """
+        if 'blockstart' not in blockindex.dtype.names:
+            # Written without a journal
+            return blockindex
+        latest = {}
+        for i, entry in enumerate(blockindex):
+            latest[_blockKey(entry['blockstart'], entry['blockstop'])] = i
+        live = sorted( i for i in latest.values() if blockindex[i]['nbytes'] >= 0 )
+        return blockindex[live]
 
     @timeLogged(logger, logging.DEBUG)
     def _deserialize(self, mygroup, slot):
@@ -393,9 +658,37 @@ class SerialBlockSlot(SerialSlot):
             self.inslot.resize(num)
         for index, t in enumerate(sorted(mygroup.items())):
             groupName, labelGroup = t
-            for blockData in labelGroup.values():
-                slicing = stringToSlicing(blockData.attrs['blockSlice'])
-                self.inslot[index][slicing] = blockData[...]
+            if 'blockindex' in labelGroup:
+                self._readBlocks( labelGroup, self.inslot[index] )
+            else:
+                # Old format: one dataset per block
+                for blockData in labelGroup.values():
+                    slicing = stringToSlicing(blockData.attrs['blockSlice'])
+                    self.inslot[index][slicing] = blockData[...]
+
+    def _readBlocks(self, labelGroup, inslot):
+        dtype = numpy.dtype( labelGroup.attrs['dtype'] )
+        blockindex = self._liveEntries( labelGroup['blockindex'][...] )
+        blockdata = labelGroup['blockdata'][...]
+
+        # Decompress in parallel, but write into the slot one block at a time
+        lock = threading.Lock()
+        def readBlock(entry):
+            start, stop = entry['start'], entry['stop']
+            data = blockdata[entry['offset']:entry['offset'] + entry['nbytes']]
+            block = numpy.fromstring( zlib.decompress( data.tostring() ), dtype=dtype )
+            block = block.reshape( tuple(stop - start) )
+            with lock:
+                inslot[roiToSlice( start, stop )] = block
+
+        pool = RequestPool()
+        for entry in blockindex:
+            pool.add( Request( partial(readBlock, entry) ) )
+        pool.wait()
+        pool.clean()
+
+def _blockKey(start, stop):
+    return tuple(map(int, start)) + tuple(map(int, stop))
 
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
@@ -420,7 +713,7 @@ class SerialHdf5BlockSlot(SerialBlockSlot):
         for index, t in enumerate(sorted(mygroup.items())):
             groupName, labelGroup = t
             for blockRoiString, blockDataset in labelGroup.items():
-                blockRoi = eval(blockRoiString)
+                blockRoi = parseRoiString(blockRoiString)
                 roiShape = TinyVector(blockRoi[1]) - TinyVector(blockRoi[0])
                 assert roiShape == blockDataset.shape
 
@@ -428,6 +721,8 @@ class SerialHdf5BlockSlot(SerialBlockSlot):
 
 class SerialClassifierSlot(SerialSlot):
     """For saving a random forest classifier."""
+    deferrable = True
+
     def __init__(self, slot, cache, inslot=None, name=None,
                  default=None, depends=None, selfdepends=True):
         super(SerialClassifierSlot, self).__init__(
@@ -486,6 +781,8 @@ class SerialClassifierSlot(SerialSlot):
 
 class SerialCountingSlot(SerialSlot):
     """For saving a random forest classifier."""
+    deferrable = True
+
     def __init__(self, slot, cache, inslot=None, name=None, subname=None,
                  default=None, depends=None, selfdepends=True):
         super(SerialCountingSlot, self).__init__(
@@ -773,31 +1070,83 @@ class AppletSerializer(object):
         
         """
         self.progressSignal.emit(0)
+        try:
+            for deferrable, step in self._deserializationSteps(hdf5File, projectFilePath, headless):
+                step()
+        finally:
+            self.progressSignal.emit(100)
+
+    def deserializeFromHdf5Deferred(self, hdf5File, projectFilePath, headless = False):
+        """Lazy version of deserializeFromHdf5(): only the slots before
+        the first deferrable one are read now.
+
+        Returns None if nothing was deferred. Otherwise, returns a function
+        which reads the remaining slots (in order) and calls
+        *_deserializeFromHdf5*. The caller must make sure it is called
+        before the applet state is used or saved, and that the slots which
+        are not read yet aren't modified in the meantime.
+
+        Dirty tracking (see ignoreDirty) is re-enabled for each slot as soon
+        as it has been read, so changes made while the rest is loading are
+        saved.
+
+        """
+        self.progressSignal.emit(0)
+        steps = self._deserializationSteps(hdf5File, projectFilePath, headless)
+        firstDeferred = len(steps)
+        for i, (deferrable, step) in enumerate(steps):
+            if deferrable:
+                firstDeferred = i
+                break
+
+        try:
+            for deferrable, step in steps[:firstDeferred]:
+                step()
+        except:
+            self.progressSignal.emit(100)
+            raise
+        if firstDeferred == len(steps):
+            self.progressSignal.emit(100)
+            return None
 
+        # Something was deferred, so the first steps are those of the serial slots
+        for ss in self.serialSlots[:firstDeferred]:
+            ss.ignoreDirty = False
+
+        def loadDeferred():
+            try:
+                for i in range(firstDeferred, len(steps)):
+                    steps[i][1]()
+                    if i < len(self.serialSlots):
+                        self.serialSlots[i].ignoreDirty = False
+            finally:
+                self.progressSignal.emit(100)
+        return loadDeferred
+
+    def _deserializationSteps(self, hdf5File, projectFilePath, headless):
+        """The steps of a deserialization, as a list of (deferrable,
+        function) pairs.
+
+        """
         # If the top group isn't there, call initWithoutTopGroup
         try:
             topGroup = hdf5File[self.topGroupName]
             groupVersion = topGroup['StorageVersion'][()]
         except KeyError:
-            topGroup = None
-            groupVersion = None
+            return [(False, partial(self.initWithoutTopGroup, hdf5File, projectFilePath))]
 
-        try:
-            if topGroup is not None:
-                inc = self.progressIncrement()
-                for ss in self.serialSlots:
-                    ss.deserialize(topGroup)
-                    self.progressSignal.emit(inc)
-
-                # Call the subclass to do remaining work
-                if self.caresOfHeadless:
-                    self._deserializeFromHdf5(topGroup, groupVersion, hdf5File, projectFilePath, headless)
-                else:
-                    self._deserializeFromHdf5(topGroup, groupVersion, hdf5File, projectFilePath)
-            else:
-                self.initWithoutTopGroup(hdf5File, projectFilePath)
-        finally:
-            self.progressSignal.emit(100)
+        inc = self.progressIncrement()
+        def deserializeSlot(ss):
+            ss.deserialize(topGroup)
+            self.progressSignal.emit(inc)
+        steps = [(ss.deferrable, partial(deserializeSlot, ss)) for ss in self.serialSlots]
+
+        # Call the subclass to do remaining work
+        if self.caresOfHeadless:
+            steps.append( (False, partial(self._deserializeFromHdf5, topGroup, groupVersion, hdf5File, projectFilePath, headless)) )
+        else:
+            steps.append( (False, partial(self._deserializeFromHdf5, topGroup, groupVersion, hdf5File, projectFilePath)) )
+        return steps
     
     def repairFile(self,path,filt = None):
         """get new path to lost file"""
@@ -20,13 +20,15 @@
 ###############################################################################
 # Built-in
 import logging
+import collections
+import threading
 
 # Third-party
 import numpy
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 from lazyflow.operators import OpSubRegion, OpMultiArrayStacker
 from lazyflow.stype import Opaque
@@ -227,13 +229,27 @@ class OpBlockwiseObjectClassification( Operator ):
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
 
+    # Block pipelines are computed concurrently by at most this many workers.
+    MaxConcurrentBlocks = InputSlot( value=4 )
+    # Rough upper bound for the memory used by the block pipelines (cached and working set).
+    # Least-recently-used pipelines are discarded to stay within the budget.
+    MemoryBudgetMb = InputSlot( value=4096 )
+
     PredictionImage = OutputSlot()
     ProbabilityChannelImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
+
+    # Per-voxel byte estimates (in the halo region) for one block pipeline.
+    # A pipeline keeps its label image (uint32) and object center image (uint8) cached.
+    CACHED_BYTES_PER_VOXEL = 5
+    # While it is computed, the raw data, its float32 copy and the label volume are
+    # in memory at once (see OpRegionFeatures3d). Raw data bytes are added per channel.
+    WORKING_BYTES_PER_VOXEL = 8
     
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict() # indexed by blockstart, least recently used first
+        self._pipelineUsers = collections.defaultdict(int) # number of requests currently using each pipeline
         self._lock = RequestLock()
         
     def setupOutputs(self):
@@ -269,6 +285,29 @@ class OpBlockwiseObjectClassification( Operator ):
         self.BlockwiseRegionFeatures.meta.shape = tuple(region_feature_output_shape)
         self.BlockwiseRegionFeatures.meta.dtype = object
         self.BlockwiseRegionFeatures.meta.axistags = self.PredictionImage.meta.axistags
+
+        self._maxWorkers, self._maxPipelines = self._computeBudget()
+
+    def _computeBudget(self):
+        """
+        Translate the memory budget into a number of concurrently processed 
+        blocks and a number of cached block pipelines.
+        """
+        tagged_shape = self.RawImage.meta.getTaggedShape()
+        halo_voxels = 1
+        for k in 'xyz':
+            if k in tagged_shape:
+                halo_voxels *= min( tagged_shape[k], self._block_shape_dict[k] + 2*self._halo_padding_dict[k] )
+
+        raw_bytes = numpy.dtype(self.RawImage.meta.dtype).itemsize * tagged_shape['c']
+        working_bytes = halo_voxels * (self.WORKING_BYTES_PER_VOXEL + raw_bytes)
+        cached_bytes = halo_voxels * self.CACHED_BYTES_PER_VOXEL
+        budget = self.MemoryBudgetMb.value * 2**20
+
+        max_workers = max( 1, min( self.MaxConcurrentBlocks.value, budget // (working_bytes + cached_bytes) ) )
+        max_pipelines = max( max_workers, (budget - max_workers*working_bytes) // cached_bytes )
+        logger.debug( "Block budget: {} concurrent blocks, {} cached block pipelines".format( max_workers, max_pipelines ) )
+        return int(max_workers), int(max_pipelines)
         
     def execute(self, slot, subindex, roi, destination):
         if slot == self.PredictionImage or slot == self.ProbabilityChannelImage:
@@ -286,36 +325,55 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = getIntersectingBlocks( block_shape, roi_one_channel )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
-
-        # Retrieve result from each block, and write into the appropriate region of the destination
-        # TODO: Parallelize this loop
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
-            block_roi = opBlockPipeline.block_roi
-            block_intersection = getIntersection( block_roi, roi_one_channel )
-            block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
-            destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
-
-            block_slot = opBlockPipeline.PredictionImage            
-            if slot == self.ProbabilityChannelImage:
-                block_slot = opBlockPipeline.ProbabilityChannelImage
-                # Add channels back to roi
-                # request all channels
-                block_relative_intersection[...,-1] = (0, opBlockPipeline.ProbabilityChannelImage.meta.shape[-1])
-                # But only write the ones that were specified in the original roi
-                destination_relative_intersection[...,-1] = ( roi.start[-1], roi.stop[-1] )
-
-            # Request the data
-            destination_slice = roiToSlice( *destination_relative_intersection )
-            req = block_slot( *block_relative_intersection )
-            req.writeInto( destination[destination_slice] )
-            req.wait()
-
+        def processBlock(block_start):
+            opBlockPipeline = self._acquirePipeline(block_start)
+            try:
+                block_roi = opBlockPipeline.block_roi
+                block_intersection = getIntersection( block_roi, roi_one_channel )
+                block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
+                destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
+
+                block_slot = opBlockPipeline.PredictionImage            
+                if slot == self.ProbabilityChannelImage:
+                    block_slot = opBlockPipeline.ProbabilityChannelImage
+                    # Add channels back to roi
+                    # request all channels
+                    block_relative_intersection[...,-1] = (0, opBlockPipeline.ProbabilityChannelImage.meta.shape[-1])
+                    # But only write the ones that were specified in the original roi
+                    destination_relative_intersection[...,-1] = ( roi.start[-1], roi.stop[-1] )
+
+                # Request the data
+                destination_slice = roiToSlice( *destination_relative_intersection )
+                req = block_slot( *block_relative_intersection )
+                req.writeInto( destination[destination_slice] )
+                req.wait()
+            finally:
+                self._releasePipeline(block_start)
+
+        self._processBlocks( block_starts, processBlock )
         return destination
 
+    def _processBlocks(self, block_starts, func):
+        """
+        Call func(block_start) for every block, with at most _maxWorkers blocks in flight.
+        """
+        queue = collections.deque( block_starts )
+        queue_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with queue_lock:
+                    if not queue:
+                        return
+                    block_start = queue.popleft()
+                func(block_start)
+
+        pool = RequestPool()
+        for _ in range( min( self._maxWorkers, len(block_starts) ) ):
+            pool.add( Request( worker ) )
+        pool.wait()
+        pool.clean()
+
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
         Provide data for the BlockwiseRegionFeatures slot.
@@ -324,7 +382,7 @@ class OpBlockwiseObjectClassification( Operator ):
                    (1,20,30,40,5) should be requested via roi [(1,2,3,4,5),(2,3,4,5,6)]
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
-              Therefore, it is considered an error to request features that are not already computed.
+              If the pipeline of a block was discarded in the meantime (see MemoryBudgetMb), its features are recomputed.
         """
         axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
@@ -334,8 +392,6 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = map( tuple, block_starts )
         
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
-
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
             tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
@@ -345,41 +401,91 @@ class OpBlockwiseObjectClassification( Operator ):
             destination_start = numpy.array(block_start) / block_shape - roi.start
             destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
 
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
-            req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
-            req.wait()
+            opBlockPipeline = self._acquirePipeline(block_start)
+            try:
+                req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
+                req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
+                req.wait()
+            finally:
+                self._releasePipeline(block_start)
         
         return destination
 
-    def _ensurePipelineExists(self, block_start):
-        if block_start in self._blockPipelines:
-            return
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline for the given block (creating it if necessary),
+        and protect it from eviction until _releasePipeline() is called.
+        """
         with self._lock:
-            if block_start in self._blockPipelines:
-                return
-
-            logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+            opBlockPipeline = self._getPipeline(block_start)
+            self._pipelineUsers[block_start] += 1
+            return opBlockPipeline
 
-            block_shape = self._getFullShape( self._block_shape_dict )
-            halo_padding = self._getFullShape( self._halo_padding_dict )
+    def _releasePipeline(self, block_start):
+        with self._lock:
+            self._pipelineUsers[block_start] -= 1
+            if self._pipelineUsers[block_start] == 0:
+                del self._pipelineUsers[block_start]
+            self._evictPipelines()
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
-            block_roi = (block_start, block_stop)
+    def _evictPipelines(self, reserve=0):
+        """
+        Discard least-recently-used pipelines that aren't in use until we're within budget
+        (leaving room for 'reserve' new pipelines).
+        Must be called with self._lock held.
+        """
+        excess = len(self._blockPipelines) + reserve - self._maxPipelines
+        for block_start in list(self._blockPipelines.keys()):
+            if excess <= 0:
+                break
+            if block_start in self._pipelineUsers:
+                continue
+            logger.debug( "Discarding pipeline for block: {}".format( block_start ) )
+            self._blockPipelines.pop(block_start).cleanUp()
+            excess -= 1
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
-            opBlockPipeline.RawImage.connect( self.RawImage )
-            opBlockPipeline.BinaryImage.connect( self.BinaryImage )
-            opBlockPipeline.Classifier.connect( self.Classifier )
-            opBlockPipeline.LabelsCount.connect( self.LabelsCount )
-            opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+    def _ensurePipelineExists(self, block_start):
+        """
+        Return the pipeline for the given block, creating it first if necessary.
+        The pipeline becomes the most recently used one.
+        """
+        with self._lock:
+            return self._getPipeline(block_start)
 
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
-            
+    def _getPipeline(self, block_start):
+        """
+        Implementation of _ensurePipelineExists().
+        Must be called with self._lock held.
+        """
+        if block_start in self._blockPipelines:
+            # Move to the end of the LRU order
+            opBlockPipeline = self._blockPipelines.pop(block_start)
             self._blockPipelines[block_start] = opBlockPipeline
+            return opBlockPipeline
+
+        self._evictPipelines(reserve=1)
+        logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( self._halo_padding_dict )
+
+        input_shape = self.RawImage.meta.shape
+        block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
+        block_roi = (block_start, block_stop)
+
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
+        opBlockPipeline.RawImage.connect( self.RawImage )
+        opBlockPipeline.BinaryImage.connect( self.BinaryImage )
+        opBlockPipeline.Classifier.connect( self.Classifier )
+        opBlockPipeline.LabelsCount.connect( self.LabelsCount )
+        opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+
+        # Forward dirtyness
+        opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
+        
+        self._blockPipelines[block_start] = opBlockPipeline
+        return opBlockPipeline
 
     
     def _getFullShape(self, spatialShapeDict):
@@ -404,7 +510,7 @@ class OpBlockwiseObjectClassification( Operator ):
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
         oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
+        self._blockPipelines = collections.OrderedDict()
         with self._lock:
             for opBlockPipeline in oldBlockPipelines.values():
                 opBlockPipeline.cleanUp()
@@ -414,6 +520,38 @@ class OpBlockwiseObjectClassification( Operator ):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty( slice(None) )
+            self.ProbabilityChannelImage.setDirty( slice(None) )
+        elif slot == self.RawImage or slot == self.BinaryImage:
+            # The existing pipelines forward their own dirtyness,
+            # but the blocks of discarded pipelines must be marked dirty here.
+            start, stop = self._getDirtyBlocksRoi( roi )
+            self.PredictionImage.setDirty( start, stop )
+            c_index = self.RawImage.meta.getAxisKeys().index('c')
+            stop[c_index] = self.ProbabilityChannelImage.meta.shape[c_index]
+            self.ProbabilityChannelImage.setDirty( start, stop )
+        elif slot == self.Classifier or slot == self.LabelsCount or slot == self.SelectedFeatures:
+            self.PredictionImage.setDirty( slice(None) )
+            self.ProbabilityChannelImage.setDirty( slice(None) )
+        # Changing the budget doesn't change the results.
+        # The new budget is applied in setupOutputs()
+
+    def _getDirtyBlocksRoi(self, roi):
+        """
+        Return the (single-channel) roi of all blocks whose halo intersects the given input roi.
+        """
+        axiskeys = self.RawImage.meta.getAxisKeys()
+        shape = numpy.array( self.PredictionImage.meta.shape )
+        block_shape = numpy.array( self._getFullShape( self._block_shape_dict ) )
+        halo = numpy.array( [ self._halo_padding_dict[k] if k in 'xyz' else 0 for k in axiskeys ] )
+
+        start = numpy.maximum( numpy.array(roi.start) - halo, 0 )
+        stop = numpy.minimum( numpy.array(roi.stop) + halo, shape )
+        start = (start // block_shape) * block_shape
+        stop = numpy.minimum( ((stop + block_shape - 1) // block_shape) * block_shape, shape )
+        c_index = axiskeys.index('c')
+        start[c_index] = 0
+        stop[c_index] = 1
+        return start, stop
     
     
     def _handleDirtyBlock(self, block_start, slot, roi):
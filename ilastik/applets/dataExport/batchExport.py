@@ -0,0 +1,439 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Resumable export of all lanes of a (batch) data export operator.
+
+The hdf5 outputs are written block by block, and every finished block is
+recorded in a journal next to the output file. Running the same export
+again skips the outputs which are complete and the blocks which are already
+written, so an interrupted batch run picks up where it stopped. Outputs in
+other formats are exported as a whole, and only their completion is recorded.
+
+The journal's header describes the export, including the modification time
+of the input dataset and a fingerprint of whatever else the results depend
+on (e.g. the project file). If anything in it changed, the output is
+exported again from scratch.
+
+Blocks of several outputs are computed at the same time (the tail of one
+output overlaps with the head of the next), on lazyflow's worker threads.
+The number of blocks in flight is limited by a memory budget.
+"""
+import os
+import glob
+import json
+import threading
+from functools import partial
+
+import numpy
+import h5py
+
+from lazyflow.request import Request
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+from lazyflow.utility import PathComponents
+
+from ilastik.applets.dataSelection.internalStorage import COMPRESSION, chunkShape
+
+import logging
+logger = logging.getLogger(__name__)
+
+#: Memory for all blocks which are being computed at the same time
+MEMORY_BUDGET = 2 * 2**30
+
+#: Upper bound for the data of a single block
+BLOCK_BYTES = 64 * 2**20
+
+#: The journal of an output file is stored next to it, with this suffix
+JOURNAL_SUFFIX = '.journal'
+
+class ExportJournal(object):
+    """
+    Records the progress of a single export: one json record per line,
+    starting with a header which describes the export. The file is only
+    appended to, so an interrupted write loses at most the last record.
+    A journal whose header doesn't match the export is started over.
+    """
+    def __init__(self, path, header):
+        self.path = path
+        # (Compare the header in its json form)
+        self.header = json.loads( json.dumps(header) )
+        self.completedBlocks = set()
+        self.complete = False
+        self._lock = threading.Lock()
+
+        records = []
+        truncated = False
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        records.append( json.loads(line) )
+                    except ValueError:
+                        # Interrupted while writing this record
+                        truncated = True
+                        break
+        if not records or records[0] != self.header:
+            self.reset()
+            return
+        if truncated:
+            # Drop the partial record, so that new records can be appended
+            with open(self.path, 'w') as f:
+                f.writelines( json.dumps(record) + '\n' for record in records )
+        for record in records[1:]:
+            if 'block' in record:
+                self.completedBlocks.add( tuple(record['block']) )
+            elif record.get('complete'):
+                self.complete = True
+
+    def reset(self):
+        with self._lock:
+            self.completedBlocks = set()
+            self.complete = False
+            with open(self.path, 'w') as f:
+                f.write( json.dumps(self.header) + '\n' )
+
+    def recordBlock(self, blockStart):
+        blockStart = tuple( int(x) for x in blockStart )
+        self._append( {'block' : blockStart} )
+        self.completedBlocks.add( blockStart )
+
+    def recordComplete(self):
+        self._append( {'complete' : True} )
+        self.complete = True
+
+    def _append(self, record):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write( json.dumps(record) + '\n' )
+                f.flush()
+                os.fsync( f.fileno() )
+
+class ResumableBatchExport(object):
+    """
+    Exports all lanes of an OpDataExport (usually the batch results applet's
+    top-level operator). See the module docstring.
+
+    :param restart: Discard the journals, i.e. export everything again.
+    :param fingerprint: A json-serializable description of the state the
+        results depend on, besides the input data (see projectFingerprint).
+        Outputs which were exported with a different fingerprint are exported again.
+    """
+    def __init__(self, opDataExport, memoryBudget=MEMORY_BUDGET, blockBytes=BLOCK_BYTES, restart=False, fingerprint=None):
+        self._opDataExport = opDataExport
+        self._memoryBudget = memoryBudget
+        self._blockBytes = blockBytes
+        self._restart = restart
+        self._fingerprint = fingerprint
+
+    def run(self, progressSignal=None):
+        """
+        Export all lanes. A failure only stops the output it occurs in.
+
+        :param progressSignal: Called with the overall progress percentage.
+        :returns: A list of (laneIndex, exportPath, exception) for the failed outputs.
+        """
+        lanes = [ _LaneExport( index, opLane, self._blockBytes, self._restart, self._fingerprint )
+                  for index, opLane in enumerate(self._opDataExport) ]
+
+        totalBlocks = sum( lane.totalBlocks for lane in lanes )
+        progress = _Progress( totalBlocks - sum( len(lane.pendingBlocks) for lane in lanes ),
+                              totalBlocks, progressSignal )
+
+        # Throttle the blocks in flight (of all lanes together) according to the memory budget
+        inFlight = _MemoryBudget( self._memoryBudget )
+        for lane in lanes:
+            if lane.skip:
+                logger.info( "Skipping {}: export is complete.".format( lane.exportPath ) )
+                continue
+            logger.info( "Exporting result {} to {}".format( lane.index, lane.exportPath ) )
+            if not lane.blockwise:
+                lane.runWholeExport()
+                progress.advance( lane.totalBlocks )
+                continue
+
+            try:
+                lane.open()
+            except Exception as ex:
+                lane.fail( ex )
+            for blockStart in lane.pendingBlocks:
+                if lane.error is not None:
+                    break
+                inFlight.acquire( lane.blockBytes )
+                lane.started()
+                req = Request( partial( self._exportBlock, lane, blockStart, progress, inFlight ) )
+                req.submit()
+            lane.allSubmitted()
+
+        for lane in lanes:
+            lane.done.wait()
+
+        failures = [ (lane.index, lane.exportPath, lane.error) for lane in lanes if lane.error is not None ]
+        for index, path, error in failures:
+            logger.error( "Export of result {} to {} failed: {}".format( index, path, error ) )
+        return failures
+
+    def _exportBlock(self, lane, blockStart, progress, inFlight):
+        try:
+            lane.exportBlock( blockStart )
+            progress.advance( 1 )
+        except Exception as ex:
+            lane.fail( ex )
+        finally:
+            inFlight.release( lane.blockBytes )
+            lane.finished()
+
+class _LaneExport(object):
+    """
+    The export of a single lane, and its journal.
+    """
+    def __init__(self, index, opLane, blockBytes, restart, fingerprint):
+        self.index = index
+        self.opLane = opLane
+        self.image = opLane.ImageToExport
+        self.exportPath = opLane.ExportPath.value
+        self.error = None
+        self.done = threading.Event()
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._allSubmitted = False
+        self._file = None
+        self._dataset = None
+
+        pathComponents = PathComponents( self.exportPath )
+        self.externalPath = pathComponents.externalPath
+        self.internalPath = pathComponents.internalPath
+        self.blockwise = ( opLane.OutputFormat.value == 'hdf5' and self.internalPath is not None )
+
+        meta = self.image.meta
+        header = { 'path' : self.exportPath,
+                   'shape' : map( int, meta.shape ),
+                   'dtype' : numpy.dtype(meta.dtype).name,
+                   'input' : _inputFingerprint( opLane ),
+                   'fingerprint' : fingerprint }
+        if self.blockwise:
+            self.chunkShape = chunkShape( meta.getAxisKeys(), meta.shape )
+            self.blockShape = _blockShape( meta, self.chunkShape, blockBytes )
+            header['blockShape'] = self.blockShape
+            blocks = [ tuple( map(int, start) ) for start in getIntersectingBlocks( self.blockShape, ((0,)*len(meta.shape), meta.shape) ) ]
+            self.blockBytes = _pixelBytes( meta ) * numpy.prod( self.blockShape ) // _channels( meta )
+        else:
+            blocks = [ (0,)*len(meta.shape) ]
+
+        self.journal = ExportJournal( self.externalPath + JOURNAL_SUFFIX, header )
+        if restart or not os.path.exists( self.externalPath ):
+            self.journal.reset()
+        elif self.blockwise and not self._datasetMatches():
+            self.journal.reset()
+
+        self.totalBlocks = len(blocks)
+        self.skip = self.journal.complete
+        if self.skip:
+            self.pendingBlocks = []
+            self.done.set()
+        else:
+            self.pendingBlocks = [ start for start in blocks if start not in self.journal.completedBlocks ]
+
+    def _datasetMatches(self):
+        try:
+            with h5py.File( self.externalPath, 'r' ) as f:
+                dataset = f.get( self.internalPath )
+                return ( dataset is not None
+                         and dataset.shape == tuple(self.image.meta.shape)
+                         and dataset.dtype == numpy.dtype(self.image.meta.dtype) )
+        except IOError:
+            return False
+
+    def runWholeExport(self):
+        try:
+            self.opLane.run_export()
+            self.journal.recordComplete()
+        except Exception as ex:
+            self.error = ex
+        self.done.set()
+
+    def open(self):
+        """
+        Open the output file, and create the dataset if it isn't there (or
+        if it doesn't match the journal).
+        """
+        meta = self.image.meta
+        self._file = h5py.File( self.externalPath, 'a' )
+        dataset = self._file.get( self.internalPath )
+        if dataset is None or not self.journal.completedBlocks:
+            if dataset is not None:
+                del self._file[ self.internalPath ]
+            dataset = self._file.create_dataset( self.internalPath, shape=meta.shape, dtype=meta.dtype,
+                                                 chunks=self.chunkShape, **COMPRESSION )
+            dataset.attrs['axistags'] = meta.axistags.toJSON()
+            if meta.drange is not None:
+                dataset.attrs['drange'] = meta.drange
+        self._dataset = dataset
+
+    def exportBlock(self, blockStart):
+        if self.error is not None:
+            return
+        start, stop = getBlockBounds( self.image.meta.shape, self.blockShape, blockStart )
+        data = self.image( start, stop ).wait()
+        with self._lock:
+            self._dataset[ roiToSlice( start, stop ) ] = data
+            # The block must be on disk before it is recorded
+            self._file.flush()
+        self.journal.recordBlock( blockStart )
+
+    def fail(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+
+    def started(self):
+        with self._lock:
+            self._pending += 1
+
+    def finished(self):
+        with self._lock:
+            self._pending -= 1
+            last = ( self._pending == 0 and self._allSubmitted )
+        if last:
+            self._finish()
+
+    def allSubmitted(self):
+        with self._lock:
+            self._allSubmitted = True
+            last = ( self._pending == 0 )
+        if last:
+            self._finish()
+
+    def _finish(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.error is None:
+            self.journal.recordComplete()
+            logger.info( "Finished exporting {}".format( self.exportPath ) )
+        self.done.set()
+
+class _MemoryBudget(object):
+    """
+    Memory reserved for the blocks in flight. It is only acquired by the
+    submitting thread (blocking a lazyflow worker thread could stall the
+    computation). A block which exceeds the whole budget may still run alone.
+    """
+    def __init__(self, budget):
+        self._condition = threading.Condition()
+        self._budget = budget
+        self._used = 0
+
+    def acquire(self, nbytes):
+        with self._condition:
+            while self._used > 0 and self._used + nbytes > self._budget:
+                self._condition.wait()
+            self._used += nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self._used -= nbytes
+            self._condition.notify_all()
+
+class _Progress(object):
+    def __init__(self, completed, total, progressSignal):
+        self._lock = threading.Lock()
+        self._completed = completed
+        self._total = max( 1, total )
+        self._signal = progressSignal
+        self._percent = None
+        self._report()
+
+    def advance(self, blocks):
+        with self._lock:
+            self._completed += blocks
+            self._report()
+
+    def _report(self):
+        percent = 100 * self._completed // self._total
+        if self._signal is not None and percent != self._percent:
+            self._percent = percent
+            self._signal( percent )
+
+def projectFingerprint(projectFilePath):
+    """
+    A fingerprint of a project file (its path and modification time), for
+    ResumableBatchExport: the classifier and all settings are stored in it.
+    """
+    if projectFilePath is None or not os.path.exists(projectFilePath):
+        return None
+    return { 'project' : os.path.abspath(projectFilePath),
+             'modified' : os.path.getmtime(projectFilePath) }
+
+def _inputFingerprint(opLane):
+    """
+    The path of the lane's input dataset, and the modification time of its
+    file(s), if it is stored outside of the project.
+    """
+    if not opLane.RawDatasetInfo.ready():
+        return None
+    filePath = getattr( opLane.RawDatasetInfo.value, 'filePath', None )
+    if not filePath:
+        return None
+    workingDirectory = opLane.WorkingDirectory.value if opLane.WorkingDirectory.ready() else os.getcwd()
+    externalPath = PathComponents( filePath, workingDirectory ).externalPath
+    # (Stacks are given as globstrings)
+    modified = [ os.path.getmtime(path) for path in glob.glob(externalPath) ]
+    return { 'path' : filePath,
+             'modified' : max(modified) if modified else None }
+
+def _channels(meta):
+    return meta.getTaggedShape().get('c', 1)
+
+def _pixelBytes(meta):
+    """
+    Bytes needed per pixel (over all channels) to compute the image.
+    """
+    pixelBytes = numpy.dtype(meta.dtype).itemsize * _channels(meta)
+    if meta.ram_usage_per_requested_pixel is not None:
+        pixelBytes = max( pixelBytes, meta.ram_usage_per_requested_pixel )
+    return pixelBytes
+
+def _blockShape(meta, chunks, blockBytes):
+    """
+    Blocks which consist of whole chunks (and all channels), grown along
+    the spatial axes in turn for as long as they stay within blockBytes.
+    """
+    axiskeys = meta.getAxisKeys()
+    shape = list(meta.shape)
+    block = list(chunks)
+    if 'c' in axiskeys:
+        block[ axiskeys.index('c') ] = shape[ axiskeys.index('c') ]
+    pixelBytes = _pixelBytes(meta) / float( _channels(meta) )
+    spatial = [ axiskeys.index(k) for k in 'xyz' if k in axiskeys ]
+
+    grown = True
+    while grown:
+        grown = False
+        for i in spatial:
+            if block[i] >= shape[i]:
+                continue
+            larger = list(block)
+            larger[i] = min( shape[i], 2*block[i] )
+            if numpy.prod(larger) * pixelBytes > blockBytes:
+                continue
+            block = larger
+            grown = True
+    return tuple(block)
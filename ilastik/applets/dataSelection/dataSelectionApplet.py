@@ -217,52 +217,37 @@ class DataSelectionApplet( Applet ):
         Return the filePaths list with globstrings replaced by the paths to the new hdf5 volumes.
         """
         import hashlib
-        import pickle
         import h5py
-        from lazyflow.graph import Graph
-        from lazyflow.operators.ioOperators import OpStackToH5Writer
+        from ilastik.applets.base.appletSerializer import getOrCreateGroup
+        from stackImport import importStack
         
         filePaths = list(filePaths)
         for i, path in enumerate(filePaths):
             if '*' in path:
                 globstring = path
     
-                # Embrace paranoia:
-                # We want to make sure we never re-use a stale cache file for a new dataset,
-                #  even if the dataset is located in the same location as a previous one and has the same globstring!
-                # Create a sha-1 of the file name and modification date.
+                # Each stack location gets its own volume file.
+                # The file keeps a fingerprint of every slice, so that we never use stale data,
+                #  but only need to re-read the slices which have changed since the last conversion.
+                absGlobstring = '//'.join( os.path.abspath(p) for p in globstring.split('//') )
                 sha = hashlib.sha1()
-                files = [k.replace('\\', '/') for k in glob.glob( path )]
-                for f in files:
-                    sha.update(f)
-                    sha.update(pickle.dumps(os.stat(f).st_mtime))
+                sha.update( absGlobstring.replace('\\', '/') )
                 stackFile = sha.hexdigest() + '.h5'
                 stackPath = os.path.join( stackVolumeCacheDir, stackFile ).replace('\\', '/')
                 
                 # Overwrite original path
                 filePaths[i] = stackPath + "/volume/data"
     
-                # Generate the hdf5 if it doesn't already exist
-                if os.path.exists(stackPath):
-                    logger.info( "Using previously generated hdf5 volume for stack {}".format(path) )
-                    logger.info( "Volume path: {}".format(filePaths[i]) )
-                else:
-                    logger.info( "Generating hdf5 volume for stack {}".format(path) )
-                    logger.info( "Volume path: {}".format(filePaths[i]) )
-    
-                    if not os.path.exists( stackVolumeCacheDir ):
-                        os.makedirs( stackVolumeCacheDir )
-                    
-                    with h5py.File(stackPath) as f:
-                        # Configure the conversion operator
-                        opWriter = OpStackToH5Writer( graph=Graph() )
-                        opWriter.hdf5Group.setValue(f)
-                        opWriter.hdf5Path.setValue("volume/data")
-                        opWriter.GlobString.setValue(globstring)
-                        
-                        # Initiate the write
-                        success = opWriter.WriteImage.value
-                        assert success, "Something went wrong when generating an hdf5 file from an image sequence."
+                logger.info( "Generating (or updating) hdf5 volume for stack {}".format(path) )
+                logger.info( "Volume path: {}".format(filePaths[i]) )
+
+                if not os.path.exists( stackVolumeCacheDir ):
+                    os.makedirs( stackVolumeCacheDir )
+                
+                with h5py.File(stackPath, 'a') as f:
+                    importStack( globstring,
+                                 getOrCreateGroup(f, 'volume'), 'data',
+                                 indexGroup=getOrCreateGroup(f, 'slice_fingerprints') )
             
         return filePaths
 
@@ -20,7 +20,8 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 from opDataSelection import OpDataSelection, DatasetInfo
-from lazyflow.operators.ioOperators import OpStackToH5Writer, OpH5WriterBigDataset
+from internalStorage import writeInternalDataset
+from stackImport import importStack
 
 import os
 import vigra
@@ -93,19 +94,10 @@ class DataSelectionSerializer( AppletSerializer ):
                     # Obtain the data from the corresponding output and store it to the project.
                     dataSlot = self.topLevelOperator._NonTransposedImageGroup[laneIndex][roleIndex]
 
-                    try:    
-                        opWriter = OpH5WriterBigDataset(parent=self.topLevelOperator.parent, graph=self.topLevelOperator.graph)
-                        opWriter.CompressionEnabled.setValue(False) # Compression slows down browsing a lot, and raw data tends to be noisy and doesn't compress very well, anyway.
-                        opWriter.hdf5File.setValue( localDataGroup )
-                        opWriter.hdf5Path.setValue( info.datasetId )
-                        opWriter.Image.connect(dataSlot)
-        
-                        # Trigger the copy
-                        success = opWriter.WriteImage.value
-                        assert success
-                    finally:
-                        opWriter.cleanUp()
-    
+                    # The dataset is chunked for browsing and compressed with a fast codec.
+                    # (OpDataSelection caches the decompressed chunks.)
+                    writeInternalDataset( localDataGroup, info.datasetId, dataSlot, self.progressSignal )
+
                     # Add axistags and drange attributes, in case someone uses this dataset outside ilastik
                     localDataGroup[info.datasetId].attrs['axistags'] = dataSlot.meta.axistags.toJSON()
                     if dataSlot.meta.drange is not None:
@@ -202,18 +194,11 @@ class DataSelectionSerializer( AppletSerializer ):
             if '//' not in globstring and not os.path.isabs(globstring):
                 globstring = os.path.normpath( os.path.join(cwd, globstring) )
             
-            opWriter = OpStackToH5Writer(parent=self.topLevelOperator.parent, graph=self.topLevelOperator.graph)
-            opWriter.hdf5Group.setValue(localDataGroup)
-            opWriter.hdf5Path.setValue(info.datasetId)
-            opWriter.GlobString.setValue(globstring)
-                
-            # Forward progress from the writer directly to our applet                
-            opWriter.progressSignal.subscribe( self.progressSignal.emit )
-            
-            success = opWriter.WriteImage.value
+            # Forward progress from the import directly to our applet
+            importStack( globstring, localDataGroup, info.datasetId, progressSignal=self.progressSignal.emit )
+            success = True
             
         finally:
-            opWriter.cleanUp()
             self.progressSignal.emit(100)
 
         return success
@@ -0,0 +1,285 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Storage of datasets which are copied into the project file.
+
+The datasets are chunked so that the orthogonal slices shown by the viewer
+touch few chunks, and compressed with lzf (which every h5py build can read).
+With 'blosc_compression: true' in ~/.ilastikrc, the faster blosc codec is
+used instead, but the resulting files can only be opened where the hdf5plugin
+package is installed. For browsing, the decompressed chunks are kept in a
+small cache (see ``OpChunkCache``). The same cache serves image stacks slice
+by slice, straight from the files.
+"""
+import collections
+import threading
+from functools import partial
+
+import numpy
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.utility import BigRequestStreamer
+
+from ilastik.config import cfg as ilastik_config
+from ilastik.utility import log_exception
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _compression():
+    # lzf is always available with h5py
+    lzf = { 'compression' : 'lzf', 'shuffle' : True }
+    if not ilastik_config.getboolean('ilastik', 'blosc_compression'):
+        return lzf
+    try:
+        # Registers the blosc filter with hdf5
+        import hdf5plugin
+        return dict( hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE) )
+    except Exception:
+        # Not installed, or an incompatible version (or hdf5 library)
+        logger.warn( "Blosc compression is not available, using lzf instead.", exc_info=True )
+        return lzf
+
+#: The h5py.Group.create_dataset() arguments for compressing internal datasets
+COMPRESSION = _compression()
+
+#: Chunk edge length (along each spatial axis) for 3D and 2D data
+CHUNK_EDGE_3D = 64
+CHUNK_EDGE_2D = 256
+
+def chunkShape(axiskeys, shape):
+    """
+    Choose a chunk shape for the viewer's access pattern: the viewer shows
+    slices along each spatial axis, so the chunks are (roughly) isotropic in
+    space, and contain all channels of a single time step.
+    """
+    tagged = dict(zip(axiskeys, shape))
+    spatial = [k for k in 'xyz' if tagged.get(k, 1) > 1]
+    edge = CHUNK_EDGE_3D if len(spatial) == 3 else CHUNK_EDGE_2D
+
+    chunks = []
+    for key, size in zip(axiskeys, shape):
+        if key in 'xyz':
+            chunks.append( min(edge, size) )
+        elif key == 'c':
+            chunks.append( size )
+        else:
+            chunks.append( 1 )
+    return tuple(chunks)
+
+def writeInternalDataset(group, name, slot, progressSignal=None):
+    """
+    Copy the data of the given slot into a new dataset ``group[name]``.
+    The data is requested chunk by chunk, in parallel.
+    """
+    shape = slot.meta.shape
+    chunks = chunkShape( slot.meta.getAxisKeys(), shape )
+    dataset = group.create_dataset( name, shape=shape, dtype=slot.meta.dtype, chunks=chunks, **COMPRESSION )
+
+    lock = threading.Lock()
+    def writeBlock(roi, data):
+        with lock:
+            dataset[roiToSlice(*roi)] = data
+
+    streamer = BigRequestStreamer( slot, ((0,)*len(shape), shape), chunks )
+    streamer.resultSignal.subscribe( writeBlock )
+    if progressSignal is not None:
+        streamer.progressSignal.subscribe( progressSignal )
+    streamer.execute()
+    return dataset
+
+class OpChunkCache(Operator):
+    """
+    Keeps the most recently used chunks of the input in memory, so that
+    browsing a compressed dataset doesn't decompress the same chunks again
+    for every slice. The input is only requested chunk by chunk.
+
+    If ReadAhead is nonzero, that many layers of chunks (along the first
+    axis) following each request are fetched in the background, which suits
+    readers that go through the data slice by slice. Chunks which are still
+    being read ahead when the cache is cleared (or cleaned up) are cancelled.
+
+    If EvictConsumed is set, a chunk is dropped as soon as each of its pixels
+    has been read (at least once). That suits intermediate results which are
+    read (about) once by the next step of a pipeline.
+    """
+    Input = InputSlot()
+    ChunkShape = InputSlot()
+    MaxBytes = InputSlot(value=32*2**20)
+    ReadAhead = InputSlot(value=0)
+    EvictConsumed = InputSlot(value=False)
+
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpChunkCache, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        with self._lock:
+            pending = getattr(self, '_pending', {}).values()
+            self._chunks = collections.OrderedDict()
+            self._nbytes = 0
+            self._pending = {} # chunk start : read-ahead request
+            self._fetching = {} # chunk start : request which reads the chunk from the input
+            self._consumed = {}
+            # Chunks fetched before the last clear must not enter the cache
+            self._generation = getattr(self, '_generation', 0) + 1
+        # The chunks being read ahead aren't needed anymore
+        for request in pending:
+            request.cancel()
+
+    def cleanUp(self):
+        self._clear()
+        super(OpChunkCache, self).cleanUp()
+
+    def setupOutputs(self):
+        assert len(self.ChunkShape.value) == len(self.Input.meta.shape)
+        self.Output.meta.assignFrom(self.Input.meta)
+        self._clear()
+
+    def execute(self, slot, subindex, roi, result):
+        chunkShape = self.ChunkShape.value
+        pool = RequestPool()
+        for chunkStart in getIntersectingBlocks( chunkShape, (roi.start, roi.stop) ):
+            chunkRoi = getBlockBounds( self.Input.meta.shape, chunkShape, chunkStart )
+            pool.add( Request( partial(self._copyChunk, chunkRoi, roi, result) ) )
+        pool.wait()
+        pool.clean()
+        self._readAhead( roi )
+        return result
+
+    def _readAhead(self, roi):
+        """
+        Fetch the chunks which follow the roi along the first axis.
+        """
+        readAhead = self.ReadAhead.value
+        if readAhead == 0:
+            return
+        shape = self.Input.meta.shape
+        chunkShape = self.ChunkShape.value
+        lastLayer = (numpy.asarray(roi.stop) - 1)[0] // chunkShape[0] * chunkShape[0]
+        for chunkStart in getIntersectingBlocks( chunkShape, (roi.start, roi.stop) ):
+            if chunkStart[0] != lastLayer:
+                continue
+            for layer in range(1, readAhead+1):
+                start = numpy.array(chunkStart)
+                start[0] += layer * chunkShape[0]
+                if start[0] >= shape[0]:
+                    break
+                key = tuple(start)
+                chunkRoi = getBlockBounds( shape, chunkShape, start )
+                with self._lock:
+                    if key in self._chunks or key in self._pending:
+                        continue
+                    request = Request( partial(self._getChunk, chunkRoi) )
+                    self._pending[key] = request
+                request.notify_finished( partial(self._forgetReadAhead, key, request) )
+                request.notify_failed( partial(self._readAheadFailed, key, request) )
+                request.notify_cancelled( partial(self._forgetReadAhead, key, request) )
+                request.submit()
+
+    def _forgetReadAhead(self, key, request, *args):
+        with self._lock:
+            if self._pending.get(key) is request:
+                del self._pending[key]
+
+    def _readAheadFailed(self, key, request, exc, exc_info):
+        self._forgetReadAhead(key, request)
+        log_exception( logger, "Reading ahead chunk {} failed".format( key ), exc_info )
+
+    def _copyChunk(self, chunkRoi, roi, result):
+        data = self._getChunk( chunkRoi )
+        start, stop = getIntersection( chunkRoi, (roi.start, roi.stop) )
+        result[ roiToSlice( start - roi.start, stop - roi.start ) ] = \
+            data[ roiToSlice( start - chunkRoi[0], stop - chunkRoi[0] ) ]
+        if self.EvictConsumed.value:
+            self._consume( chunkRoi, start, stop )
+
+    def _consume(self, chunkRoi, start, stop):
+        """
+        Mark the region start:stop of the chunk as read, and drop the chunk
+        if all of it has been read. Pixels which are read more than once
+        (e.g. by overlapping requests) count only once.
+        """
+        key = tuple(chunkRoi[0])
+        with self._lock:
+            consumed = self._consumed.get(key)
+            if consumed is None:
+                consumed = numpy.zeros( tuple( numpy.subtract(chunkRoi[1], chunkRoi[0]) ), dtype=bool )
+                self._consumed[key] = consumed
+            consumed[ roiToSlice( start - chunkRoi[0], stop - chunkRoi[0] ) ] = True
+            if not consumed.all():
+                return
+            del self._consumed[key]
+            data = self._chunks.pop(key, None)
+            if data is not None:
+                self._nbytes -= data.nbytes
+
+    def _getChunk(self, chunkRoi):
+        key = tuple(chunkRoi[0])
+        with self._lock:
+            data = self._chunks.pop(key, None)
+            if data is not None:
+                # Most recently used chunks are last
+                self._chunks[key] = data
+                return data
+            # Concurrent misses on the same chunk wait for the same fetch
+            request = self._fetching.get(key)
+            if request is None:
+                request = Request( partial(self._fetchChunk, chunkRoi, self._generation) )
+                self._fetching[key] = request
+                request.notify_finished( partial(self._forgetFetch, key, request) )
+                request.notify_failed( partial(self._forgetFetch, key, request) )
+                request.notify_cancelled( partial(self._forgetFetch, key, request) )
+        return request.wait()
+
+    def _fetchChunk(self, chunkRoi, generation):
+        key = tuple(chunkRoi[0])
+        data = self.Input( *chunkRoi ).wait()
+
+        with self._lock:
+            if key not in self._chunks and generation == self._generation:
+                self._chunks[key] = data
+                self._nbytes += data.nbytes
+            maxBytes = self.MaxBytes.value
+            while self._nbytes > maxBytes and len(self._chunks) > 1:
+                evictedKey, evicted = self._chunks.popitem(last=False)
+                self._consumed.pop(evictedKey, None)
+                self._nbytes -= evicted.nbytes
+        return data
+
+    def _forgetFetch(self, key, request, *args):
+        with self._lock:
+            if self._fetching.get(key) is request:
+                del self._fetching[key]
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            self._clear()
+            self.Output.setDirty( roi.start, roi.stop )
+        elif slot == self.ChunkShape:
+            self._clear()
+            self.Output.setDirty( slice(None) )
+        # Changing MaxBytes, ReadAhead or EvictConsumed doesn't change the data
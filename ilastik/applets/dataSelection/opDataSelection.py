@@ -27,6 +27,7 @@ from lazyflow.utility.jsonConfig import RoiTuple
 from lazyflow.operators.ioOperators import OpStreamingHdf5Reader, OpInputDataReader
 from lazyflow.operators.valueProviders import OpMetadataInjector
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.dataSelection.internalStorage import OpChunkCache
 
 from ilastik.utility import OpMultiLaneWrapper
 from lazyflow.operators.opReorderAxes import OpReorderAxes
@@ -103,6 +104,11 @@ class OpDataSelection(Operator):
     
     SupportedExtensions = OpInputDataReader.SupportedExtensions
 
+    #: Memory for the decoded slices of an image stack, and the number of
+    #: slices which are decoded in advance when the stack is read along z.
+    StackCacheBytes = 128*2**20
+    StackReadAhead = 4
+
     # Inputs    
     ProjectFile = InputSlot(stype='object', optional=True) #: The project hdf5 File object (already opened)
     ProjectDataGroup = InputSlot(stype='string', optional=True) #: The internal path to the hdf5 group where project-local datasets are stored within the project file
@@ -166,6 +172,16 @@ class OpDataSelection(Operator):
                 opReader.InternalPath.setValue(internalPath)
                 providerSlot = opReader.OutputImage
                 self._opReaders.append(opReader)
+
+                # Don't decompress the same chunks over and over while browsing
+                # (h5py doesn't report filters like blosc as compression, so don't check that)
+                dataset = self.ProjectFile.value[internalPath]
+                if dataset.chunks is not None:
+                    opChunkCache = OpChunkCache(parent=self)
+                    opChunkCache.ChunkShape.setValue(dataset.chunks)
+                    opChunkCache.Input.connect(providerSlot)
+                    providerSlot = opChunkCache.Output
+                    self._opReaders.append(opChunkCache)
             else:
                 # Use a normal (filesystem) reader
                 opReader = OpInputDataReader(parent=self)
@@ -175,6 +191,17 @@ class OpDataSelection(Operator):
                 opReader.FilePath.setValue(datasetInfo.filePath)
                 providerSlot = opReader.Output
                 self._opReaders.append(opReader)
+
+                # Image stacks are read directly from the slice files.
+                # Keep the decoded slices, so each file is only decoded once.
+                if '*' in datasetInfo.filePath and providerSlot.meta.getAxisKeys()[0] == 'z':
+                    opChunkCache = OpChunkCache(parent=self)
+                    opChunkCache.ChunkShape.setValue( (1,) + tuple(providerSlot.meta.shape[1:]) )
+                    opChunkCache.MaxBytes.setValue( self.StackCacheBytes )
+                    opChunkCache.ReadAhead.setValue( self.StackReadAhead )
+                    opChunkCache.Input.connect(providerSlot)
+                    providerSlot = opChunkCache.Output
+                    self._opReaders.append(opChunkCache)
             
             # Inject metadata if the dataset info specified any.
             # Also, inject if if dtype is uint8, which we can reasonably assume has drange (0,255)
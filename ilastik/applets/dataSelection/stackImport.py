@@ -0,0 +1,152 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Import of image stacks (given as globstrings) into hdf5 datasets.
+
+The slices are decoded in parallel and written in batches which are aligned
+to the dataset's chunks. Optionally, a fingerprint (path, size and
+modification time) of every slice file is stored next to the data, so that
+importing the same stack again only re-reads the slices which have changed.
+"""
+import os
+import glob
+import json
+import threading
+from functools import partial
+
+import numpy
+
+from lazyflow.graph import Graph
+from lazyflow.request import Request, RequestPool
+from lazyflow.operators.ioOperators import OpStackLoader
+
+from ilastik.applets.base.appletSerializer import deleteIfPresent
+from internalStorage import COMPRESSION, chunkShape
+
+import logging
+logger = logging.getLogger(__name__)
+
+#: Upper bound for the data read by a single batch
+MAX_BATCH_BYTES = 256 * 2**20
+
+def stackFiles(globstring):
+    """
+    The files of a stack, in the order in which OpStackLoader reads them.
+    Several globstrings may be given, separated by '//'.
+    """
+    files = []
+    for part in sorted(globstring.split('//')):
+        files += sorted(glob.glob(part))
+    return files
+
+def sliceFingerprint(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path).replace('\\', '/'), stat.st_size, stat.st_mtime]
+
+def importStack(globstring, group, name, indexGroup=None, progressSignal=None):
+    """
+    Import the stack into ``group[name]``, or update it if it is there already.
+
+    :param indexGroup: If given, the slice fingerprints are stored in
+        ``indexGroup[name]``, and only the slices whose fingerprint changed
+        since the last import are read again.
+    :param progressSignal: Called with the progress percentage.
+    :returns: The dataset
+    """
+    files = stackFiles(globstring)
+    fingerprints = map(sliceFingerprint, files)
+
+    opLoader = OpStackLoader( graph=Graph() )
+    try:
+        opLoader.globstring.setValue( globstring )
+        stack = opLoader.stack
+        shape = stack.meta.shape
+        dtype = numpy.dtype(stack.meta.dtype)
+
+        oldFingerprints = None
+        if indexGroup is not None and name in indexGroup:
+            oldFingerprints = json.loads( indexGroup[name][()] )
+            # Invalidate the index until the data is consistent with it again
+            del indexGroup[name]
+
+        dataset = group.get(name)
+        if ( dataset is None or oldFingerprints is None
+             or dataset.shape != shape or dataset.dtype != dtype
+             or len(oldFingerprints) != len(fingerprints) ):
+            deleteIfPresent( group, name )
+            dataset = group.create_dataset( name, shape=shape, dtype=dtype,
+                                            chunks=chunkShape( stack.meta.getAxisKeys(), shape ),
+                                            **COMPRESSION )
+            changed = range(shape[0])
+        elif len(files) == shape[0]:
+            changed = [z for z, (old, new) in enumerate(zip(oldFingerprints, fingerprints)) if old != new]
+        elif oldFingerprints != fingerprints:
+            # Several slices per file: we can't tell which slices have changed
+            changed = range(shape[0])
+        else:
+            changed = []
+
+        logger.info( "Importing {} of {} slices of stack {}".format( len(changed), shape[0], globstring ) )
+        _writeSlices( stack, dataset, changed, progressSignal )
+        dataset.attrs['axistags'] = stack.meta.axistags.toJSON()
+    finally:
+        opLoader.cleanUp()
+
+    if indexGroup is not None:
+        indexGroup.create_dataset( name, data=json.dumps(fingerprints) )
+    return dataset
+
+def _writeSlices(stack, dataset, slices, progressSignal=None):
+    """
+    Copy the given slices (along the first axis) from the stack to the
+    dataset. Each batch covers at most one layer of chunks.
+    """
+    sliceBytes = numpy.prod( dataset.shape[1:] ) * dataset.dtype.itemsize
+    depth = max( 1, min( dataset.chunks[0], MAX_BATCH_BYTES // sliceBytes ) )
+
+    batches = {}
+    for z in slices:
+        batches.setdefault( z // depth, [] ).append( z )
+
+    lock = threading.Lock()
+    progress = [0]
+    def copyBatch(batch):
+        # Read each run of consecutive slices at once
+        runs = []
+        for z in sorted(batch):
+            if runs and runs[-1][1] == z:
+                runs[-1][1] = z+1
+            else:
+                runs.append( [z, z+1] )
+        for start, stop in runs:
+            data = stack( (start,) + (0,)*(len(dataset.shape)-1), (stop,) + dataset.shape[1:] ).wait()
+            with lock:
+                dataset[start:stop] = data
+        with lock:
+            progress[0] += 1
+            if progressSignal is not None:
+                progressSignal( 100 * progress[0] // len(batches) )
+
+    pool = RequestPool()
+    for batch in batches.values():
+        pool.add( Request( partial(copyBatch, batch) ) )
+    pool.wait()
+    pool.clean()
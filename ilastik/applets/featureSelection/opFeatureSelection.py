@@ -19,22 +19,18 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 #Python
-import os
 import logging
 
-#SciPy
-import numpy
-import h5py
-
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import roiToSlice
-from lazyflow.operators import OpSlicedBlockedArrayCache, OpMultiArraySlicer2
+from lazyflow.operators import OpMultiArraySlicer2
 from lazyflow.operators import OpPixelFeaturesPresmoothed as OpPixelFeaturesPresmoothed_Original
 from lazyflow.operators import OpPixelFeaturesInterpPresmoothed as OpPixelFeaturesPresmoothed_Interpolated
 from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as OpPixelFeaturesPresmoothed_Refactored
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.cacheGeometry import OpAdaptiveSlicedBlockedArrayCache
+from opPrecomputedFeatures import OpPrecomputedFeatures
 
 logger = logging.getLogger(__name__)
 
@@ -93,39 +89,15 @@ class OpFeatureSelectionNoCache(Operator):
         #  check it for errors (See setupOutputs)
         # self.opPixelFeatures.SelectionMatrix.connect( self.SelectionMatrix )
 
+        # Features which were computed outside of ilastik (see FeatureListFilename)
+        self.opPrecomputedFeatures = OpPrecomputedFeatures(parent=self)
+        self.opPrecomputedFeatures.InputImage.connect( self.InputImage )
+
     def setupOutputs(self):
         if self.FeatureListFilename.ready() and len(self.FeatureListFilename.value) > 0:
-            f = open(self.FeatureListFilename.value, 'r')
-            self._files = []
-            for line in f:
-                line = line.strip()
-                if len(line) > 0:
-                    self._files.append(line)
-            f.close()
-            
-            self.OutputImage.disconnect()
-            self.FeatureLayers.disconnect()
-            
-            axistags = self.inputs["InputImage"].meta.axistags
-            
-            self.FeatureLayers.resize(len(self._files))
-            for i in range(len(self._files)):
-                f = h5py.File(self._files[i], 'r')
-                shape = f["data"].shape
-                assert len(shape) == 3
-                dtype = f["data"].dtype.type
-                f.close()
-                self.FeatureLayers[i].meta.shape    = shape+(1,)
-                self.FeatureLayers[i].meta.dtype    = dtype
-                self.FeatureLayers[i].meta.axistags = axistags 
-                self.FeatureLayers[i].meta.description = os.path.basename(self._files[i]) 
-            
-            self.OutputImage.meta.shape    = (shape) + (len(self._files),)
-            self.OutputImage.meta.dtype    = dtype 
-            self.OutputImage.meta.axistags = axistags 
-            
-            self.CachedOutputImage.meta.shape    = (shape) + (len(self._files),)
-            self.CachedOutputImage.meta.axistags = axistags 
+            self.opPrecomputedFeatures.FeatureListFilename.setValue( self.FeatureListFilename.value )
+            self.OutputImage.connect( self.opPrecomputedFeatures.Output )
+            self.FeatureLayers.connect( self.opPrecomputedFeatures.Features )
         else:
             # Set the new selection matrix and check if it creates an error.
             selections = self.SelectionMatrix.value
@@ -141,39 +113,14 @@ class OpFeatureSelectionNoCache(Operator):
             self.OutputImage.connect( self.opPixelFeatures.Output )
             self.FeatureLayers.connect( self.opPixelFeatures.Features )
 
+            # Close the files of the precomputed features which were used before (if any)
+            if self.opPrecomputedFeatures.FeatureListFilename.ready():
+                self.opPrecomputedFeatures.FeatureListFilename.disconnect()
+                self.opPrecomputedFeatures.closeFiles()
+
     def propagateDirty(self, slot, subindex, roi):
         # Output slots are directly connected to internal operators
         pass
-    
-    def execute(self, slot, subindex, rroi, result):
-        if len(self.FeatureListFilename.value) == 0:
-            return
-       
-        assert result.dtype == numpy.float32
-        
-        key = roiToSlice(rroi.start, rroi.stop)
-            
-        if slot == self.FeatureLayers:
-            index = subindex[0]
-            f = h5py.File(self._files[index], 'r')
-            result[...,0] = f["data"][key[0:3]]
-            return result
-        elif slot == self.OutputImage or slot == self.CachedOutputImage:
-            assert result.ndim == 4
-            assert result.shape[-1] == len(self._files), "result.shape = %r" % result.shape 
-            assert rroi.start == 0, "rroi = %r" % (rroi,)
-            assert rroi.stop  == len(self._files), "rroi = %r" % (rroi,)
-            
-            j = 0
-            for i in range(key[3].start, key[3].stop):
-                f = h5py.File(self._files[i], 'r')
-                r = f["data"][key[0:3]]
-                assert r.dtype == numpy.float32
-                assert r.ndim == 3
-                f.close()
-                result[:,:,:,j] = r 
-                j += 1
-            return result  
 
 class OpFeatureSelection( OpFeatureSelectionNoCache ):
     """
@@ -186,8 +133,8 @@ class OpFeatureSelection( OpFeatureSelectionNoCache ):
     def __init__(self, *args, **kwargs):
         super( OpFeatureSelection, self).__init__( *args, **kwargs )
 
-        # Create the cache
-        self.opPixelFeatureCache = OpSlicedBlockedArrayCache(parent=self)
+        # Create the cache (it chooses its own block shapes)
+        self.opPixelFeatureCache = OpAdaptiveSlicedBlockedArrayCache(parent=self)
         self.opPixelFeatureCache.name = "opPixelFeatureCache"
 
         # Connect the cache to the feature output
@@ -201,41 +148,7 @@ class OpFeatureSelection( OpFeatureSelectionNoCache ):
         super( OpFeatureSelection, self ).setupOutputs()
 
         if self.FeatureListFilename.ready() and len(self.FeatureListFilename.value) > 0:
-            self.CachedOutputImage.disconnect()            
-            self.CachedOutputImage.meta.assignFrom(self.OutputImage.meta)
-        
+            # The precomputed features are cached by their own operator
+            self.CachedOutputImage.connect( self.opPrecomputedFeatures.Output )
         else:
-            # We choose block shapes that have only 1 channel because the channels may be 
-            #  coming from different features (e.g different filters) and probably shouldn't be cached together.
-            blockDimsX = { 't' : (1,1),
-                           'z' : (128,256),
-                           'y' : (128,256),
-                           'x' : (32,32),
-                           'c' : (1000,1000) } # Overestimate number of feature channels: Cache block dimensions will be clipped to the size of the actual feature image
-    
-            blockDimsY = { 't' : (1,1),
-                           'z' : (128,256),
-                           'y' : (32,32),
-                           'x' : (128,256),
-                           'c' : (1000,1000) }
-    
-            blockDimsZ = { 't' : (1,1),
-                           'z' : (32,32),
-                           'y' : (128,256),
-                           'x' : (128,256),
-                           'c' : (1000,1000) }
-            
-            axisOrder = [ tag.key for tag in self.InputImage.meta.axistags ]
-            innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-            outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-    
-            innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-            outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-    
-            innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-            outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-    
-            # Configure the cache        
-            self.opPixelFeatureCache.innerBlockShape.setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            self.opPixelFeatureCache.outerBlockShape.setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-
+            self.CachedOutputImage.connect( self.opPixelFeatureCache.Output )
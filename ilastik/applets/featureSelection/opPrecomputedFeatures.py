@@ -0,0 +1,208 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+from functools import partial
+
+import numpy
+import h5py
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.roi import roiToSlice
+
+from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.dataSelection.internalStorage import OpChunkCache, chunkShape
+
+import logging
+logger = logging.getLogger(__name__)
+
+class OpPrecomputedFeatures(Operator):
+    """
+    Provides features which were computed outside of ilastik.
+
+    FeatureListFilename names a text file which lists one hdf5 file per line.
+    The features are stored in the 'data' dataset of each file, either with
+    the same axes as the input image (the channels are the features), or
+    with the input's axes except for the channel axis (a single feature).
+
+    The files stay open as long as the operator is configured, and each file
+    is read through a cache whose blocks match the chunks of its dataset.
+    """
+    InputImage = InputSlot() # Only used for its shape and axistags
+    FeatureListFilename = InputSlot(stype='filestring')
+    MaxCacheBytes = InputSlot(value=256*2**20) # Shared by all files
+
+    Output = OutputSlot() # All features, concatenated along the channel axis
+    Features = OutputSlot(level=1) # One slot per file
+
+    #: The name of the dataset within each file
+    DatasetName = 'data'
+
+    def __init__(self, *args, **kwargs):
+        super(OpPrecomputedFeatures, self).__init__(*args, **kwargs)
+        self._files = []
+        self._opReaders = []
+        self._opCaches = []
+
+    def setupOutputs(self):
+        self.Features.resize(0)
+        self._closeFiles()
+
+        inputShape = self.InputImage.meta.shape
+        axistags = self.InputImage.meta.axistags
+        if axistags.channelIndex != len(inputShape)-1:
+            raise DatasetConstraintError( "Feature Selection",
+                                          "Precomputed features require an input image with the channel axis last." )
+
+        listFilename = self.FeatureListFilename.value
+        with open(listFilename, 'r') as f:
+            paths = filter( None, (line.strip() for line in f) )
+
+        self.Features.resize( len(paths) )
+        for path, featureSlot in zip(paths, self.Features):
+            hdf5File = h5py.File(path, 'r')
+            self._files.append( hdf5File )
+            if self.DatasetName not in hdf5File:
+                raise DatasetConstraintError( "Feature Selection",
+                                              "Feature file {} has no '{}' dataset.".format( path, self.DatasetName ) )
+            dataset = hdf5File[self.DatasetName]
+            if dataset.shape[:len(inputShape)-1] != inputShape[:-1] \
+               or len(dataset.shape) not in (len(inputShape)-1, len(inputShape)):
+                raise DatasetConstraintError( "Feature Selection",
+                                              "The features in {} (shape {}) don't match the input image (shape {})."
+                                              .format( path, dataset.shape, inputShape ) )
+
+            opReader = _OpFeatureDataset( parent=self )
+            opReader.AxisTags.setValue( axistags, check_changed=False )
+            opReader.Dataset.setValue( dataset, check_changed=False )
+            opReader.Description.setValue( os.path.basename(path) )
+
+            opCache = OpChunkCache( parent=self )
+            opCache.ChunkShape.setValue( opReader.blockShape() )
+            opCache.MaxBytes.setValue( self.MaxCacheBytes.value // len(paths) )
+            opCache.Input.connect( opReader.Output )
+            featureSlot.connect( opCache.Output )
+
+            self._opReaders.append( opReader )
+            self._opCaches.append( opCache )
+
+        channels = [ slot.meta.shape[-1] for slot in self.Features ]
+        self._channelOffsets = numpy.cumsum( [0] + channels )
+
+        self.Output.meta.assignFrom( self.InputImage.meta )
+        self.Output.meta.shape = inputShape[:-1] + (sum(channels),)
+        if len(paths) > 0:
+            self.Output.meta.dtype = numpy.result_type( *[slot.meta.dtype for slot in self.Features] ).type
+        self.Output.meta.drange = None
+        self.Output.meta.display_mode = None
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output
+        # Read the channels of all files which intersect the roi concurrently
+        pool = RequestPool()
+        for index, featureSlot in enumerate(self.Features):
+            start = max( roi.start[-1], self._channelOffsets[index] )
+            stop = min( roi.stop[-1], self._channelOffsets[index+1] )
+            if start < stop:
+                pool.add( Request( partial(self._readChannels, index, roi, start, stop, result) ) )
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _readChannels(self, index, roi, start, stop, result):
+        offset = self._channelOffsets[index]
+        featureStart = tuple(roi.start[:-1]) + (start - offset,)
+        featureStop = tuple(roi.stop[:-1]) + (stop - offset,)
+        data = self.Features[index]( featureStart, featureStop ).wait()
+        result[..., start-roi.start[-1]:stop-roi.start[-1]] = data
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.InputImage:
+            # The features don't depend on the image data, only on its shape
+            pass
+        else:
+            self.Output.setDirty( slice(None) )
+
+    def _closeFiles(self):
+        for op in self._opCaches + self._opReaders:
+            op.cleanUp()
+        self._opReaders = []
+        self._opCaches = []
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def closeFiles(self):
+        """
+        Release the feature files, e.g. when they aren't used anymore.
+        The operator reopens them when it is set up again.
+        """
+        self.Features.resize(0)
+        self._closeFiles()
+
+    def cleanUp(self):
+        self.closeFiles()
+        super(OpPrecomputedFeatures, self).cleanUp()
+
+class _OpFeatureDataset(Operator):
+    """
+    Reads a feature dataset from an open hdf5 file, adding a singleton
+    channel axis if the dataset has none.
+    """
+    Dataset = InputSlot(stype='object')
+    AxisTags = InputSlot(stype='object')
+    Description = InputSlot(stype='string')
+
+    Output = OutputSlot()
+
+    def setupOutputs(self):
+        dataset = self.Dataset.value
+        axistags = self.AxisTags.value
+        self._hasChannels = ( len(dataset.shape) == len(axistags) )
+        shape = dataset.shape
+        if not self._hasChannels:
+            shape += (1,)
+
+        self.Output.meta.shape = shape
+        self.Output.meta.dtype = dataset.dtype.type
+        self.Output.meta.axistags = axistags
+        self.Output.meta.description = self.Description.value
+
+    def blockShape(self):
+        """
+        Blocks which contain whole chunks of the dataset (and all of its channels).
+        """
+        dataset = self.Dataset.value
+        shape = self.Output.meta.shape
+        if dataset.chunks is None:
+            return chunkShape( self.Output.meta.getAxisKeys(), shape )
+        return dataset.chunks[:len(shape)-1] + (shape[-1],)
+
+    def execute(self, slot, subindex, roi, result):
+        dataset = self.Dataset.value
+        if self._hasChannels:
+            result[...] = dataset[ roiToSlice(roi.start, roi.stop) ]
+        else:
+            result[...,0] = dataset[ roiToSlice(roi.start[:-1], roi.stop[:-1]) ]
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty( slice(None) )
@@ -24,6 +24,7 @@ import vigra
 import time
 import warnings
 import itertools
+import threading
 from collections import defaultdict
 from functools import partial
 
@@ -799,6 +800,12 @@ class OpObjectPredict(Operator):
     Performs prediction on all objects in a time slice at once, and
     caches the result.
 
+    Each time slice is cached separately and guarded by its own lock,
+    so requests for different time slices are predicted in parallel.
+    The feature matrices are cached separately from the predictions:
+    a new classifier only requires re-running the forest, and dirty
+    features only invalidate the affected time slices.
+
     """
     # WARNING: right now we predict and cache a whole time slice. We
     # expect this to be fast because there are relatively few objects
@@ -822,6 +829,24 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        self._resetCaches()
+
+    def _resetCaches(self):
+        # protects the dicts below, but is never held during computation
+        self._lock = threading.Lock()
+        # one lock per time slice, held while it is predicted
+        self._timestep_locks = defaultdict(RequestLock)
+        # t -> probabilities
+        self.prob_cache = dict()
+        # t -> (feature matrix, bad objects)
+        self._feature_cache = dict()
+        # Incremented whenever cached predictions become invalid, so that
+        # a prediction which was in flight at the time isn't cached.
+        self._generation = 0
+        self._timestep_generation = defaultdict(int)
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -848,9 +873,7 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
+        self._resetCaches()
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -865,96 +888,148 @@ class OpObjectPredict(Operator):
             times = range(self.Predictions.meta.shape[0])
 
         if slot is self.CachedProbabilities:
-            return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            prob_cache = self.prob_cache
+            return {t: prob_cache[t] for t in times if t in prob_cache}
 
         classifier = self.Classifier.value
         if classifier is None:
             # this happens if there was no data to train with
             return dict((t, numpy.array([])) for t in times)
 
-        feats = {}
-        prob_predictions = {}
+        if slot is self.BadObjects:
+            return { t : self._getFeatureMatrix(t)[1] for t in times }
 
-        selected = self.SelectedFeatures([]).wait()
+        # predict the time slices in parallel
+        probs = {}
+        def predict_timestep(_t):
+            probs[_t] = self._predictTimestep(_t, classifier)
 
-        # FIXME: self.prob_cache is shared, so we need to block.
-        # However, this makes prediction single-threaded.
-        with self.lock:
-            for t in times:
-                if t in self.prob_cache:
-                    continue
+        pool = RequestPool()
+        for t in times:
+            req = Request( partial(predict_timestep, t) )
+            pool.add(req)
+
+        pool.wait()
+        pool.clean()
 
-                tmpfeats = self.Features([t]).wait()
-                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
-                rows, cols = replace_missing(ftmatrix)
-                self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-                self.bad_objects[t][rows] = 1
-                feats[t] = ftmatrix
-                prob_predictions[t] = 0
-
-            def predict_forest(_t):
-                # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
-                #        and we have to average the PROBABILITIES from all forests.
-                #       Averaging the label predictions from each forest is NOT equivalent.
-                #       For details please see wikipedia:
-                #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
-                #       (^-^)
-                prob_predictions[_t] = classifier.predict_probabilities(feats[_t].astype(numpy.float32))
-
-            # predict the data with all the forests in parallel
-            pool = RequestPool()
+        if slot == self.Probabilities:
+            return probs
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
             for t in times:
-                if t in self.prob_cache:
-                    continue
-                req = Request( partial(predict_forest, t) )
-                pool.add(req)
+                labels[t] = 1 + numpy.argmax(probs[t], axis=1)
+                labels[t][0] = 0 # Background gets the zero label
 
-            pool.wait()
-            pool.clean()
+            return labels
 
-            for t in times:
-                if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-arrays, indexed as follows:
-                    # prob_predictions[t][object_index, class_index]
-                    self.prob_cache[t] = prob_predictions[t]
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: probs[t][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((probs[t].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
 
-            elif slot == self.ProbabilityChannels:
-                try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
+        else:
+            assert False, "Unknown input slot"
 
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
+    def _getFeatureMatrix(self, t):
+        """Returns (feature matrix, bad objects) for time slice t."""
+        with self._lock:
+            cached = self._feature_cache.get(t)
+            generation = self._timestep_generation[t]
+        if cached is not None:
+            return cached
 
-            else:
-                assert False, "Unknown input slot"
+        selected = self.SelectedFeatures([]).wait()
+        tmpfeats = self.Features([t]).wait()
+        ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
+        rows, cols = replace_missing(ftmatrix)
+        bad_objects = numpy.zeros((ftmatrix.shape[0],))
+        bad_objects[rows] = 1
+
+        with self._lock:
+            if self._timestep_generation[t] == generation:
+                self._feature_cache[t] = (ftmatrix, bad_objects)
+        return ftmatrix, bad_objects
+
+    def _predictTimestep(self, t, classifier):
+        """Returns the probabilities for time slice t, from the
+        cache if possible."""
+        with self._lock:
+            timestep_lock = self._timestep_locks[t]
+
+        # Only one request predicts a given time slice; the others wait for it.
+        with timestep_lock:
+            with self._lock:
+                probs = self.prob_cache.get(t)
+                generation = (self._generation, self._timestep_generation[t])
+            if probs is not None:
+                return probs
+
+            ftmatrix, _ = self._getFeatureMatrix(t)
+
+            # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
+            #        and we have to average the PROBABILITIES from all forests.
+            #       Averaging the label predictions from each forest is NOT equivalent.
+            #       For details please see wikipedia:
+            #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
+            #       (^-^)
+            # prob_predictions is a dict-of-arrays, indexed as follows:
+            # prob_predictions[t][object_index, class_index]
+            probs = classifier.predict_probabilities(ftmatrix.astype(numpy.float32))
+            probs[0] = 0 # Background probability is always zero
+
+            with self._lock:
+                # don't cache the result if it became stale while we were computing
+                if (self._generation, self._timestep_generation[t]) == generation:
+                    self.prob_cache[t] = probs
+            return probs
+
+    def _invalidateTimesteps(self, times):
+        with self._lock:
+            for t in times:
+                self._timestep_generation[t] += 1
+                self.prob_cache.pop(t, None)
+                self._feature_cache.pop(t, None)
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
+        if slot is self.Features and len(roi._l) > 0:
+            # Only the given time slices (or (time, object) pairs) changed.
+            if isinstance(roi._l[0], int):
+                times = list(roi._l)
+            else:
+                times = list(set(t for t, _ in roi._l))
+            self._invalidateTimesteps(times)
+            for oslot in [self.Predictions, self.Probabilities, self.BadObjects]:
+                oslot.setDirty(List(oslot, roi._l))
+            for oslot in self.ProbabilityChannels:
+                oslot.setDirty(List(oslot, roi._l))
+            return
+
+        prob_cache = {}
         if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
+            prob_cache = self.InputProbabilities([]).wait()
+
+        with self._lock:
+            # all predictions are invalid
+            self._generation += 1
+            self.prob_cache = prob_cache
+
+            if slot is self.Features or slot is self.SelectedFeatures:
+                # feature matrices are invalid, too
+                self._feature_cache = {}
+                for t in self._timestep_generation.keys():
+                    self._timestep_generation[t] += 1
+
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.ProbabilityChannels.setDirty(())
+        if slot is self.Features or slot is self.SelectedFeatures or slot is self.Classifier:
+            self.BadObjects.setDirty(())
 
     def createExportTable(self, roi):
         if not self.Predictions.ready() or not self.Features.ready():
@@ -21,7 +21,9 @@
 #Python
 from copy import copy
 import collections
+import threading
 from collections import defaultdict
+from functools import partial
 
 #SciPy
 import numpy as np
@@ -31,7 +33,8 @@ import vigra.analysis
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
-from lazyflow.roi import roiToSlice, sliceToRoi
+from lazyflow.roi import roiToSlice, sliceToRoi, roiFromShape, getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool
 from lazyflow.operators import OpCachedLabelImage, OpMultiArraySlicer2, OpMultiArrayStacker, OpArrayCache, OpCompressedCache
 
 import logging
@@ -44,6 +47,7 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.regionStatistics import RegionStatistics, summarize_block, STREAMABLE_FEATURES
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -57,6 +61,10 @@ default_features = {'Coord<Minimum>':{}, 'Coord<Maximum>':{}, 'RegionCenter': {}
 # to distinguish them, they go in their own category with this name
 default_features_key = 'Default features'
 
+# local features are computed in batches of this many objects,
+# each batch in its own request
+LOCAL_FEATURES_BATCH_SIZE = 100
+
 def max_margin(d, default=(0, 0, 0)):
     """find any parameter named 'margin' in the nested feature
     dictionary 'd' and return the max.
@@ -125,6 +133,12 @@ class OpRegionFeatures3d(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * StreamingBlockShape (optional) : a dict of spatial block dims,
+      e.g. {'x' : 256, 'y' : 256, 'z' : 256}. If given, and all
+      requested features can be accumulated blockwise (see
+      regionStatistics.STREAMABLE_FEATURES), the volume is processed
+      block by block instead of being read as a whole.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -134,6 +148,7 @@ class OpRegionFeatures3d(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    StreamingBlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
 
@@ -171,24 +186,29 @@ class OpRegionFeatures3d(Operator):
         assert slot == self.Output
         import time
         start = time.time()
-        # Process ENTIRE volume
-        rawVolume = self.RawVolume[:].wait()
-        labelVolume = self.LabelVolume[:].wait()
+        assert np.prod(roi.stop - roi.start) == 1
 
-        # Convert to 4D (preserve axis order)
-        axes4d = self.RawVolume.meta.getTaggedShape().keys()
-        axes4d = filter(lambda k: k in 'xyzc', axes4d)
+        feature_names = self.Features([]).wait()
+        if self.StreamingBlockShape.ready() and self._can_stream(feature_names):
+            acc = self._extract_blockwise(feature_names, self.StreamingBlockShape.value)
+        else:
+            # Process ENTIRE volume
+            rawVolume = self.RawVolume[:].wait()
+            labelVolume = self.LabelVolume[:].wait()
 
-        rawVolume = rawVolume.view(vigra.VigraArray)
-        rawVolume.axistags = self.RawVolume.meta.axistags
-        rawVolume4d = rawVolume.withAxes(*axes4d)
+            # Convert to 4D (preserve axis order)
+            axes4d = self.RawVolume.meta.getTaggedShape().keys()
+            axes4d = filter(lambda k: k in 'xyzc', axes4d)
 
-        labelVolume = labelVolume.view(vigra.VigraArray)
-        labelVolume.axistags = self.LabelVolume.meta.axistags
-        labelVolume4d = labelVolume.withAxes(*axes4d)
+            rawVolume = rawVolume.view(vigra.VigraArray)
+            rawVolume.axistags = self.RawVolume.meta.axistags
+            rawVolume4d = rawVolume.withAxes(*axes4d)
 
-        assert np.prod(roi.stop - roi.start) == 1
-        acc = self._extract(rawVolume4d, labelVolume4d)
+            labelVolume = labelVolume.view(vigra.VigraArray)
+            labelVolume.axistags = self.LabelVolume.meta.axistags
+            labelVolume4d = labelVolume.withAxes(*axes4d)
+
+            acc = self._extract(rawVolume4d, labelVolume4d)
         result[tuple(roi.start)] = acc
         stop = time.time()
         logger.debug("TIMING: computing features took {:.3f}s".format(stop-start))
@@ -226,6 +246,73 @@ class OpRegionFeatures3d(Operator):
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
+    @staticmethod
+    def _can_stream(feature_names):
+        """Only the vigra plugin's global features can be accumulated
+        blockwise, and only if no neighborhood features are requested."""
+        if set(feature_names.keys()) - set(["Standard Object Features"]):
+            return False
+        if np.any(max_margin(feature_names)):
+            return False
+        for feature_dict in feature_names.itervalues():
+            if set(feature_dict.keys()) - STREAMABLE_FEATURES:
+                return False
+        return True
+
+    def _extract_blockwise(self, feature_names, block_shape_dict):
+        """Compute the features by accumulating region statistics over
+        blocks of the volume, so that neither the raw data nor the
+        labels are ever read as a whole."""
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        axiskeys = taggedShape.keys()
+        shape = self.RawVolume.meta.shape
+
+        # like the vigra plugin, single slices are treated as 2D
+        spatial_axes = filter(lambda k: k in 'xyz', axiskeys)
+        if taggedShape['z'] == 1:
+            spatial_axes.remove('z')
+        nchannels = taggedShape['c']
+
+        block_shape = [block_shape_dict.get(k, shape[i]) if k in 'xyz' else shape[i]
+                       for i, k in enumerate(axiskeys)]
+        block_shape = np.minimum(block_shape, shape)
+        block_starts = getIntersectingBlocks(block_shape, roiFromShape(shape))
+
+        stats = RegionStatistics(nchannels, len(spatial_axes))
+        stats_lock = threading.Lock()
+
+        def process_block(block_start):
+            block_roi = getBlockBounds(shape, block_shape, block_start)
+
+            rawBlock = self.RawVolume(*block_roi).wait()
+            rawBlock = rawBlock.view(vigra.VigraArray)
+            rawBlock.axistags = self.RawVolume.meta.axistags
+            rawBlock = rawBlock.withAxes(*(spatial_axes + ['c']))
+
+            labelBlock = self.LabelVolume(*block_roi).wait()
+            labelBlock = labelBlock.view(vigra.VigraArray)
+            labelBlock.axistags = self.LabelVolume.meta.axistags
+            labelBlock = labelBlock.withAxes(*spatial_axes)
+
+            offset = [block_roi[0][axiskeys.index(k)] for k in spatial_axes]
+            summary = summarize_block(np.asarray(rawBlock), np.asarray(labelBlock), offset)
+            with stats_lock:
+                stats.add_summary(summary)
+
+        logger.debug("computing region statistics in {} blocks".format(len(block_starts)))
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add(Request(partial(process_block, block_start)))
+        pool.wait()
+        pool.clean()
+
+        selected = feature_names.get("Standard Object Features", {}).keys()
+        all_features = {}
+        if selected:
+            all_features["Standard Object Features"] = stats.features(selected)
+        all_features[default_features_key] = stats.features(default_features.keys())
+        return self._add_background_object(all_features, max(stats.nlabels - 1, 0))
+
     def _extract(self, image, labels):
         if not (image.ndim == labels.ndim == 4):
             raise Exception("both images must be 4D. raw image shape: {}"
@@ -292,13 +379,6 @@ class OpRegionFeatures3d(Operator):
         maxcoords = extrafeats["Coord<Maximum>"]
         nobj = mincoords.shape[0]
         
-        # local features: loop over all objects
-        def dictextend(a, b):
-            for key in b:
-                a[key].append(b[key])
-            return a
-        
-
         local_features = defaultdict(lambda: defaultdict(list))
         margin = max_margin(feature_names)
         has_local_features = {}
@@ -308,22 +388,43 @@ class OpRegionFeatures3d(Operator):
                 if 'margin' in features:
                     has_local_features[plugin_name] = True
                     break
-            
-                            
+
         if np.any(margin) > 0:
+            # local features: split the objects into batches and
+            # compute the batches in parallel.
             #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
+            batches = [range(start, min(start + LOCAL_FEATURES_BATCH_SIZE, nobj))
+                       for start in range(0, nobj, LOCAL_FEATURES_BATCH_SIZE)]
+            batch_results = [None] * len(batches)
+
+            def compute_batch(batch_index):
+                rawbboxes = []
+                binary_bboxes = []
+                for i in batches[batch_index]:
+                    extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
+                    rawbboxes.append(self.compute_rawbbox(image, extent, axes))
+                    #it's i+1 here, because the background has label 0
+                    binary_bboxes.append(np.asarray(labels[tuple(extent)] == i+1))
+                batch_result = {}
                 for plugin_name, feature_dict in feature_names.iteritems():
                     if not has_local_features[plugin_name]:
                         continue
                     plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+                    batch_result[plugin_name] = plugin.plugin_object.compute_local_batch(rawbboxes, binary_bboxes, feature_dict, axes)
+                batch_results[batch_index] = batch_result
+
+            logger.debug("computing local features for {} objects in {} batches".format(nobj, len(batches)))
+            pool = RequestPool()
+            for batch_index in range(len(batches)):
+                pool.add(Request(partial(compute_batch, batch_index)))
+            pool.wait()
+            pool.clean()
+
+            # concatenate the batches, preserving the object order
+            for batch_result in batch_results:
+                for plugin_name, feats in batch_result.iteritems():
+                    for key, values in feats.iteritems():
+                        local_features[plugin_name][key].extend(values)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
@@ -346,7 +447,11 @@ class OpRegionFeatures3d(Operator):
             all_features[name] = dict(d1.items() + d2.items())
         all_features[default_features_key]=extrafeats
 
-        # reshape all features
+        return self._add_background_object(all_features, nobj)
+
+    @staticmethod
+    def _add_background_object(all_features, nobj):
+        """reshape all features"""
         for pfeats in all_features.itervalues():
             for key, value in pfeats.iteritems():
                 if value.shape[0] != nobj:
@@ -367,7 +472,7 @@ class OpRegionFeatures3d(Operator):
         return all_features
 
     def propagateDirty(self, slot, subindex, roi):
-        if slot is self.Features:
+        if slot is self.Features or slot is self.StreamingBlockShape:
             self.Output.setDirty(slice(None))
         else:
             axes = self.RawVolume.meta.getTaggedShape().keys()
@@ -392,6 +497,7 @@ class OpRegionFeatures(Operator):
     RawImage = InputSlot()
     LabelImage = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    StreamingBlockShape = InputSlot(optional=True)
     Output = OutputSlot()
 
     # Schematic:
@@ -421,6 +527,7 @@ class OpRegionFeatures(Operator):
         self.opRegionFeatures3dBlocks.RawVolume.connect(self.opRawTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.LabelVolume.connect(self.opLabelTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.Features.connect(self.Features)
+        self.opRegionFeatures3dBlocks.StreamingBlockShape.connect(self.StreamingBlockShape)
         assert self.opRegionFeatures3dBlocks.Output.level == 1
 
         self.opTimeStacker = OpMultiArrayStacker(parent=self)
@@ -446,6 +553,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    StreamingBlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -466,6 +574,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawImage.connect(self.RawImage)
         self._opRegionFeatures.LabelImage.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.StreamingBlockShape.connect(self.StreamingBlockShape)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -625,6 +734,11 @@ class OpObjectExtraction(Operator):
     # for example {"Standard Object Features": {"Mean in neighborhood":{"margin": (5, 5, 2)}}}
     Features = InputSlot(rtype=List, stype=Opaque, value={})
 
+    # optional dict of spatial block dims, e.g. {'x' : 256, 'y' : 256, 'z' : 256}.
+    # If set, features which can be accumulated blockwise are computed
+    # without reading the whole volume at once.
+    StreamingBlockShape = InputSlot(optional=True)
+
     LabelImage = OutputSlot()
     ObjectCenterImage = OutputSlot()
 
@@ -674,6 +788,7 @@ class OpObjectExtraction(Operator):
         self._opRegFeats.RawImage.connect(self.RawImage)
         self._opRegFeats.LabelImage.connect(self._opLabelImage.Output)
         self._opRegFeats.Features.connect(self.Features)
+        self._opRegFeats.StreamingBlockShape.connect(self.StreamingBlockShape)
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
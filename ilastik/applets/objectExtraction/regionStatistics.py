@@ -0,0 +1,240 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+import numpy as np
+
+# The vigra region features which can be assembled from mergeable
+# per-label statistics. Everything else needs the whole object at once.
+STREAMABLE_FEATURES = set(['Count', 'Sum', 'Mean', 'Variance', 'Skewness',
+                           'Kurtosis', 'Minimum', 'Maximum',
+                           'Coord<Minimum>', 'Coord<Maximum>', 'RegionCenter'])
+
+# The statistics of a single block, for the labels present in the
+# block only. ids is sorted, and all other fields are indexed like ids.
+# moments holds the mean and the 2nd to 4th central moment sums of each channel.
+BlockSummary = collections.namedtuple('BlockSummary', ['ids', 'count', 'moments',
+                                                       'minimum', 'maximum', 'coordsum',
+                                                       'coordmin', 'coordmax'])
+
+def summarize_block(raw, labels, offset):
+    """Compute the statistics of the labels found in one block.
+
+    The result only has entries for the labels present in the block,
+    so it is cheap to merge into a RegionStatistics even if the
+    volume has many more objects.
+
+    :param raw: numpy.ndarray with the spatial axes and a trailing
+        channel axis
+    :param labels: integer numpy.ndarray with the spatial axes
+    :param offset: the global coordinates of the block's first pixel
+
+    """
+    assert raw.shape[:-1] == labels.shape
+    nchannels = raw.shape[-1]
+    ndim = labels.ndim
+
+    labels = np.asarray(labels).reshape(-1)
+    foreground = np.nonzero(labels)[0]
+    ids, inverse = np.unique(labels[foreground], return_inverse=True)
+    n = len(ids)
+
+    count = np.bincount(inverse, minlength=n).astype(np.float64)
+    moments = np.zeros((4, n, nchannels))
+    minimum = _filled((n, nchannels), np.inf)
+    maximum = _filled((n, nchannels), -np.inf)
+    values = np.asarray(raw, dtype=np.float64).reshape(-1, nchannels)[foreground]
+    for c in range(nchannels):
+        v = values[:, c]
+        moments[0, :, c] = np.bincount(inverse, weights=v, minlength=n) / count
+        # sums of the powers of the deviations from the mean (two passes,
+        # so that a large mean doesn't cancel out the small moments)
+        deviation = v - moments[0, inverse, c]
+        power = deviation.copy()
+        for k in range(1, 4):
+            power *= deviation
+            moments[k, :, c] = np.bincount(inverse, weights=power, minlength=n)
+        np.minimum.at(minimum[:, c], inverse, v)
+        np.maximum.at(maximum[:, c], inverse, v)
+
+    coordsum = np.zeros((n, ndim))
+    coordmin = _filled((n, ndim), np.inf)
+    coordmax = _filled((n, ndim), -np.inf)
+    # the block is dense, so each coordinate is just an unraveled index
+    coords = np.unravel_index(foreground, raw.shape[:-1])
+    for d in range(ndim):
+        coord = coords[d].astype(np.float64) + offset[d]
+        coordsum[:, d] = np.bincount(inverse, weights=coord, minlength=n)
+        np.minimum.at(coordmin[:, d], inverse, coord)
+        np.maximum.at(coordmax[:, d], inverse, coord)
+
+    return BlockSummary(ids, count, moments, minimum, maximum,
+                        coordsum, coordmin, coordmax)
+
+def _filled(shape, value):
+    a = np.empty(shape, dtype=np.float64)
+    a.fill(value)
+    return a
+
+def _merge_moments(count_a, moments_a, count_b, moments_b):
+    """Combine the means and central moment sums of two disjoint sets
+    of values, with the pairwise update formulas of Chan et al. and
+    Pebay ("Formulas for robust, one-pass parallel computation of
+    covariances and arbitrary-order statistical moments", 2008).
+
+    :param count_a: the sizes of the sets, shape (n,)
+    :param moments_a: the means and central moment sums, shape (4, n, nchannels)
+
+    """
+    na = count_a[:, np.newaxis]
+    nb = count_b[:, np.newaxis]
+    n = na + nb
+    # empty sets contribute nothing (and both may be empty)
+    n_inv = 1.0 / np.maximum(n, 1)
+    mean_a, m2_a, m3_a, m4_a = moments_a
+    mean_b, m2_b, m3_b, m4_b = moments_b
+
+    delta = mean_b - mean_a
+    delta_n = delta * n_inv
+    nanb = na * nb
+
+    merged = np.empty(np.broadcast(moments_a, moments_b).shape)
+    merged[0] = mean_a + delta_n * nb
+    merged[1] = m2_a + m2_b + delta * delta_n * nanb
+    merged[2] = (m3_a + m3_b + delta * delta_n**2 * nanb * (na - nb) +
+                 3 * delta_n * (na * m2_b - nb * m2_a))
+    merged[3] = (m4_a + m4_b + delta * delta_n**3 * nanb * (na * na - nanb + nb * nb) +
+                 6 * delta_n**2 * (na * na * m2_b + nb * nb * m2_a) +
+                 4 * delta_n * (na * m3_b - nb * m3_a))
+    return merged
+
+class RegionStatistics(object):
+    """Mergeable per-label statistics of a label image and its raw data.
+
+    Statistics of a volume can be accumulated block by block with
+    add_block() or add_summary(), or computed for separate parts of
+    the volume and combined afterwards with merge(). Label 0 is
+    background and is ignored.
+
+    Per label, we keep the pixel count, the mean and the central
+    moment sums (up to the fourth order) of each raw channel, the
+    per-channel min/max, the coordinate sums and the bounding box.
+    Everything in STREAMABLE_FEATURES can be derived from those. The
+    moments are merged pairwise (see _merge_moments()), which stays
+    accurate when the mean is large compared to the spread, unlike
+    moments computed from raw power sums.
+
+    """
+    def __init__(self, nchannels, ndim):
+        self.nchannels = nchannels
+        self.ndim = ndim
+        self.nlabels = 0
+        self.count = np.zeros((0,), dtype=np.float64)
+        self.moments = np.zeros((4, 0, nchannels), dtype=np.float64)
+        self.minimum = np.zeros((0, nchannels), dtype=np.float64)
+        self.maximum = np.zeros((0, nchannels), dtype=np.float64)
+        self.coordsum = np.zeros((0, ndim), dtype=np.float64)
+        self.coordmin = np.zeros((0, ndim), dtype=np.float64)
+        self.coordmax = np.zeros((0, ndim), dtype=np.float64)
+
+    def _grow(self, nlabels):
+        """make room for labels [0, nlabels)"""
+        capacity = len(self.count)
+        if nlabels > capacity:
+            # grow geometrically, so that many small increments stay cheap
+            extra = max(nlabels, 2 * capacity) - capacity
+            self.count = np.concatenate((self.count, np.zeros((extra,))))
+            self.moments = np.concatenate((self.moments, np.zeros((4, extra, self.nchannels))), axis=1)
+            self.minimum = np.concatenate((self.minimum, _filled((extra, self.nchannels), np.inf)))
+            self.maximum = np.concatenate((self.maximum, _filled((extra, self.nchannels), -np.inf)))
+            self.coordsum = np.concatenate((self.coordsum, np.zeros((extra, self.ndim))))
+            self.coordmin = np.concatenate((self.coordmin, _filled((extra, self.ndim), np.inf)))
+            self.coordmax = np.concatenate((self.coordmax, _filled((extra, self.ndim), -np.inf)))
+        self.nlabels = max(self.nlabels, nlabels)
+
+    def add_block(self, raw, labels, offset):
+        """Accumulate the statistics of one block.
+
+        See summarize_block() for the parameters.
+
+        """
+        self.add_summary(summarize_block(raw, labels, offset))
+
+    def add_summary(self, summary):
+        """Accumulate a BlockSummary produced by summarize_block()."""
+        if len(summary.ids) == 0:
+            return
+        self._grow(int(summary.ids[-1]) + 1)
+        # ids are unique, so fancy-indexed updates are safe
+        ids = summary.ids
+        self.moments[:, ids] = _merge_moments(self.count[ids], self.moments[:, ids],
+                                              summary.count, summary.moments)
+        self.count[ids] += summary.count
+        self.minimum[ids] = np.minimum(self.minimum[ids], summary.minimum)
+        self.maximum[ids] = np.maximum(self.maximum[ids], summary.maximum)
+        self.coordsum[ids] += summary.coordsum
+        self.coordmin[ids] = np.minimum(self.coordmin[ids], summary.coordmin)
+        self.coordmax[ids] = np.maximum(self.coordmax[ids], summary.coordmax)
+
+    def merge(self, other):
+        """Add the statistics of another (disjoint) part of the volume."""
+        assert (other.nchannels, other.ndim) == (self.nchannels, self.ndim)
+        self._grow(other.nlabels)
+        n = other.nlabels
+        self.moments[:, :n] = _merge_moments(self.count[:n], self.moments[:, :n],
+                                             other.count[:n], other.moments[:, :n])
+        self.count[:n] += other.count[:n]
+        self.minimum[:n] = np.minimum(self.minimum[:n], other.minimum[:n])
+        self.maximum[:n] = np.maximum(self.maximum[:n], other.maximum[:n])
+        self.coordsum[:n] += other.coordsum[:n]
+        self.coordmin[:n] = np.minimum(self.coordmin[:n], other.coordmin[:n])
+        self.coordmax[:n] = np.maximum(self.coordmax[:n], other.coordmax[:n])
+
+    def features(self, names):
+        """Compute the requested features from the accumulated statistics.
+
+        The result has the same layout as the vigra plugin's output:
+        dict[feature_name] is a float numpy.ndarray of shape (nobj, k),
+        and the background object is NOT included.
+
+        """
+        unsupported = set(names) - STREAMABLE_FEATURES
+        if unsupported:
+            raise ValueError("cannot compute features {} blockwise".format(sorted(unsupported)))
+
+        # slice off the background and the unused capacity
+        objects = slice(1, self.nlabels)
+        n = self.count[objects, np.newaxis]
+        mean, m2, m3, m4 = self.moments[:, objects]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            available = {
+                'Count': n,
+                'Sum': mean * n,
+                'Mean': mean,
+                'Variance': m2 / n,
+                'Skewness': np.sqrt(n) * m3 / m2**1.5,
+                'Kurtosis': n * m4 / m2**2 - 3.0,
+                'Minimum': self.minimum[objects],
+                'Maximum': self.maximum[objects],
+                'Coord<Minimum>': self.coordmin[objects],
+                'Coord<Maximum>': self.coordmax[objects],
+                'RegionCenter': self.coordsum[objects] / n,
+            }
+        return dict((name, available[name]) for name in names)
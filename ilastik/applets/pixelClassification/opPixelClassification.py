@@ -30,7 +30,7 @@ import vigra
 from lazyflow.roi import determineBlockShape
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpValueCache, OpTrainClassifierBlocked, OpClassifierPredict,\
-                               OpSlicedBlockedArrayCache, OpMultiArraySlicer2, \
+                               OpMultiArraySlicer2, \
                                OpPixelOperator, OpMaxChannelIndicatorOperator, OpCompressedUserLabelArray
 
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
@@ -39,6 +39,7 @@ from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.operatorSubView import OperatorSubView
 from ilastik.utility import OpMultiLaneWrapper
+from ilastik.utility.cacheGeometry import OpAdaptiveSlicedBlockedArrayCache
 
 class OpPixelClassification( Operator ):
     """
@@ -440,8 +441,9 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         self.PredictionProbabilities.connect( self.predict.PMaps )
 
         # Prediction cache for the GUI
-        self.prediction_cache_gui = OpSlicedBlockedArrayCache( parent=self )
+        self.prediction_cache_gui = OpAdaptiveSlicedBlockedArrayCache( parent=self )
         self.prediction_cache_gui.name = "prediction_cache_gui"
+        self.prediction_cache_gui.ThinEdge.setValue( 1 )
         self.prediction_cache_gui.inputs["fixAtCurrent"].connect( self.FreezePredictions )
         self.prediction_cache_gui.inputs["Input"].connect( self.predict.PMaps )
         self.CachedPredictionProbabilities.connect(self.prediction_cache_gui.Output )
@@ -467,50 +469,13 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         self.opUncertaintyEstimator.Input.connect( self.prediction_cache_gui.Output )
 
         # Cache the uncertainty so we get zeros for uncomputed points
-        self.opUncertaintyCache = OpSlicedBlockedArrayCache( parent=self )
+        self.opUncertaintyCache = OpAdaptiveSlicedBlockedArrayCache( parent=self )
         self.opUncertaintyCache.name = "opUncertaintyCache"
+        self.opUncertaintyCache.ThinEdge.setValue( 1 )
         self.opUncertaintyCache.Input.connect( self.opUncertaintyEstimator.Output )
         self.opUncertaintyCache.fixAtCurrent.connect( self.FreezePredictions )
         self.UncertaintyEstimate.connect( self.opUncertaintyCache.Output )
 
-    def setupOutputs(self):
-        # Set the blockshapes for each input image separately, depending on which axistags it has.
-        axisOrder = [ tag.key for tag in self.FeatureImages.meta.axistags ]
-
-        blockDimsX = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (128,256),
-                       'x' : (1,1),
-                       'c' : (100, 100) }
-
-        blockDimsY = { 't' : (1,1),
-                       'z' : (128,256),
-                       'y' : (1,1),
-                       'x' : (128,256),
-                       'c' : (100,100) }
-
-        blockDimsZ = { 't' : (1,1),
-                       'z' : (1,1),
-                       'y' : (128,256),
-                       'x' : (128,256),
-                       'c' : (100,100) }
-
-        innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-        outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-
-        innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-        outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-
-        innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-        outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-
-        self.prediction_cache_gui.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-        self.prediction_cache_gui.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-
-        self.opUncertaintyCache.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-        self.opUncertaintyCache.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
-
-
 class OpEnsembleMargin(Operator):
     """
     Produces a pixelwise measure of the uncertainty of the pixelwise predictions.
@@ -19,12 +19,14 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import copy
+import threading
+from functools import partial
 import numpy
 import vigra
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import roiFromShape, roiToSlice, getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import roiFromShape, roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
 from lazyflow.operators import OpCrosshairMarkers, OpSelectLabel
-from lazyflow.operators.operators import OpArrayCache
 
 from ilastik.workflows.carving.opCarving import OpCarving
 from opParseAnnotations import OpParseAnnotations
@@ -54,6 +56,8 @@ class OpSplitBodyCarving( OpCarving ):
     AnnotationLocations = OutputSlot()
     AnnotationBodyIds = OutputSlot()
     Annotations = OutputSlot()
+
+    RavelerBodyBoundingBoxes = OutputSlot() # A single object: { raveler label : (start, stop) }
     
     BLOCK_SIZE = 520
     SEED_MARGIN = 10
@@ -72,6 +76,11 @@ class OpSplitBodyCarving( OpCarving ):
         self._opSelectRavelerObject.SelectedLabel.connect( self.CurrentRavelerLabel )
         self._opSelectRavelerObject.Input.connect( self.RavelerLabels )
         self.CurrentRavelerObject.connect( self._opSelectRavelerObject.Output )
+
+        # The bounding boxes of all raveler bodies (for auto-seeding)
+        self._opBodyBoundingBoxes = OpLabelBoundingBoxes( parent=self )
+        self._opBodyBoundingBoxes.Input.connect( self.RavelerLabels )
+        self.RavelerBodyBoundingBoxes.connect( self._opBodyBoundingBoxes.BoundingBoxes )
         
         # LUTs of all fragments of the current Raveler body are combined into a single LUT
         self._opFragmentSetLut = OpFragmentSetLut( parent=self )
@@ -79,10 +88,6 @@ class OpSplitBodyCarving( OpCarving ):
         self._opFragmentSetLut.RavelerLabel.connect( self.CurrentRavelerLabel )
         self._opFragmentSetLut.CurrentEditingFragment.connect( self.CurrentEditingFragment )
         self._opFragmentSetLut.Trigger.connect( self.Trigger )
-
-        # The combined LUT is cached to avoid recomputing it for every orthoview.
-        self._opFragmentSetLutCache = OpArrayCache( parent=self )
-        self._opFragmentSetLutCache.blockShape.setValue( (1e10,) ) # Something big (always get the whole thing)
         
         # Display-only: Show the annotations as crosshairs
         self._opCrosshairs = OpCrosshairMarkers( parent=self )
@@ -93,53 +98,96 @@ class OpSplitBodyCarving( OpCarving ):
 
     @classmethod
     def autoSeedBackground(cls, laneView, foreground_label):
-        # Seed the entire image with background labels, except for the individual label in question
-        # To save memory, we'll do this in blocks instead of all at once
+        # Seed a 'hull' of background labels around the individual label in question.
+        # The hull is SEED_MARGIN away from the label, so only the label's bounding box
+        #  (plus that margin) is processed, in blocks (in parallel).
+        bounding_boxes = laneView.RavelerBodyBoundingBoxes.value
+        if foreground_label not in bounding_boxes:
+            logger.warn( "Can't auto-seed label {}: It doesn't occur in the volume.".format( foreground_label ) )
+            return
 
         volume_shape = laneView.RavelerLabels.meta.shape
-        volume_roi = roiFromShape( volume_shape )
-        block_shape = (OpSplitBodyCarving.BLOCK_SIZE,) * len( volume_shape ) 
+        axiskeys = laneView.RavelerLabels.meta.getAxisKeys()
+        spatial_axes = [ i for i, k in enumerate(axiskeys) if k in 'xyz' ]
+        halo = cls.SEED_MARGIN + 1
+
+        # The region which can contain seeds
+        region_start, region_stop = map( numpy.array, bounding_boxes[foreground_label] )
+        region_start[spatial_axes] = numpy.maximum( 0, region_start[spatial_axes] - halo )
+        region_stop[spatial_axes] = numpy.minimum( numpy.array(volume_shape)[spatial_axes], region_stop[spatial_axes] + halo )
+
+        block_shape = (cls.BLOCK_SIZE,) * len( volume_shape )
         block_shape = numpy.minimum( block_shape, volume_shape )
-        block_starts = getIntersectingBlocks( block_shape, volume_roi )
-
-        logger.debug("Auto-seeding {} blocks for label".format( len(block_starts), foreground_label ))
-        for block_index, block_start in enumerate(block_starts):
-            block_roi = getBlockBounds( volume_shape, block_shape, block_start )
-            label_block = laneView.RavelerLabels(*block_roi).wait()
-            background_block = numpy.where( label_block == foreground_label, 0, 1 )
-            background_block = numpy.asarray( background_block, numpy.float32 ) # Distance transform requires float
-            if (background_block == 0.0).any():
-                # We need to leave a small border between the background seeds and the object membranes
-                background_block_view = background_block.view( vigra.VigraArray )
-                background_block_view.axistags = copy.copy( laneView.RavelerLabels.meta.axistags )
-                
-                background_block_view_4d = background_block_view.bindAxis('t', 0)
-                background_block_view_3d = background_block_view_4d.bindAxis('c', 0)
-                
-                distance_transformed_block = vigra.filters.distanceTransform3D(background_block_view_3d, background=False)
-                distance_transformed_block = distance_transformed_block.astype( numpy.uint8 )
-                
-                # Create a 'hull' surrounding the foreground, but leave some space.
-                background_seed_block = (distance_transformed_block == OpSplitBodyCarving.SEED_MARGIN)
-                background_seed_block = background_seed_block.astype(numpy.uint8) * 1 # (In carving, background is label 1)
-
-#                # Make the hull VERY sparse to avoid over-biasing graph cut toward the background class
-#                # FIXME: Don't regenerate this random block on every loop iteration
-#                rand_bytes = numpy.random.randint(0, 1000, background_seed_block.shape)
-#                background_seed_block = numpy.where( rand_bytes < 1, background_seed_block, 0 )
-#                background_seed_block = background_seed_block.view(vigra.VigraArray)
-#                background_seed_block.axistags = background_block_view_3d.axistags
-                
-                axisorder = laneView.RavelerLabels.meta.getTaggedShape().keys()
-                
-                logger.debug("Writing backgound seeds: {}/{}".format( block_index, len(block_starts) ))
-                laneView.WriteSeeds[ roiToSlice( *block_roi ) ] = background_seed_block.withAxes(*axisorder)
-            else:
-                logger.debug("Skipping all-background block: {}/{}".format( block_index, len(block_starts) ))
+        block_starts = getIntersectingBlocks( block_shape, (region_start, region_stop) )
+
+        logger.debug("Auto-seeding {} blocks for label {}".format( len(block_starts), foreground_label ))
+        seed_blocks = []
+        pool = RequestPool()
+        for block_start in block_starts:
+            block_roi = getIntersection( getBlockBounds( volume_shape, block_shape, block_start ),
+                                         (region_start, region_stop) )
+            pool.add( Request( partial( cls._computeBackgroundSeeds, laneView, foreground_label,
+                                        block_roi, (region_start, region_stop), seed_blocks ) ) )
+        pool.wait()
+        pool.clean()
+
+        # Only the (small) bounding boxes of the seeds are written.
+        # The zeros in them would erase the seeds which are already there, so those are kept.
+        for block_index, (seed_roi, seed_block) in enumerate(seed_blocks):
+            logger.debug("Writing backgound seeds: {}/{}".format( block_index, len(seed_blocks) ))
+            seed_slicing = roiToSlice( *seed_roi )
+            existing_seeds = laneView.opLabelArray.Output[ seed_slicing ].wait()
+            seed_block = numpy.where( seed_block != 0, seed_block, existing_seeds ).astype( existing_seeds.dtype )
+            laneView.WriteSeeds[ seed_slicing ] = seed_block
+
+    @classmethod
+    def _computeBackgroundSeeds(cls, laneView, foreground_label, block_roi, region, seed_blocks):
+        """
+        Compute the background seeds of a single block, and append them (cropped to
+        their bounding box) to seed_blocks, if there are any.
+        """
+        axiskeys = laneView.RavelerLabels.meta.getAxisKeys()
+        spatial_axes = [ i for i, k in enumerate(axiskeys) if k in 'xyz' ]
+        halo = cls.SEED_MARGIN + 1
+
+        # The distances must be computed with a halo, so that they don't depend on the blocking
+        block_start, block_stop = map( numpy.array, block_roi )
+        halo_start, halo_stop = block_start.copy(), block_stop.copy()
+        halo_start[spatial_axes] = numpy.maximum( region[0][spatial_axes], block_start[spatial_axes] - halo )
+        halo_stop[spatial_axes] = numpy.minimum( region[1][spatial_axes], block_stop[spatial_axes] + halo )
+
+        label_block = laneView.RavelerLabels(halo_start, halo_stop).wait()
+        background_block = numpy.where( label_block == foreground_label, 0, 1 )
+        background_block = numpy.asarray( background_block, numpy.float32 ) # Distance transform requires float
+        if not (background_block == 0.0).any():
+            return
+
+        # We need to leave a small border between the background seeds and the object membranes
+        background_block_view = background_block.view( vigra.VigraArray )
+        background_block_view.axistags = copy.copy( laneView.RavelerLabels.meta.axistags )
+        
+        background_block_view_4d = background_block_view.bindAxis('t', 0)
+        background_block_view_3d = background_block_view_4d.bindAxis('c', 0)
+        
+        distance_transformed_block = vigra.filters.distanceTransform3D(background_block_view_3d, background=False)
+        distance_transformed_block = distance_transformed_block.astype( numpy.uint8 )
+        
+        # Create a 'hull' surrounding the foreground, but leave some space.
+        background_seed_block = (distance_transformed_block == cls.SEED_MARGIN)
+        background_seed_block = background_seed_block.astype(numpy.uint8) * 1 # (In carving, background is label 1)
+        background_seed_block = numpy.asarray( background_seed_block.withAxes(*axiskeys) )
+
+        # Drop the halo, and crop the seeds to their bounding box
+        background_seed_block = background_seed_block[ roiToSlice( block_start - halo_start, block_stop - halo_start ) ]
+        nonzero = background_seed_block.nonzero()
+        if len(nonzero[0]) == 0:
+            return
+        seed_start = numpy.array( [ n.min() for n in nonzero ] )
+        seed_stop = numpy.array( [ n.max()+1 for n in nonzero ] )
+        background_seed_block = background_seed_block[ roiToSlice( seed_start, seed_stop ) ]
+        seed_blocks.append( ( (block_start + seed_start, block_start + seed_stop), background_seed_block ) )
 
     def setupOutputs(self):
-        self._opFragmentSetLutCache.Input.connect( self._opFragmentSetLut.Lut )
-            
         super( OpSplitBodyCarving, self ).setupOutputs()
         self.MaskedSegmentation.meta.assignFrom(self.Segmentation.meta)
         def handleDirtySegmentation(slot, roi):
@@ -151,7 +199,7 @@ class OpSplitBodyCarving( OpCarving ):
         self.CurrentFragmentSegmentation.meta.assignFrom( self.RavelerLabels.meta )
         self.CurrentFragmentSegmentation.meta.dtype = numpy.uint8
 
-        if not self._opFragmentSetLutCache.Output.ready():
+        if not self._opFragmentSetLut.Fragments.ready():
             self.MaskedSegmentation.meta.NOTREADY = True
             self.CurrentRavelerObjectRemainder.meta.NOTREADY = True
 
@@ -194,12 +242,14 @@ class OpSplitBodyCarving( OpCarving ):
         # Start with the original raveler object
         self._opSelectRavelerObject.Output(roi.start, roi.stop).writeInto(result).wait()
 
-        lut = self._opFragmentSetLutCache.Output[:].wait()
+        fragments = self._opFragmentSetLut.Fragments.value
 
         # Save memory: Implement (A - B) == (A & ~B), and do it with in-place operations
         slicing = roiToSlice( roi.start[1:4], roi.stop[1:4] )
         a = result[0,...,0]
-        b = lut[self._mst.regionVol[slicing]] # (Advanced indexing)
+        if not fragments.intersects( self._mst.regionVol[slicing] ):
+            return result # B is empty
+        b = fragments.lookup( self._mst.regionVol[slicing] )
         numpy.logical_not( b, out=b ) # ~B
         numpy.logical_and(a, b, out=a) # A & ~B
         
@@ -209,11 +259,14 @@ class OpSplitBodyCarving( OpCarving ):
         # Start with the original raveler object
         self.CurrentRavelerObject(roi.start, roi.stop).writeInto(result).wait()
 
-        lut = self._opFragmentSetLutCache.Output[:].wait()
+        fragments = self._opFragmentSetLut.Fragments.value
 
         slicing = roiToSlice( roi.start[1:4], roi.stop[1:4] )
         a = result[0,...,0]
-        b = lut[self._mst.regionVol[slicing]] # (Advanced indexing)
+        if not fragments.intersects( self._mst.regionVol[slicing] ):
+            a[:] = 0
+            return result
+        b = fragments.lookup( self._mst.regionVol[slicing] )
 
         # Use bitwise_and instead of numpy.where to avoid the temporary caused by a == 0
         #a[:] = numpy.where( a == 0, 0, b )
@@ -280,15 +333,24 @@ class OpSplitBodyCarving( OpCarving ):
         return deleted
 
 class OpFragmentSetLut(Operator):
+    """
+    Assigns each supervoxel the (1-based) number of the saved fragment of the
+    given raveler body which contains it (or 0), either as a dense LUT over
+    all supervoxels (Lut) or as a FragmentSupervoxels object (Fragments),
+    which only holds the supervoxels of the fragments.
+    """
     MST = InputSlot()
     RavelerLabel = InputSlot()
     CurrentEditingFragment = InputSlot()
     Trigger = InputSlot(optional=True) # For dirty notifications only
     
     Lut = OutputSlot()
+    Fragments = OutputSlot()
 
     def __init__(self, *args, **kwargs):
         super( OpFragmentSetLut, self ).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._fragments = None
         
         # HACK: See setupOutputs
         self.MST.notifyDirty( bind(self._setupOutputs) )
@@ -296,37 +358,215 @@ class OpFragmentSetLut(Operator):
     def setupOutputs(self):
         self.Lut.meta.shape = ( len(self.MST.value.objects.lut), )
         self.Lut.meta.dtype = numpy.uint8
+        self.Fragments.meta.shape = (1,)
+        self.Fragments.meta.dtype = object
+        self._fragments = None
         
     def execute(self, slot, subindex, roi, result):
+        if slot == self.Fragments:
+            with self._lock:
+                if self._fragments is None:
+                    self._fragments = self._computeFragments()
+                result[0] = self._fragments
+            return result
+
         assert slot == self.Lut
         assert roi.stop - roi.start == self.Lut.meta.shape
         
+        result[:] = 0
+        for supervoxels, fragment_number in self._fragmentSupervoxelLists():
+            result[supervoxels] = fragment_number
+
+        logger.info( "Finished accumulating fragments into lut" )
+        return result
+
+    def _fragmentSupervoxelLists(self):
+        """
+        The supervoxels of each fragment that came from the current raveler object,
+        with the fragment's number, in reverse order (the first fragment has priority).
+        """
         ravelerLabel = self.RavelerLabel.value
         if ravelerLabel == 0:
-            result[:] = 0
-            return result
+            return []
 
         logger.info( "Requesting fragment names" )
         mst = self.MST.value
         names = OpSplitBodyCarving.getSavedObjectNamesForMstAndRavelerLabel(mst, ravelerLabel)
         logger.info( "Got fragment names: {}".format( names ) )
         
-        # Accumulate the supervoxels from each fragment that came from the current raveler object
-        result[:] = 0
-        for i, name in reversed(list(enumerate(names))):
-            if name != self.CurrentEditingFragment.value:
-                objectSupervoxels = mst.object_lut[name]
-                # Give each fragment it's own label to support different colors for each
-                result[objectSupervoxels] = i+1
+        # Give each fragment it's own label to support different colors for each
+        return [ (mst.object_lut[name], i+1) for i, name in reversed(list(enumerate(names)))
+                 if name != self.CurrentEditingFragment.value ]
 
-        logger.info( "Finished accumulating fragments into lut" )
-        return result
+    def _computeFragments(self):
+        return FragmentSupervoxels.fromLists( self._fragmentSupervoxelLists() )
     
     def propagateDirty(self, slot, subindex, roi):
+        self._fragments = None
         self.Lut.setDirty( slice(None) )
+        self.Fragments.setDirty()
+
+class FragmentSupervoxels(object):
+    """
+    The supervoxels of a set of fragments: sorted supervoxel ids, and the
+    fragment number of each. Lookups only consider the supervoxels in the
+    id range of the given tile, so they don't depend on the total number
+    of supervoxels.
+    """
+    #: Up to this id range (relative to the tile size), lookups go through a small LUT
+    MAX_LUT_RATIO = 4
+
+    def __init__(self, supervoxels, numbers):
+        self.supervoxels = supervoxels
+        self.numbers = numbers
+        # Per thread: a buffer for the ids relative to the LUT, reused for all tiles
+        self._buffers = threading.local()
+
+    @classmethod
+    def fromLists(cls, lists):
+        """
+        Create from a list of (supervoxels, fragment number), as given by
+        OpFragmentSetLut._fragmentSupervoxelLists(). Where fragments overlap,
+        the last one listed wins (as in the dense LUT).
+        """
+        if not lists:
+            return cls( numpy.zeros( (0,), dtype=numpy.uint32 ), numpy.zeros( (0,), dtype=numpy.uint8 ) )
+        supervoxels = numpy.concatenate( [ numpy.asarray(sv).ravel() for sv, _ in lists ] )
+        numbers = numpy.concatenate( [ numpy.repeat( numpy.uint8(n), numpy.asarray(sv).size ) for sv, n in lists ] )
+
+        order = numpy.argsort( supervoxels, kind='mergesort' )
+        supervoxels, numbers = supervoxels[order], numbers[order]
+        last = numpy.append( numpy.diff(supervoxels) != 0, True )
+        return cls( supervoxels[last], numbers[last] )
+
+    def _offsetBuffer(self, regionIds):
+        buf = getattr( self._buffers, 'offsets', None )
+        if buf is None or buf.dtype != regionIds.dtype or buf.size < regionIds.size:
+            buf = self._buffers.offsets = numpy.empty( (regionIds.size,), dtype=regionIds.dtype )
+        return buf[:regionIds.size].reshape( regionIds.shape )
+
+    def _range(self, regionIds):
+        lo, hi = regionIds.min(), regionIds.max()
+        i, j = numpy.searchsorted( self.supervoxels, [lo, hi+1] )
+        return lo, hi, i, j
+
+    def intersects(self, regionIds):
+        """
+        Whether any fragment supervoxel could occur among the given ids.
+        (A cheap test: only the range of the ids is checked.)
+        """
+        if len(self.supervoxels) == 0 or regionIds.size == 0:
+            return False
+        _, _, i, j = self._range( regionIds )
+        return i < j
 
+    def lookup(self, regionIds):
+        """
+        Returns the fragment number of each of the given supervoxel ids (0: none), as uint8.
+        """
+        result = numpy.zeros( regionIds.shape, dtype=numpy.uint8 )
+        if not self.intersects( regionIds ):
+            return result
+        lo, hi, i, j = self._range( regionIds )
+        supervoxels = self.supervoxels[i:j]
+        numbers = self.numbers[i:j]
+        if hi - lo < self.MAX_LUT_RATIO * regionIds.size:
+            lut = numpy.zeros( (hi - lo + 1,), dtype=numpy.uint8 )
+            lut[ supervoxels - lo ] = numbers
+            offsets = self._offsetBuffer( regionIds )
+            numpy.subtract( regionIds, lo, out=offsets )
+            numpy.take( lut, offsets, out=result )
+        else:
+            index = numpy.searchsorted( supervoxels, regionIds )
+            numpy.minimum( index, len(supervoxels)-1, out=index )
+            found = ( supervoxels[index] == regionIds )
+            result[found] = numbers[index[found]]
+        return result
+
+class OpLabelBoundingBoxes(Operator):
+    """
+    Outputs the bounding boxes of all (nonzero) labels of the input, as a
+    dict of { label : (start, stop) }.  The boxes are computed blockwise (in
+    parallel) on the first request, and kept until the input becomes dirty.
+    """
+    Input = InputSlot()
+    BoundingBoxes = OutputSlot()
 
+    BLOCK_SIZE = 256
 
+    def __init__(self, *args, **kwargs):
+        super( OpLabelBoundingBoxes, self ).__init__(*args, **kwargs)
+        # The boxes are computed with requests while the lock is held
+        self._lock = RequestLock()
+        self._boundingBoxes = None
+
+    def setupOutputs(self):
+        self.BoundingBoxes.meta.shape = (1,)
+        self.BoundingBoxes.meta.dtype = object
+        self._boundingBoxes = None
 
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.BoundingBoxes
+        with self._lock:
+            if self._boundingBoxes is None:
+                self._boundingBoxes = self._computeBoundingBoxes()
+            result[0] = self._boundingBoxes
+        return result
 
+    def _computeBoundingBoxes(self):
+        shape = self.Input.meta.shape
+        block_shape = numpy.minimum( (self.BLOCK_SIZE,) * len(shape), shape )
+        block_boxes = []
+        def processBlock(block_start):
+            start, stop = getBlockBounds( shape, block_shape, block_start )
+            labels, mins, maxs = _blockBoundingBoxes( self.Input(start, stop).wait() )
+            block_boxes.append( (labels, mins + start, maxs + start) )
+
+        pool = RequestPool()
+        for block_start in getIntersectingBlocks( block_shape, roiFromShape(shape) ):
+            pool.add( Request( partial(processBlock, block_start) ) )
+        pool.wait()
+        pool.clean()
+
+        # Combine the boxes of each label from all blocks
+        labels = numpy.concatenate( [b[0] for b in block_boxes] )
+        if len(labels) == 0:
+            return {}
+        labels, mins, maxs = _groupExtrema( labels,
+                                            numpy.concatenate( [b[1] for b in block_boxes] ),
+                                            numpy.concatenate( [b[2] for b in block_boxes] ) )
+        return dict( (int(label), (tuple(start), tuple(stop+1))) for label, start, stop in zip(labels, mins, maxs) )
 
+    def propagateDirty(self, slot, subindex, roi):
+        self._boundingBoxes = None
+        self.BoundingBoxes.setDirty()
+
+def _groupExtrema(labels, mins, maxs):
+    """
+    Reduce per-occurrence (label, min coordinates, max coordinates) to one entry per label.
+    """
+    order = numpy.argsort( labels, kind='mergesort' )
+    labels, mins, maxs = labels[order], mins[order], maxs[order]
+    group_starts = numpy.concatenate( ([0], numpy.flatnonzero( numpy.diff(labels) ) + 1) )
+    return ( labels[group_starts],
+             numpy.minimum.reduceat( mins, group_starts, axis=0 ),
+             numpy.maximum.reduceat( maxs, group_starts, axis=0 ) )
+
+def _blockBoundingBoxes(block):
+    """
+    Returns (labels, mins, maxs) for the nonzero labels of the given block,
+    with inclusive min and max coordinates (relative to the block).
+    """
+    # Along each axis, the extent of a label is given by the first and last slice it occurs in.
+    extents = []
+    for axis in range( block.ndim ):
+        slice_labels = [ numpy.unique( block.take( [i], axis=axis ) ) for i in range( block.shape[axis] ) ]
+        positions = numpy.concatenate( [ numpy.repeat( i, len(u) ) for i, u in enumerate(slice_labels) ] )
+        labels, first, last = _groupExtrema( numpy.concatenate( slice_labels ), positions, positions )
+        extents.append( (first, last) )
+
+    # Every label occurs in some slice along each axis, so the labels are the same for all axes.
+    mins = numpy.array( [ e[0] for e in extents ] ).transpose()
+    maxs = numpy.array( [ e[1] for e in extents ] ).transpose()
+    nonzero = ( labels != 0 )
+    return labels[nonzero], mins[nonzero], maxs[nonzero]
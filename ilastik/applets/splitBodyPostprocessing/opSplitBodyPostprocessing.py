@@ -24,9 +24,9 @@ import numpy
 import vigra
 import h5py
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
-from lazyflow.roi import roiToSlice
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
 
-from lazyflow.request import Request
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.operators import OpFilterLabels, OpCompressedCache, OpVigraLabelVolume, OpMaskedWatershed, OpSelectLabel
 from lazyflow.operators.ioOperators import OpH5WriterBigDataset
 from lazyflow.operators.opReorderAxes import OpReorderAxes
@@ -38,6 +38,25 @@ from ilastik.utility import bind, log_exception
 import logging
 logger = logging.getLogger(__name__)
 
+#: Extent of the final segmentation's blocks along each spatial axis
+FINAL_BLOCK_EDGE = 256
+
+def finalBlockShape( meta, blockEdge=FINAL_BLOCK_EDGE ):
+    """
+    The block shape in which the final segmentation (and the fragment
+    images it is assembled from) are computed and cached: bounded along
+    the spatial axes, one block for all channels, one timestep at a time.
+    """
+    blockShape = []
+    for key, size in zip( meta.getAxisKeys(), meta.shape ):
+        if key in 'xyz':
+            blockShape.append( min( size, blockEdge ) )
+        elif key == 'c':
+            blockShape.append( size )
+        else:
+            blockShape.append( 1 )
+    return tuple(blockShape)
+
 class OpSplitBodyPostprocessing(Operator):
     
     RawData = InputSlot() # (Display only)
@@ -151,9 +170,14 @@ class OpSplitBodyPostprocessing(Operator):
         self._opMaskedWatershedCaches.Input.connect( self._opMaskedWatersheds.Output )
         self.WatershedFilledBodies.connect( self._opMaskedWatershedCaches.Output )
 
+        # The final segmentation is assembled block by block, so the filled bodies are
+        #  cached again in bounded blocks (the watershed caches above hold the entire volume).
+        self._opFilledBodyBlockCaches = OperatorWrapper( OpCompressedCache, parent=self, broadcastingSlotNames=['BlockShape'] )
+        self._opFilledBodyBlockCaches.Input.connect( self._opMaskedWatershedCaches.Output )
+
         self._opAccumulateFinalImage = OpAccumulateFragmentSegmentations( parent=self )
         self._opAccumulateFinalImage.RavelerLabels.connect( self.RavelerLabels )
-        self._opAccumulateFinalImage.FragmentSegmentations.connect( self.WatershedFilledBodies )
+        self._opAccumulateFinalImage.FragmentSegmentations.connect( self._opFilledBodyBlockCaches.Output )
         
         self._opFinalCache = OpCompressedCache( parent=self )
         self._opFinalCache.Input.connect( self._opAccumulateFinalImage.Output )
@@ -175,6 +199,11 @@ class OpSplitBodyPostprocessing(Operator):
             self._opSelectLabel.SelectedLabel[index].setValue( raveler_body_id )
             self._opFragmentSetLuts.RavelerLabel[index].setValue( raveler_body_id )
 
+        # Cache the final segmentation (and the bodies it is assembled from) in bounded blocks
+        blockShape = finalBlockShape( self.RavelerLabels.meta )
+        self._opFilledBodyBlockCaches.BlockShape.setValue( blockShape )
+        self._opFinalCache.BlockShape.setValue( blockShape )
+
     def execute(self, slot, subindex, roi, result):
         # All outputs are provided by internal operators, so this function should never be called
         assert False, "Unknown output slot: {}".format( slot.name )
@@ -280,84 +309,116 @@ class OpFragment(Operator):
         self.Output.setDirty()
 
 class OpAccumulateFragmentSegmentations( Operator ):
+    """
+    Combines the raveler labels with the fragment segmentations of the split
+    bodies: The fragment labels of each body are shifted above all labels
+    which precede them (the raveler labels and the fragments of the previous
+    bodies), and replace the raveler labels wherever they are nonzero.
+
+    The label offset of each body only depends on the maximum label of the
+    raveler labels and of the preceding fragment segmentations, so the
+    offsets are determined once (blockwise), and any roi of the output can
+    then be assembled independently, block by block.
+    """
     RavelerLabels = InputSlot()
     FragmentSegmentations = InputSlot(level=1)
     
     Output = OutputSlot()
     Mapping = OutputSlot()
 
+    #: Extent of the blocks along each spatial axis
+    BlockEdge = FINAL_BLOCK_EDGE
+
     def __init__(self, *args, **kwargs):
         super( OpAccumulateFragmentSegmentations, self ).__init__( *args, **kwargs )
+        self._lock = RequestLock()
+        self._offsets = None
         self._mapping = None
     
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.RavelerLabels.meta )
         self.Mapping.meta.dtype = object
         self.Mapping.meta.shape = (1,)
+        self._offsets = None
+        self._mapping = None
+
+    def _blockShape(self):
+        return finalBlockShape( self.Output.meta, self.BlockEdge )
+
+    def _maxLabel(self, slot):
+        """
+        The maximum of the given slot, computed block by block (in parallel).
+        """
+        shape = slot.meta.shape
+        blockShape = self._blockShape()
+        blockMaxima = []
+        def readMax(blockStart):
+            start, stop = getBlockBounds( shape, blockShape, blockStart )
+            blockMaxima.append( slot( start, stop ).wait().max() )
+        
+        pool = RequestPool()
+        for blockStart in getIntersectingBlocks( blockShape, ((0,)*len(shape), shape) ):
+            pool.add( Request( partial(readMax, blockStart) ) )
+        pool.wait()
+        pool.clean()
+        return int( max( [0] + blockMaxima ) )
+
+    def _getOffsets(self):
+        """
+        Determine the label offset of each body's fragments (and the mapping
+        from the final labels to raveler bodies), if they aren't known yet.
+        """
+        with self._lock:
+            if self._offsets is None:
+                max_label = self._maxLabel( self.RavelerLabels )
+                offsets = []
+                mapping = collections.OrderedDict()
+                mapping[(0,max_label+1)] = -1 # Special body-id: -1 means "identity"
+                for body_index, slot in enumerate(self.FragmentSegmentations):
+                    logger.info( "Finding max label of body {}...".format( body_index ) )
+                    offsets.append( max_label )
+                    fragment_max = self._maxLabel( slot )
+                    if fragment_max > 0:
+                        new_max = max_label + fragment_max
+                    else:
+                        new_max = max_label
+                    body_id = slot.meta.selected_label
+                    mapping[(max_label+1, new_max+1)] = body_id
+                    max_label = new_max
+                self._offsets = offsets
+                self._mapping = mapping
+            return self._offsets
 
     def execute(self, slot, subindex, roi, result):
         if slot == self.Mapping:
+            self._getOffsets()
             result[0] = self._mapping
             return result
         elif slot == self.Output:
-            assert (roi.start == 0).all() and (roi.stop == self.Output.meta.shape).all(), "Must request entire image."
-            self.RavelerLabels(roi.start, roi.stop).writeInto( result ).wait()
-    
-            # Allocate a temporary for our fragment images
-            fragment_image = numpy.zeros( result.shape, dtype=numpy.int32 )
-            max_label = result.max()
-            self._mapping = collections.OrderedDict()
-            self._mapping[(0,max_label+1)] = -1 # Special body-id: -1 means "identity"
-    
-            for body_index, slot in enumerate(self.FragmentSegmentations):
-                slot(roi.start, roi.stop).writeInto(fragment_image.view(numpy.uint32)).wait()
-
-                # This next line shows what we want to do, but it creates a big 
-                # temporary array (e.g. fragment_image + max_label)
-                # fragment_image = numpy.where( fragment_image, fragment_image+max_label, 0) 
-
-                # Instead, we bend over backwards here to do this 'in place'
-                logger.info( "Adding body {} to final image.".format( body_index ) )
-                fragment_image[:] = numpy.where( fragment_image, fragment_image, -max_label )
-                numpy.add( fragment_image, max_label, out=fragment_image )
-                result[:] = numpy.where( fragment_image, fragment_image, result )
-                
-                logger.info( "Finding new max label..." )
-                # New max
-                max_label = result.max()
-                
-                # Update mapping
-                old_max = self._mapping.keys()[-1][1]
-                body_id = slot.meta.selected_label
-                self._mapping[(old_max,max_label+1)] = body_id
-
-            logger.info( "Finished assembling final segmentation." )
+            offsets = self._getOffsets()
+            blockShape = self._blockShape()
+            pool = RequestPool()
+            for blockStart in getIntersectingBlocks( blockShape, (roi.start, roi.stop) ):
+                blockRoi = getBlockBounds( self.Output.meta.shape, blockShape, blockStart )
+                start, stop = getIntersection( blockRoi, (roi.start, roi.stop) )
+                pool.add( Request( partial(self._assembleBlock, offsets, start, stop, roi, result) ) )
+            pool.wait()
+            pool.clean()
             return result
         else:
             assert False, "Unknown output slot: {}".format( slot.name )
 
-    def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    def _assembleBlock(self, offsets, start, stop, roi, result):
+        block = result[ roiToSlice( start - roi.start, stop - roi.start ) ]
+        self.RavelerLabels(start, stop).writeInto( block ).wait()
 
+        # Allocate a temporary for our fragment images (one block only)
+        fragment_image = numpy.zeros( block.shape, dtype=numpy.uint32 )
+        for offset, slot in zip( offsets, self.FragmentSegmentations ):
+            slot(start, stop).writeInto( fragment_image ).wait()
+            fragment_pixels = fragment_image.nonzero()
+            block[fragment_pixels] = fragment_image[fragment_pixels] + offset
 
+    def propagateDirty(self, slot, subindex, roi):
+        self._offsets = None
+        self.Output.setDirty()
@@ -29,7 +29,7 @@ from lazyflow.operators.opReorderAxes import OpReorderAxes
 
 from lazyflow.utility import PathComponents
 from ilastik.utility import bind, log_exception
-from ilastik.applets.splitBodyPostprocessing.opSplitBodyPostprocessing import OpAccumulateFragmentSegmentations, OpMaskedWatershed
+from ilastik.applets.splitBodyPostprocessing.opSplitBodyPostprocessing import OpAccumulateFragmentSegmentations, OpMaskedWatershed, finalBlockShape
 
 import logging
 logger = logging.getLogger(__name__)
@@ -117,9 +117,14 @@ class OpSplitBodySupervoxelExport(Operator):
         self._opRelabeledMergedSupervoxelCaches.Input.connect( self._opRelabelMergedSupervoxels.Output )
         self.RelabeledSupervoxels.connect( self._opRelabeledMergedSupervoxelCaches.Output )
 
+        # The final supervoxels are assembled block by block, so the relabeled supervoxels are
+        #  cached again in bounded blocks (the caches above hold the entire volume).
+        self._opRelabeledSupervoxelBlockCaches = OperatorWrapper( OpCompressedCache, parent=self, broadcastingSlotNames=['BlockShape'] )
+        self._opRelabeledSupervoxelBlockCaches.Input.connect( self._opRelabeledMergedSupervoxelCaches.Output )
+
         self._opAccumulateFinalImage = OpAccumulateFragmentSegmentations( parent=self )
         self._opAccumulateFinalImage.RavelerLabels.connect( self.RavelerLabels )
-        self._opAccumulateFinalImage.FragmentSegmentations.connect( self._opRelabeledMergedSupervoxelCaches.Output )
+        self._opAccumulateFinalImage.FragmentSegmentations.connect( self._opRelabeledSupervoxelBlockCaches.Output )
         
         self._opFinalCache = OpCompressedCache( parent=self )
         self._opFinalCache.Input.connect( self._opAccumulateFinalImage.Output )
@@ -135,6 +140,11 @@ class OpSplitBodySupervoxelExport(Operator):
         for index, raveler_body_id in enumerate(raveler_bodies):
             self._opSelectLabel.SelectedLabel[index].setValue( raveler_body_id )
 
+        # Cache the final supervoxels (and the bodies they are assembled from) in bounded blocks
+        blockShape = finalBlockShape( self.RavelerLabels.meta )
+        self._opRelabeledSupervoxelBlockCaches.BlockShape.setValue( blockShape )
+        self._opFinalCache.BlockShape.setValue( blockShape )
+
     def execute(self, slot, subindex, roi, result):
         assert False, "Can't execute slot {}.  All slots should be connected to internal operators".format( slot.name )
 
@@ -142,10 +152,13 @@ class OpSplitBodySupervoxelExport(Operator):
         # If anything is dirty, the entire output is dirty
         self.FinalSupervoxels.setDirty()
 
-    def exportFinalSupervoxels(self, outputPath, axisorder, progressCallback=None):
+    def exportFinalSupervoxels(self, outputPath, axisorder, progressCallback=None, linkOriginalDatasets=False):
         """
         Executes the export process within a request.
         The (already-running) request is returned, in case you want to wait for it or monitor its progress.
+
+        :param linkOriginalDatasets: If True, the other datasets of the original segmentation file are
+            linked (as external links) instead of copied. (The export then depends on that file.)
         """
         assert self.FinalSupervoxels.ready(), "Can't export yet: The final segmentation isn't ready!"
 
@@ -176,32 +189,17 @@ class OpSplitBodySupervoxelExport(Operator):
             log_exception( logger, msg, exc_info )
 
         def handleFinished( result ):
-            # Generate the mapping transforms dataset
-            mapping = self._opAccumulateFinalImage.Mapping.value
-            num_labels = mapping.keys()[-1][1]
-            transform = numpy.zeros( shape=(num_labels, 2), dtype=numpy.uint32 )
-            for (start, stop), body_id in mapping.items():
-                for supervoxel_label in range(start, stop):
-                    transform[supervoxel_label][0] = supervoxel_label
-                    if body_id == -1:
-                        # Special case: -1 means "identity transform" for this supervoxel
-                        # (Which is really an untouched raveler body)
-                        transform[supervoxel_label][1] = supervoxel_label
-                    else:
-                        transform[supervoxel_label][1] = body_id
-
-            # Save the transform before closing the file
-            f.create_dataset('transforms', data=transform)
-
-            # Copy all other datasets from the original segmentation file.
-            ravelerSegmentationInfo = self.DatasetInfos[2].value
-            pathComponents = PathComponents(ravelerSegmentationInfo.filePath, self.WorkingDirectory.value)
-            with h5py.File(pathComponents.externalPath, 'r') as originalFile:
-                for k,dset in originalFile.items():
-                    if k not in ['transforms', 'stack']:
-                        f.copy(dset, k)
-            
             try:
+                # Generate the mapping transforms dataset (before closing the file)
+                mapping = self._opAccumulateFinalImage.Mapping.value
+                writeTransforms( f, 'transforms', mapping )
+
+                # Copy all other datasets from the original segmentation file.
+                ravelerSegmentationInfo = self.DatasetInfos[2].value
+                pathComponents = PathComponents(ravelerSegmentationInfo.filePath, self.WorkingDirectory.value)
+                copyOriginalDatasets( f, pathComponents.externalPath, exclude=['transforms', 'stack'],
+                                      link=linkOriginalDatasets )
+
                 cleanOps()
                 logger.info("FINISHED Final Supervoxel Export")
             finally:
@@ -253,5 +251,48 @@ class OpMaskedSelectUint32(Operator):
     def propagateDirty(self, slot, subindex, roi):
         pass
 
-
-
+#: Number of rows of the transforms table which are generated at once
+TRANSFORM_CHUNK_ROWS = 2**20
+
+def writeTransforms(f, name, mapping, chunkRows=TRANSFORM_CHUNK_ROWS):
+    """
+    Write the transforms table (supervoxel label -> body id) for the given
+    mapping, which maps consecutive label ranges (start, stop) to a body id
+    (or -1, for "identity": an untouched raveler body). The table is
+    generated chunk by chunk, so only one chunk is held in memory.
+    """
+    ranges = [ (start, stop, body_id) for (start, stop), body_id in mapping.items() if stop > start ]
+    starts = numpy.array( [r[0] for r in ranges], dtype=numpy.int64 )
+    body_ids = numpy.array( [r[2] for r in ranges], dtype=numpy.int64 )
+    num_labels = mapping.keys()[-1][1]
+
+    dataset = f.create_dataset( name, shape=(num_labels, 2), dtype=numpy.uint32,
+                                chunks=( max(1, min(chunkRows, num_labels)), 2 ) )
+    for chunk_start in range(0, num_labels, chunkRows):
+        labels = numpy.arange( chunk_start, min(chunk_start + chunkRows, num_labels), dtype=numpy.int64 )
+        # Index of the range each label falls into
+        range_index = numpy.searchsorted( starts, labels, side='right' ) - 1
+        chunk_body_ids = body_ids[range_index]
+        # Special case: -1 means "identity transform" for this supervoxel
+        chunk_body_ids = numpy.where( chunk_body_ids == -1, labels, chunk_body_ids )
+
+        transform = numpy.empty( (len(labels), 2), dtype=numpy.uint32 )
+        transform[:,0] = labels
+        transform[:,1] = chunk_body_ids
+        dataset[chunk_start:chunk_start+len(labels)] = transform
+    return dataset
+
+def copyOriginalDatasets(f, originalPath, exclude=(), link=False):
+    """
+    Copy the items of the original segmentation file (except those listed
+    in exclude) into f, or add external links to them if link is True.
+    Copies are made by hdf5 itself (H5Ocopy), which transfers the stored
+    chunks as they are, without decompressing and recompressing them.
+    """
+    with h5py.File(originalPath, 'r') as originalFile:
+        names = [ k for k in originalFile.keys() if k not in exclude ]
+        for k in names:
+            if link:
+                f[k] = h5py.ExternalLink( originalPath, k )
+            else:
+                f.copy( originalFile[k], k )
@@ -22,6 +22,7 @@
 
 # basic python modules
 import functools
+import collections
 import logging
 logger = logging.getLogger(__name__)
 from threading import Lock as ThreadLock
@@ -36,7 +37,7 @@ from lazyflow.operator import Operator
 from lazyflow.slot import InputSlot, OutputSlot
 from lazyflow.rtype import SubRegion
 from lazyflow.stype import Opaque
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request
 
 # required lazyflow operators
 from lazyflow.operators.opLabelVolume import OpLabelVolume
@@ -79,6 +80,9 @@ class OpObjectsSegment(OpGraphCut):
     # margin around each object (always xyz!)
     Margin = InputSlot(value=np.asarray((20, 20, 20)))
 
+    # RAM that the graph cuts of all concurrently processed objects may use
+    MemoryBudgetMb = InputSlot(value=1024)
+
     # bounding boxes of the labeled objects
     # this slot returns an array of dicts with shape (t, c)
     BoundingBoxes = OutputSlot(stype=Opaque)
@@ -95,6 +99,16 @@ class OpObjectsSegment(OpGraphCut):
     #Output = OutputSlot()
     #CachedOutput = OutputSlot()
 
+    # Objects with a bigger (enlarged) bounding box are not segmented, their
+    # seed is used instead.
+    MAXBOXSIZE = 10000000  # FIXME justification??
+
+    # Rough peak memory of segmentGC() per voxel of a bounding box: the
+    # opengm model holds one unary and three Potts factors per voxel, and
+    # the max-flow graph one node and three edges, plus the index arrays
+    # used to add the factors.
+    GRAPHCUT_BYTES_PER_VOXEL = 500
+
     def __init__(self, *args, **kwargs):
         super(OpObjectsSegment, self).__init__(*args, **kwargs)
 
@@ -159,7 +173,7 @@ class OpObjectsSegment(OpGraphCut):
 
         margin = self.Margin.value
         beta = self.Beta.value
-        MAXBOXSIZE = 10000000  # FIXME justification??
+        MAXBOXSIZE = self.MAXBOXSIZE
 
         ## request the bounding box coordinates ##
         # the trailing index brackets give us the dictionary (instead of an
@@ -186,8 +200,7 @@ class OpObjectsSegment(OpGraphCut):
         resultXYZ = vigra.taggedView(np.zeros(cc.shape, dtype=np.uint8),
                                      axistags='xyz')
 
-        def processSingleObject(i):
-            logger.debug("processing object {}".format(i))
+        def getBox(i):
             # maxs are inclusive, so we need to add 1
             xmin = max(mins[i][0]-margin[0], 0)
             ymin = max(mins[i][1]-margin[1], 0)
@@ -195,6 +208,11 @@ class OpObjectsSegment(OpGraphCut):
             xmax = min(maxs[i][0]+margin[0]+1, cc.shape[0])
             ymax = min(maxs[i][1]+margin[1]+1, cc.shape[1])
             zmax = min(maxs[i][2]+margin[2]+1, cc.shape[2])
+            return xmin, xmax, ymin, ymax, zmin, zmax
+
+        def processSingleObject(i):
+            logger.debug("processing object {}".format(i))
+            xmin, xmax, ymin, ymax, zmin, zmax = getBox(i)
             ccbox = cc[xmin:xmax, ymin:ymax, zmin:zmax]
             resbox = resultXYZ[xmin:xmax, ymin:ymax, zmin:zmax]
 
@@ -232,16 +250,22 @@ class OpObjectsSegment(OpGraphCut):
                 label = passed[1]  # 0 is background
                 resbox[ccsegm == label] = 1
 
-        pool = RequestPool()
-        #FIXME make sure that the parallel computations fit into memory
+        # Estimate the memory each graph cut needs, and process the largest
+        # boxes first: they can't end up as stragglers after everything else
+        # is finished.
+        tasks = []
         for i in range(1, nobj):
-            req = Request(functools.partial(processSingleObject, i))
-            pool.add(req)
+            xmin, xmax, ymin, ymax, zmin, zmax = getBox(i)
+            nVoxels = (xmax-xmin)*(ymax-ymin)*(zmax-zmin)
+            nbytes = 0
+            if nVoxels <= MAXBOXSIZE:
+                nbytes = nVoxels*self.GRAPHCUT_BYTES_PER_VOXEL
+            tasks.append((nbytes, functools.partial(processSingleObject, i)))
+        tasks.sort(key=lambda task: task[0], reverse=True)
 
         logger.info("Processing {} objects ...".format(nobj-1))
 
-        pool.wait()
-        pool.clean()
+        _runWithinMemoryBudget(tasks, self.MemoryBudgetMb.value*2**20)
 
         logger.info("object loop done")
 
@@ -272,3 +296,34 @@ class OpObjectsSegment(OpGraphCut):
         elif slot == self.Margin:
             # margin affects the whole volume
             self.Output.setDirty(slice(None))
+        elif slot == self.MemoryBudgetMb:
+            # only affects how the objects are scheduled
+            pass
+
+
+def _runWithinMemoryBudget(tasks, budget):
+    """
+    Run tasks, a list of (nbytes, callable) pairs, as requests in the given
+    order, but only start a task when the estimated memory of all running
+    tasks stays within budget (in bytes).  A task which exceeds the budget
+    on its own is run alone.
+    """
+    running = collections.deque()
+    used = 0
+    for nbytes, func in tasks:
+        nbytes = min(nbytes, budget)
+        # Waiting for a request (instead of, say, a condition variable) lets
+        # this thread work on other requests in the meantime.
+        while running and used + nbytes > budget:
+            req, reqbytes = running.popleft()
+            req.wait()
+            req.clean()
+            used -= reqbytes
+        req = Request(func)
+        req.submit()
+        running.append((req, nbytes))
+        used += nbytes
+
+    for req, _ in running:
+        req.wait()
+        req.clean()
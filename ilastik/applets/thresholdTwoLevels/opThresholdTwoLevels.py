@@ -43,7 +43,7 @@ from lazyflow.request import Request, RequestPool
 # local
 from thresholdingTools import OpAnisotropicGaussianSmoothing5d
 
-from thresholdingTools import OpSelectLabels
+from thresholdingTools import OpBlockwiseHysteresis
 
 from opGraphcutSegment import haveGraphCut
 
@@ -369,15 +369,24 @@ class _OpThresholdTwoLevels(Operator):
 
     # Schematic:
     #
-    #           HighThreshold                         MinSize,MaxSize                       --(cache)--> opColorize -> FilteredSmallLabels
-    #                   \                                       \                     /
-    #           opHighThresholder --> opHighLabeler --> opHighLabelSizeFilter                           Output
-    #          /                   \          /                 \                                            \                         /
-    # InputImage        --(cache)--> SmallRegions                    opSelectLabels -->opFinalLabelSizeFilter--> opCache --> CachedOutput
-    #          \                                                              /                                           /       \
-    #           opLowThresholder ----> opLowLabeler --------------------------                                       InputHdf5     --> OutputHdf5
-    #                   /                \                                                                                        -> CleanBlocks
-    #           LowThreshold            --(cache)--> BigRegions
+    #           HighThreshold                         MinSize,MaxSize     --(cache)--> opColorize -> FilteredSmallLabels
+    #                   \                                       \         /
+    #           opHighThresholder --> opHighLabeler --> opHighLabelSizeFilter      (debug output only)
+    #          /                   \
+    #         /                     --(cache)--> SmallRegions
+    #        /
+    # InputImage --> opHysteresis (blockwise, uses all thresholds and sizes) --> opCache --> CachedOutput
+    #        \                                                    \           /       \
+    #         \                                                    Output   InputHdf5    --> OutputHdf5
+    #          \                                                                         -> CleanBlocks
+    #           opLowThresholder --(cache)--> BigRegions
+    #                   /
+    #           LowThreshold
+
+    # Spatial extent of the blocks in which the hysteresis is computed (and
+    # cached).  Memory use is bounded by a few copies of such a block per
+    # worker thread, independent of the volume size.
+    BlockSize = 256
 
     def __init__(self, *args, **kwargs):
         super(_OpThresholdTwoLevels, self).__init__(*args, **kwargs)
@@ -388,9 +397,6 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighThresholder = OpPixelOperator(parent=self)
         self._opHighThresholder.Input.connect(self.InputImage)
 
-        self._opLowLabeler = OpLabelVolume(parent=self)
-        self._opLowLabeler.Input.connect(self._opLowThresholder.Output)
-
         self._opHighLabeler = OpLabelVolume(parent=self)
         self._opHighLabeler.Input.connect(self._opHighThresholder.Output)
 
@@ -401,27 +407,24 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighLabelSizeFilter.BinaryOut.setValue(False)  # we do the binarization in opSelectLabels
                                                                # this way, we get to display pretty colors
 
-        self._opSelectLabels = OpSelectLabels( parent=self )        
-        self._opSelectLabels.BigLabels.connect( self._opLowLabeler.CachedOutput )
-        self._opSelectLabels.SmallLabels.connect( self._opHighLabelSizeFilter.Output )
-
-        # remove the remaining very large objects -
-        # they might still be present in case a big object
-        # was split into many small ones for the higher threshold
-        # and they got reconnected again at lower threshold
-        self._opFinalLabelSizeFilter = OpFilterLabels( parent=self )
-        self._opFinalLabelSizeFilter.Input.connect(self._opSelectLabels.Output )
-        self._opFinalLabelSizeFilter.MinLabelSize.connect( self.MinSize )
-        self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
-        self._opFinalLabelSizeFilter.BinaryOut.setValue(False)
+        # Hysteresis and size filtering (including the removal of the
+        # remaining very large objects, which might still be present in case
+        # a big object was split into many small ones for the higher
+        # threshold and they got reconnected again at lower threshold)
+        self._opHysteresis = OpBlockwiseHysteresis( parent=self )
+        self._opHysteresis.Input.connect( self.InputImage )
+        self._opHysteresis.MinSize.connect( self.MinSize )
+        self._opHysteresis.MaxSize.connect( self.MaxSize )
+        self._opHysteresis.HighThreshold.connect( self.HighThreshold )
+        self._opHysteresis.LowThreshold.connect( self.LowThreshold )
 
         self._opCache = OpCompressedCache( parent=self )
         self._opCache.name = "_OpThresholdTwoLevels._opCache"
         self._opCache.InputHdf5.connect( self.InputHdf5 )
-        self._opCache.Input.connect( self._opFinalLabelSizeFilter.Output )
+        self._opCache.Input.connect( self._opHysteresis.Output )
 
         # Connect our own outputs
-        self.Output.connect( self._opFinalLabelSizeFilter.Output )
+        self.Output.connect( self._opHysteresis.Output )
         self.CachedOutput.connect( self._opCache.Output )
 
         # Serialization outputs
@@ -471,19 +474,20 @@ class _OpThresholdTwoLevels(Operator):
         self.Output.meta.assignFrom(self.InputImage.meta)
         self.Output.meta.dtype = numpy.uint8
 
-        # Blockshape is the entire spatial volume (hysteresis thresholding is
-        # a global operation)
-        tagged_shape = self.Output.meta.getTaggedShape()
+        # Hysteresis thresholding is a global operation, but
+        # opHysteresis merges the objects across blocks itself, so all
+        # caches can be blockwise.
+        tagged_shape = self.InputImage.meta.getTaggedShape()
         tagged_shape['c'] = 1
         tagged_shape['t'] = 1
-        self._opCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opBigRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opSmallRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opFilteredSmallLabelsCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
+        for key in 'xyz':
+            tagged_shape[key] = min(tagged_shape[key], self.BlockSize)
+        blockshape = tuple(tagged_shape.values())
+        self._opHysteresis.BlockShape.setValue(blockshape)
+        self._opCache.BlockShape.setValue(blockshape)
+        self._opBigRegionCache.BlockShape.setValue(blockshape)
+        self._opSmallRegionCache.BlockShape.setValue(blockshape)
+        self._opFilteredSmallLabelsCache.BlockShape.setValue(blockshape)
 
     def execute(self, slot, subindex, roi, result):
         assert False, "Shouldn't get here..."
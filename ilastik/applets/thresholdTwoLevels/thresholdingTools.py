@@ -23,6 +23,8 @@
 import gc
 import warnings
 import logging
+import threading
+import collections
 from functools import partial
 
 # Third-party
@@ -33,12 +35,14 @@ import psutil
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpFilterLabels, OpReorderAxes
-from lazyflow.roi import extendSlice, TinyVector
+from lazyflow.roi import extendSlice, TinyVector, getIntersectingBlocks,\
+    getBlockBounds, getIntersection, roiToSlice
 from lazyflow.rtype import SubRegion
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 
 # ilastik
 from lazyflow.utility.timer import Timer
+from ilastik.utility.unionFind import mergeLabels
 
 
 logger = logging.getLogger(__name__)
@@ -389,3 +393,259 @@ class OpSelectLabels(Operator):
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown input slot: {}".format(slot.name)
+
+
+class OpBlockwiseHysteresis(Operator):
+    """
+    Two-level (hysteresis) thresholding with size filtering, computed
+    block by block.
+
+    A low-threshold object is kept if it contains a high-threshold object
+    whose size is within [MinSize, MaxSize], and if its own size is within
+    [MinSize, MaxSize], too.  This is the same result as
+    OpLabelVolume -> OpFilterLabels -> OpSelectLabels -> OpFilterLabels,
+    but the connected components are labeled within each block and merged
+    across the block faces with a union-find, so no step needs more than
+    one block (plus the block faces) in memory.
+
+    The input must have 5 dimensions in 'txyzc' order.  The global label
+    tables are computed (in parallel over blocks) the first time a time
+    slice is requested and are dropped whenever any input changes.
+    """
+    name = "OpBlockwiseHysteresis"
+
+    Input = InputSlot()
+    MinSize = InputSlot(stype='int', value=0)
+    MaxSize = InputSlot(stype='int', value=1000000)
+    HighThreshold = InputSlot(stype='float', value=0.5)
+    LowThreshold = InputSlot(stype='float', value=0.2)
+
+    # 5d, 'txyzc'.  Only the spatial entries are used.
+    BlockShape = InputSlot()
+
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockwiseHysteresis, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._resetTables()
+
+    def setupOutputs(self):
+        assert "".join(self.Input.meta.getAxisKeys()) == 'txyzc',\
+            "Input must have 'txyzc' axes, not {}".format(
+                "".join(self.Input.meta.getAxisKeys()))
+        self.Output.meta.assignFrom(self.Input.meta)
+        self.Output.meta.dtype = numpy.uint32
+        self._resetTables()
+
+    def _resetTables(self):
+        with self._lock:
+            # Tables computed for an older generation are not stored anymore
+            self._generation += 1
+            self._tables = {}
+            self._tableLocks = collections.defaultdict(RequestLock)
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output
+        spatialRoi = (roi.start[1:4], roi.stop[1:4])
+        spatialShape = self.Input.meta.shape[1:4]
+        blockShape = self._spatialBlockShape()
+        blockStarts = getIntersectingBlocks(blockShape, spatialRoi)
+
+        pool = RequestPool()
+        for t in range(roi.start[0], roi.stop[0]):
+            for c in range(roi.start[4], roi.stop[4]):
+                tables = self._getTables(t, c)
+                for blockStart in blockStarts:
+                    blockRoi = getBlockBounds(spatialShape, blockShape, blockStart)
+                    pool.add(Request(partial(self._writeBlock, tables, t, c,
+                                             blockRoi, roi, result)))
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _writeBlock(self, tables, t, c, blockRoi, roi, result):
+        blockIndex, offsets, lut = tables
+        i = blockIndex[tuple(blockRoi[0])]
+        lowLabels = self._labelBlock(t, c, blockRoi, high=False)
+        blockLut = numpy.concatenate(([0], lut[offsets[i]+1:offsets[i+1]+1]))
+
+        spatialRoi = (roi.start[1:4], roi.stop[1:4])
+        intersection = getIntersection(blockRoi, spatialRoi)
+        source = numpy.subtract(intersection, blockRoi[0])
+        dest = numpy.subtract(intersection, spatialRoi[0])
+        result[(t - roi.start[0],) + roiToSlice(*dest) + (c - roi.start[4],)] = \
+            blockLut[lowLabels[roiToSlice(*source)]]
+
+    def _spatialBlockShape(self):
+        spatialShape = self.Input.meta.shape[1:4]
+        return tuple(numpy.minimum(self.BlockShape.value[1:4], spatialShape))
+
+    def _labelBlock(self, t, c, blockRoi, high=True):
+        """
+        Label the connected components of the low (and high) threshold mask
+        of one block.  The labels are local to the block and consecutive.
+        """
+        start, stop = blockRoi
+        data = self.Input((t,) + tuple(start) + (c,),
+                          (t+1,) + tuple(stop) + (c+1,)).wait()
+        data = numpy.asarray(data)[0, ..., 0]
+
+        lowThreshold, highThreshold = self.LowThreshold.value, self.HighThreshold.value
+        drange = self.Input.meta.drange
+        if drange is not None:
+            assert drange[0] == 0,\
+                "Don't know how to threshold data with this drange."
+            lowThreshold *= drange[1]
+            highThreshold *= drange[1]
+
+        lowLabels = vigra.analysis.labelVolumeWithBackground(
+            (data > lowThreshold).astype(numpy.uint8))
+        lowLabels = numpy.asarray(lowLabels)
+        if not high:
+            return lowLabels
+        highLabels = vigra.analysis.labelVolumeWithBackground(
+            (data > highThreshold).astype(numpy.uint8))
+        return lowLabels, numpy.asarray(highLabels)
+
+    def _getTables(self, t, c):
+        with self._lock:
+            tableLock = self._tableLocks[(t, c)]
+        with tableLock:
+            with self._lock:
+                tables = self._tables.get((t, c))
+                generation = self._generation
+            if tables is None:
+                tables = self._computeTables(t, c)
+                with self._lock:
+                    if generation == self._generation:
+                        self._tables[(t, c)] = tables
+        return tables
+
+    def _computeTables(self, t, c):
+        """
+        Label all blocks of one time slice and channel, and merge the labels
+        across block faces.
+
+        Returns (blockIndex, offsets, lut): Block i's local low-threshold
+        label l has the global id offsets[i] + l, and lut maps global ids to
+        the final output labels (0 for removed objects).
+        """
+        spatialShape = self.Input.meta.shape[1:4]
+        blockShape = self._spatialBlockShape()
+        blockStarts = getIntersectingBlocks(blockShape, ([0, 0, 0], spatialShape))
+        blockRois = [getBlockBounds(spatialShape, blockShape, start) for start in blockStarts]
+        blockIndex = dict((tuple(blockRoi[0]), i) for i, blockRoi in enumerate(blockRois))
+
+        nblocks = len(blockRois)
+        lowSizes = [None]*nblocks
+        highSizes = [None]*nblocks
+        overlaps = [None]*nblocks
+        # Faces are kept only until the block on the other side has been
+        # labeled, too.  Then they are reduced to the touching label pairs.
+        openFaces = {}
+        lowEdges = []
+        highEdges = []
+        lock = threading.Lock()
+
+        def processBlock(i):
+            start, stop = blockRois[i]
+            lowLabels, highLabels = self._labelBlock(t, c, blockRois[i])
+            lowSizes[i] = numpy.bincount(lowLabels.ravel())
+            highSizes[i] = numpy.bincount(highLabels.ravel())
+            overlaps[i] = _uniquePairs(highLabels, lowLabels)
+
+            for axis in range(3):
+                # An interface is identified by the start of the block
+                # above it and the axis.
+                faces = []
+                if start[axis] > 0:
+                    # We are the block above this interface
+                    faces.append((tuple(start), axis, True, 0))
+                if stop[axis] < spatialShape[axis]:
+                    # We are the block below this interface
+                    neighbor = list(start)
+                    neighbor[axis] = stop[axis]
+                    faces.append((tuple(neighbor), axis, False, -1))
+                for upperStart, axis, isUpper, index in faces:
+                    key = (upperStart, axis)
+                    face = (i, lowLabels.take(index, axis), highLabels.take(index, axis))
+                    with lock:
+                        other = openFaces.pop(key, None)
+                        if other is None:
+                            openFaces[key] = face
+                            continue
+                    lower, upper = (other, face) if isUpper else (face, other)
+                    pairs = (lower[0], upper[0],
+                             _uniquePairs(lower[1], upper[1]),
+                             _uniquePairs(lower[2], upper[2]))
+                    with lock:
+                        lowEdges.append(pairs[:2] + pairs[2:3])
+                        highEdges.append(pairs[:2] + pairs[3:4])
+
+        pool = RequestPool()
+        for i in range(nblocks):
+            pool.add(Request(partial(processBlock, i)))
+        pool.wait()
+        pool.clean()
+        assert not openFaces
+
+        lowOffsets = numpy.cumsum([0] + [len(sizes) - 1 for sizes in lowSizes])
+        highOffsets = numpy.cumsum([0] + [len(sizes) - 1 for sizes in highSizes])
+
+        def globalSizes(sizes):
+            return numpy.concatenate([[0]] + [s[1:] for s in sizes])
+
+        def globalEdges(edges, offsets):
+            result = [numpy.zeros((0, 2), dtype=numpy.int64)]
+            for lower, upper, pairs in edges:
+                result.append(pairs + (offsets[lower], offsets[upper]))
+            return numpy.concatenate(result)
+
+        lowRoot = mergeLabels(lowOffsets[-1] + 1, globalEdges(lowEdges, lowOffsets))
+        highRoot = mergeLabels(highOffsets[-1] + 1, globalEdges(highEdges, highOffsets))
+
+        minSize, maxSize = self.MinSize.value, self.MaxSize.value
+        lowComponentSizes = numpy.bincount(lowRoot, weights=globalSizes(lowSizes),
+                                           minlength=len(lowRoot))
+        highComponentSizes = numpy.bincount(highRoot, weights=globalSizes(highSizes),
+                                            minlength=len(highRoot))
+        highPassed = (highComponentSizes >= minSize) & (highComponentSizes <= maxSize)
+        highPassed[0] = False
+
+        # low components that contain a high component which passed the filter
+        overlaps = numpy.concatenate(
+            [numpy.zeros((0, 2), dtype=numpy.int64)] +
+            [pairs + (highOffsets[i], lowOffsets[i]) for i, pairs in enumerate(overlaps)])
+        selected = numpy.zeros(len(lowComponentSizes), dtype=bool)
+        passed = highPassed[highRoot[overlaps[:, 0]]]
+        selected[lowRoot[overlaps[passed, 1]]] = True
+
+        # remove the remaining very large objects, see _OpThresholdTwoLevels
+        selected &= (lowComponentSizes >= minSize) & (lowComponentSizes <= maxSize)
+        selected[0] = False
+
+        finalLabels = numpy.zeros(len(lowComponentSizes), dtype=numpy.uint32)
+        roots = numpy.nonzero(selected)[0]
+        finalLabels[roots] = numpy.arange(1, len(roots) + 1)
+        lut = finalLabels[lowRoot]
+        logger.debug("Hysteresis at t={}, c={}: {} blocks, {} objects".format(
+            t, c, nblocks, len(roots)))
+        return blockIndex, lowOffsets, lut
+
+    def propagateDirty(self, slot, subindex, roi):
+        # Hysteresis is global: any change can affect every block.
+        self._resetTables()
+        self.Output.setDirty(slice(None))
+
+
+def _uniquePairs(a, b):
+    """
+    Return the distinct pairs (a[i], b[i]) where both are nonzero, as an
+    array of shape (n, 2).
+    """
+    mask = (a != 0) & (b != 0)
+    keys = (a[mask].astype(numpy.int64) << 32) | b[mask].astype(numpy.int64)
+    keys = numpy.unique(keys)
+    return numpy.column_stack((keys >> 32, keys & 0xFFFFFFFF))
@@ -18,6 +18,7 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+from functools import partial
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
@@ -32,7 +33,8 @@ from ilastik.applets.base.applet import DatasetConstraintError
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.valueProviders import OpZeroDefault
 
-from lazyflow.roi import sliceToRoi
+from lazyflow.roi import sliceToRoi, roiToSlice
+from lazyflow.request import Request
 
 import logging
 logger = logging.getLogger(__name__)
@@ -55,7 +57,10 @@ class OpTrackingBase(Operator):
     OutputHdf5 = OutputSlot()
     CachedOutput = OutputSlot() # For the GUI (blockwise-access)
         
-    Output = OutputSlot()    
+    Output = OutputSlot()
+
+    #: number of timesteps prepared ahead while filling the traxel store
+    PREPARED_TIMESTEPS = 4
     
     def __init__(self, parent=None, graph=None):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)        
@@ -316,6 +321,22 @@ class OpTrackingBase(Operator):
                raise Exception, "Classifier not yet ready. Did you forget to train the Object Count Classifier?"
             detProbs = self.DetectionProbabilities(time_range).wait()
             
+        logger.info( "filtering objects" )
+        # The per-timestep work (filtering and, if needed, reading the label
+        # image for the coordinate lists) is independent, so it is done in parallel,
+        # a few timesteps ahead of the traxels being added to the store (in order).
+        # That bounds the number of label image frames held at once.
+        timesteps = feats.keys()
+        pending = {}
+        def prepare(i):
+            if i < len(timesteps):
+                t = timesteps[i]
+                pending[t] = Request( partial( self._prepare_traxels_at, t, feats[t], x_range, y_range, z_range, size_range,
+                                               with_opt_correction, with_coordinate_list and coordinate_map is not None ) )
+                pending[t].submit()
+        for i in range(self.PREPARED_TIMESTEPS):
+            prepare(i)
+
         logger.info( "filling traxelstore" )
         ts = pgmlink.TraxelStore()
                 
@@ -324,130 +345,69 @@ class OpTrackingBase(Operator):
         obj_sizes = []
         total_count = 0
         empty_frame = False
-        for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
-                
-            if with_opt_correction:
-                try:
-                    rc_corr = feats[t][config.features_vigra_name]['RegionCenter_corr']
-                except:
-                    raise Exception, 'cannot consider optical correction since it has not been computed before'
-                if rc_corr.size:
-                    rc_corr = rc_corr[1:,...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-
-            
-            logger.info( "at timestep {}, {} traxels found".format( t, rc.shape[0] ) )
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:                    
-                    x, y, z = rc[idx]
-                else:
-                    raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                    y < y_range[0] or y >= y_range[1] or
-                    z < z_range[0] or z >= z_range[1] or
-                    size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
+        for i, t in enumerate(timesteps):
+            ids, com, com_corr, sizes, filtered_labels_at, n_traxels, frame = pending.pop(t).wait()
+            prepare(i + self.PREPARED_TIMESTEPS)
+            count = len(ids)
+            logger.info( "at timestep {}, {} traxels found".format( t, n_traxels ) )
+            for idx, label in enumerate(ids):
                 tr = pgmlink.Traxel()
                 tr.set_x_scale(x_scale)
                 tr.set_y_scale(y_scale)
                 tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
+                tr.Id = label
                 tr.Timestep = t
 
                 # pgmlink expects always 3 coordinates, z=0 for 2d data
                 tr.add_feature_array("com", 3)
-                for i, v in enumerate([x,y,z]):
-                    tr.set_feature_value('com', i, float(v))            
+                for k, v in enumerate(com[idx]):
+                    tr.set_feature_value('com', k, v)
                 
                 if with_opt_correction:
                     tr.add_feature_array("com_corrected", 3)
-                    for i, v in enumerate(rc_corr[idx]):
-                        tr.set_feature_value("com_corrected", i, float(v))
-                    if len(rc_corr[idx]) == 2:
-                        tr.set_feature_value("com_corrected", 2, 0.)
+                    for k, v in enumerate(com_corr[idx]):
+                        tr.set_feature_value("com_corrected", k, v)
 
                 if with_div:
                     tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx+1][1]))
+                    # divProbs is indexed by label, i.e. it includes the background
+                    tr.set_feature_value("divProb", 0, float(divProbs[t][label][1]))
 
                 if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx+1]))
-                    for i, v in enumerate(detProbs[t][idx+1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(v))
-                        
+                    tr.add_feature_array("detProb", len(detProbs[t][label]))
+                    for k, v in enumerate(detProbs[t][label]):
+                        tr.set_feature_value("detProb", k, float(v))
                 
                 # FIXME: check whether it is 2d or 3d data!
                 if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx+1]))  
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx+1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx+1]))            
-                    for i, v in enumerate(localCenters[t][idx+1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))                
+                    tr.add_feature_array("localCentersX", len(localCenters[t][label]))  
+                    tr.add_feature_array("localCentersY", len(localCenters[t][label]))
+                    tr.add_feature_array("localCentersZ", len(localCenters[t][label]))            
+                    for k, v in enumerate(localCenters[t][label]):
+                        tr.set_feature_value("localCentersX", k, float(v[0]))
+                        tr.set_feature_value("localCentersY", k, float(v[1]))
+                        tr.set_feature_value("localCentersZ", k, float(v[2]))                
 
                 tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
+                tr.set_feature_value("count", 0, sizes[idx])
 
-                    
                 ts.add(tr)
 
                 # add coordinate lists
+                if frame is not None: # store coordinates in arma::mat
+                    labels, origin, lower, upper = frame
+                    image_excerpt = labels[roiToSlice(lower[idx] - origin, upper[idx] - origin)]
+                    pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx], tr)
+            # Release the label image frame before waiting for the next timestep
+            frame = labels = image_excerpt = None
 
-                if with_coordinate_list and coordinate_map is not None: # store coordinates in arma::mat
-                    # generate roi: assume the following order: txyzc
-                    n_dim = len(rc[idx])
-                    roi = [0]*5
-                    roi[0] = slice(int(t), int(t+1))
-                    roi[1] = slice(int(lower[idx][0]), int(upper[idx][0] + 1))
-                    roi[2] = slice(int(lower[idx][1]), int(upper[idx][1] + 1))
-                    if n_dim == 3:
-                        roi[3] = slice(int(lower[idx][2]), int(upper[idx][2] + 1))
-                    else:
-                        assert n_dim == 2
-                    image_excerpt = self.LabelImage[roi].wait()
-                    if n_dim == 2:
-                        image_excerpt = image_excerpt[0, ..., 0, 0]
-                    elif n_dim ==3:
-                        image_excerpt = image_excerpt[0, ..., 0]
-                    else:
-                        raise Exception, "n_dim = %s instead of 2 or 3"
-
-                    pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx].astype(np.int64), tr)
-                    
+            if median_object_size is not None:
+                obj_sizes.extend(sizes)
             
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t)-time_range[0])] = filtered_labels_at
             logger.info( "at timestep {}, {} traxels passed filter".format(t, count) )
-            max_traxel_id_at.append(int(rc.shape[0]))
+            max_traxel_id_at.append(n_traxels)
             if count == 0:
                 empty_frame = True
                 
@@ -461,4 +421,78 @@ class OpTrackingBase(Operator):
         
         return ts, empty_frame
 
-    
+    def _prepare_traxels_at(self, t, feats_at, x_range, y_range, z_range, size_range,
+                            with_opt_correction=False, with_coordinate_list=False):
+        """
+        Filter the objects of timestep t by position and size, and collect
+        the values needed to fill their traxels, for all objects at once.
+
+        Returns (ids, com, com_corrected, sizes, filtered_labels, n_traxels, frame),
+        where ids, com, com_corrected and sizes only cover the objects which
+        passed the filter and are plain python lists, so that filling the
+        traxels does not touch numpy scalars. frame is None unless
+        with_coordinate_list is set, in which case it is
+        (labels, origin, lower, upper): the label image of the bounding box
+        of all passing objects, its global offset and the per-object bounding
+        boxes (upper exclusive), in global coordinates.
+        """
+        rc = feats_at[default_features_key]['RegionCenter']
+        lower = feats_at[default_features_key]['Coord<Minimum>']
+        upper = feats_at[default_features_key]['Coord<Maximum>']
+        ct = feats_at[default_features_key]['Count']
+        if rc.size:
+            rc = rc[1:, ...]
+            lower = lower[1:, ...]
+            upper = upper[1:, ...]
+            ct = ct[1:, ...]
+        n_traxels = int(rc.shape[0])
+
+        if with_opt_correction:
+            try:
+                rc_corr = feats_at[config.features_vigra_name]['RegionCenter_corr']
+            except:
+                raise Exception, 'cannot consider optical correction since it has not been computed before'
+            if rc_corr.size:
+                rc_corr = rc_corr[1:,...]
+
+        if n_traxels == 0:
+            return [], [], [], [], [], 0, None
+
+        n_dim = rc.shape[1]
+        if n_dim not in (2, 3):
+            raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
+
+        # pgmlink expects always 3 coordinates, z=0 for 2d data
+        com = np.zeros((n_traxels, 3), dtype=np.float64)
+        com[:, :n_dim] = rc
+        sizes = np.asarray(ct, dtype=np.float64).reshape(n_traxels, -1)[:, 0]
+
+        x, y, z = com.T
+        rejected = ((x < x_range[0]) | (x >= x_range[1]) |
+                    (y < y_range[0]) | (y >= y_range[1]) |
+                    (z < z_range[0]) | (z >= z_range[1]) |
+                    (sizes < size_range[0]) | (sizes >= size_range[1]))
+        passed = np.flatnonzero(~rejected)
+        filtered_labels = (np.flatnonzero(rejected) + 1).tolist()
+
+        com_corrected = []
+        if with_opt_correction:
+            com_corrected = np.zeros((len(passed), 3), dtype=np.float64)
+            com_corrected[:, :rc_corr.shape[1]] = rc_corr[passed]
+            com_corrected = com_corrected.tolist()
+
+        frame = None
+        if with_coordinate_list and len(passed) > 0:
+            # read the label image once per timestep instead of once per object
+            # roi order: txyzc
+            lower = np.asarray(lower[passed], dtype=np.int64)
+            upper = np.asarray(upper[passed], dtype=np.int64) + 1
+            origin = lower.min(axis=0)
+            start = [t] + list(origin) + [0]*(4 - n_dim)
+            stop = [t+1] + list(upper.max(axis=0)) + [1]*(4 - n_dim)
+            labels = self.LabelImage(start, stop).wait()
+            labels = labels.reshape(labels.shape[1:n_dim+1])
+            frame = (labels, origin, lower, upper)
+
+        return ((passed + 1).tolist(), com[passed].tolist(), com_corrected,
+                sizes[passed].tolist(), filtered_labels, n_traxels, frame)
@@ -0,0 +1,369 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+A watershed of the whole volume, computed block by block.
+
+Each block is watershedded (in 3D) together with a halo of its neighbors.
+The labels of the blocks are made consistent by a global pass, which
+compares the labels on either side of each seam between neighboring blocks:
+a block's labels in its halo, just across the seam, are matched to the
+neighbor's own labels there, and matching labels are merged.
+
+The blocks' labels are kept (compressed) together with their seams and
+the label mapping, up to MAX_KEPT_BYTES of compressed labels. Blocks past
+that budget are watershedded again whenever they are requested.
+
+Memory: Besides the kept labels, every block keeps its seams (one uint32
+layer per inner face, i.e. up to six), and the mapping has one uint32
+entry per label before merging. Both grow with the volume,
+but are much smaller than its labels.
+"""
+import threading
+import zlib
+from functools import partial
+
+import numpy
+import vigra
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice, roiFromShape
+
+import logging
+logger = logging.getLogger(__name__)
+
+class OpBlockwiseWatershed(Operator):
+    """
+    Watershed labels of the whole volume, consistent across blocks.
+
+    With seeds, the labels are the seed labels, except for regions of blocks
+    with no seeds in reach, which get new labels (above the largest seed label).
+    Without seeds, the labels are numbered consecutively.
+    """
+    InputImage = InputSlot() # Single channel
+    SeedImage = InputSlot(optional=True)
+    BlockShape = InputSlot(value=256) # Edge length along each spatial axis
+    Halo = InputSlot(value=10) # At least 1
+
+    Output = OutputSlot()
+
+    #: zlib compression level of the block labels kept in memory
+    COMPRESSION_LEVEL = 1
+
+    #: Budget for the compressed labels of all blocks, in bytes.
+    #: The labels of the blocks which don't fit are recomputed when needed.
+    MAX_KEPT_BYTES = 256 * 2**20
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockwiseWatershed, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._computeLock = RequestLock()
+        self._generation = 0
+        self._seams = None
+        self._mapping = None
+
+    def setupOutputs(self):
+        assert self.InputImage.meta.getTaggedShape().get('c', 1) == 1, "Watershed input must have a single channel"
+        self.Output.meta.assignFrom( self.InputImage.meta )
+        self.Output.meta.dtype = numpy.uint32
+        self.Output.meta.drange = None
+        self._reset()
+
+    def _reset(self):
+        with self._lock:
+            # A mapping still being computed for an older generation is not stored
+            self._generation += 1
+            self._seams = None
+            self._mapping = None
+
+    def _blockShape(self):
+        edge = self.BlockShape.value
+        return tuple( edge if k in 'xyz' else 1 for k in self.InputImage.meta.getAxisKeys() )
+
+    def _blockStarts(self):
+        shape = self.InputImage.meta.shape
+        return getIntersectingBlocks( self._blockShape(), roiFromShape(shape) )
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output
+        seams, mapping = self._getMapping()
+
+        pool = RequestPool()
+        for blockStart in getIntersectingBlocks( self._blockShape(), (roi.start, roi.stop) ):
+            pool.add( Request( partial(self._writeBlock, seams, mapping, blockStart, roi, result) ) )
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _getMapping(self):
+        with self._computeLock:
+            with self._lock:
+                seams, mapping = self._seams, self._mapping
+                generation = self._generation
+            if mapping is None:
+                seams, mapping = self._computeMapping()
+                with self._lock:
+                    if generation == self._generation:
+                        self._seams, self._mapping = seams, mapping
+        return seams, mapping
+
+    def _writeBlock(self, seams, mapping, blockStart, roi, result):
+        blockRoi = getBlockBounds( self.InputImage.meta.shape, self._blockShape(), blockStart )
+        blockSeams = seams[ tuple(blockStart) ]
+        labels = blockSeams.blockLabels()
+        if labels is None:
+            # The labels weren't kept, so the block is watershedded again
+            paddedLabels, _ = self._watershedBlock( blockRoi )
+            labels = paddedLabels[ self._innerSlicing( blockRoi ) ]
+        if not blockSeams.seeded:
+            labels += numpy.uint32(blockSeams.offset)
+        start, stop = getIntersection( blockRoi, (roi.start, roi.stop) )
+        result[ roiToSlice( start - roi.start, stop - roi.start ) ] = \
+            mapping[ labels[ roiToSlice( start - blockRoi[0], stop - blockRoi[0] ) ] ]
+
+    def _paddedRoi(self, blockRoi):
+        halo = max( 1, self.Halo.value )
+        keys = self.InputImage.meta.getAxisKeys()
+        padding = numpy.array( [ halo if k in 'xyz' else 0 for k in keys ] )
+        start = numpy.maximum( blockRoi[0] - padding, 0 )
+        stop = numpy.minimum( blockRoi[1] + padding, self.InputImage.meta.shape )
+        return start, stop
+
+    def _innerSlicing(self, blockRoi):
+        """
+        The block within its padded labels.
+        """
+        start, _ = self._paddedRoi( blockRoi )
+        return roiToSlice( blockRoi[0] - start, blockRoi[1] - start )
+
+    def _watershedBlock(self, blockRoi):
+        """
+        Watershed the block with its halo.
+        Returns the labels of the padded block (with all axes of the input),
+        and whether they are seed labels (as opposed to labels of this block only).
+        """
+        start, stop = self._paddedRoi( blockRoi )
+        keys = self.InputImage.meta.getAxisKeys()
+        spatial = tuple( i for i, k in enumerate(keys) if k in 'xyz' )
+        # Drop the non-spatial (singleton) axes
+        squeeze = tuple( slice(None) if i in spatial else 0 for i in range(len(keys)) )
+        spatialKeys = ''.join( keys[i] for i in spatial )
+
+        image = self.InputImage( start, stop ).wait()[squeeze]
+        image = vigra.taggedView( image.astype(numpy.float32), spatialKeys )
+
+        seeds = None
+        if self.SeedImage.ready():
+            seeds = self.SeedImage( start, stop ).wait()[squeeze]
+            if seeds.any():
+                seeds = vigra.taggedView( seeds.astype(numpy.uint32), spatialKeys )
+            else:
+                seeds = None
+
+        labels, _ = vigra.analysis.watershedsNew( image, seeds=seeds )
+        labels = labels.withAxes( *spatialKeys ).view( numpy.ndarray ).astype( numpy.uint32 )
+        labels = labels.reshape( tuple( numpy.subtract( stop, start ) ) )
+        return labels, seeds is not None
+
+    def _computeMapping(self):
+        """
+        Watershed all blocks (in parallel), keeping their seams and (within
+        MAX_KEPT_BYTES) their compressed labels, and merge the labels which
+        match across the seams.
+        Returns the seams of all blocks and the mapping of their labels.
+        """
+        allSeams = {}
+        keptBytes = [0]
+        lock = threading.Lock()
+        def collectSeams(blockStart):
+            seams = self._blockSeams( blockStart )
+            with lock:
+                allSeams[ tuple(blockStart) ] = seams
+                if keptBytes[0] + seams.compressedSize() > self.MAX_KEPT_BYTES:
+                    seams.dropLabels()
+                else:
+                    keptBytes[0] += seams.compressedSize()
+
+        pool = RequestPool()
+        for blockStart in self._blockStarts():
+            pool.add( Request( partial(collectSeams, blockStart) ) )
+        pool.wait()
+        pool.clean()
+
+        # Labels of unseeded blocks come after all seed labels
+        maxSeedLabel = max( [0] + [ s.maxLabel for s in allSeams.values() if s.seeded ] )
+        offset = maxSeedLabel
+        for key in sorted( allSeams.keys() ):
+            seams = allSeams[key]
+            if not seams.seeded:
+                seams.offset = offset
+                offset += seams.maxLabel
+
+        pairs = []
+        blockShape = self._blockShape()
+        for key, seams in allSeams.items():
+            for axis, haloLayer in seams.upper.items():
+                neighborKey = list(key)
+                neighborKey[axis] += blockShape[axis]
+                neighbor = allSeams[ tuple(neighborKey) ]
+                pairs.append( _matchingLabels( seams.globalLabels( haloLayer ),
+                                               neighbor.globalLabels( neighbor.lower[axis] ),
+                                               maxSeedLabel ) )
+        mapping = _mergeLabels( offset, pairs, maxSeedLabel )
+        logger.debug( "Blockwise watershed: {} labels before and {} after merging across seams"
+                      .format( offset, len( numpy.unique( mapping[1:] ) ) ) )
+        logger.debug( "Blockwise watershed: kept {} bytes of labels, {} of {} blocks will be recomputed"
+                      .format( keptBytes[0], sum( 1 for s in allSeams.values() if s.compressedSize() == 0 ),
+                               len(allSeams) ) )
+        return allSeams, mapping
+
+    def _blockSeams(self, blockStart):
+        blockRoi = getBlockBounds( self.InputImage.meta.shape, self._blockShape(), blockStart )
+        labels, seeded = self._watershedBlock( blockRoi )
+        paddedStart, _ = self._paddedRoi( blockRoi )
+        inner = self._innerSlicing( blockRoi )
+        innerLabels = numpy.ascontiguousarray( labels[inner] )
+        seams = _BlockSeams( int(labels.max()), seeded, innerLabels.shape,
+                             zlib.compress( innerLabels.data, self.COMPRESSION_LEVEL ) )
+
+        for axis, key in enumerate( self.InputImage.meta.getAxisKeys() ):
+            if key not in 'xyz':
+                continue
+            # The block's first layer along the axis
+            if blockRoi[0][axis] > 0:
+                layer = list(inner)
+                layer[axis] = blockRoi[0][axis] - paddedStart[axis]
+                seams.lower[axis] = labels[ tuple(layer) ].copy()
+            # The layer of the halo just past the block (the neighbor's first layer)
+            if blockRoi[1][axis] < self.InputImage.meta.shape[axis]:
+                layer = list(inner)
+                layer[axis] = blockRoi[1][axis] - paddedStart[axis]
+                seams.upper[axis] = labels[ tuple(layer) ].copy()
+        return seams
+
+    def propagateDirty(self, slot, subindex, roi):
+        # The labels anywhere may change when the merging changes
+        self._reset()
+        self.Output.setDirty( slice(None) )
+
+class _BlockSeams(object):
+    """
+    The labels of a block at its seams with the neighboring blocks.
+    ``lower[axis]`` is the block's first layer along the axis, and
+    ``upper[axis]`` is the layer of the halo just past the block.
+    The labels of the whole block (without its halo) are kept compressed,
+    unless they are dropped.
+    """
+    def __init__(self, maxLabel, seeded, shape, compressedLabels):
+        self.maxLabel = maxLabel
+        self.seeded = seeded
+        self.offset = 0
+        self.lower = {}
+        self.upper = {}
+        self._shape = shape
+        self._compressedLabels = compressedLabels
+
+    def compressedSize(self):
+        if self._compressedLabels is None:
+            return 0
+        return len(self._compressedLabels)
+
+    def dropLabels(self):
+        self._compressedLabels = None
+
+    def blockLabels(self):
+        """
+        The (block-local) labels of the block, as a new array,
+        or None if they were dropped.
+        """
+        if self._compressedLabels is None:
+            return None
+        labels = numpy.fromstring( zlib.decompress( self._compressedLabels ), dtype=numpy.uint32 )
+        return labels.reshape( self._shape )
+
+    def globalLabels(self, layer):
+        if self.seeded:
+            return layer
+        return layer + numpy.uint32(self.offset)
+
+def _majority(a, b):
+    """
+    For each distinct label in a, the label of b which it overlaps most.
+    """
+    order = numpy.lexsort( (b, a) )
+    a, b = a[order], b[order]
+    pairStarts = numpy.flatnonzero( numpy.append( True, (a[1:] != a[:-1]) | (b[1:] != b[:-1]) ) )
+    counts = numpy.diff( numpy.append( pairStarts, len(a) ) )
+    pairA, pairB = a[pairStarts], b[pairStarts]
+    # Sort the pairs by label, then count: the last pair of each label wins
+    order = numpy.lexsort( (counts, pairA) )
+    pairA, pairB = pairA[order], pairB[order]
+    last = numpy.append( pairA[1:] != pairA[:-1], True )
+    return pairA[last], pairB[last]
+
+def _matchingLabels(a, b, maxSeedLabel):
+    """
+    The pairs of labels to merge, given the labels of two blocks on the same
+    layer: each label is merged with the label it overlaps most on the other
+    side. Seed labels are never merged with each other.
+    """
+    a = a.ravel()
+    b = b.ravel()
+    keep = (a != 0) & (b != 0)
+    a, b = a[keep], b[keep]
+    if len(a) == 0:
+        return numpy.zeros( (0,2), dtype=numpy.uint32 )
+    pairs = numpy.concatenate( [ numpy.transpose( _majority(a, b) ),
+                                 numpy.transpose( _majority(b, a)[::-1] ) ] )
+    return pairs[ (pairs[:,0] > maxSeedLabel) | (pairs[:,1] > maxSeedLabel) ]
+
+def _mergeLabels(maxLabel, pairs, maxSeedLabel):
+    """
+    The mapping (as an array) from all labels up to maxLabel to the merged
+    labels. Merged sets which contain a seed label get that label (there is
+    at most one in each set), the other sets are numbered consecutively
+    after the seed labels.
+    """
+    parents = {}
+    def find(label):
+        root = label
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while label != root:
+            parents[label], label = root, parents[label]
+        return root
+
+    for a, b in ( numpy.concatenate( pairs ) if pairs else () ):
+        rootA, rootB = find(int(a)), find(int(b))
+        # A set's root is its smallest label, so sets with a seed label have it as
+        # their root. Two seed labels are never merged (not even through other labels).
+        if rootA != rootB and max(rootA, rootB) > maxSeedLabel:
+            parents[ max(rootA, rootB) ] = min(rootA, rootB)
+
+    mapping = numpy.arange( maxLabel + 1, dtype=numpy.uint32 )
+    for label in parents.keys():
+        mapping[label] = find(label)
+
+    # Number the remaining (unseeded) labels consecutively
+    unseeded = mapping > maxSeedLabel
+    roots, inverse = numpy.unique( mapping[unseeded], return_inverse=True )
+    mapping[unseeded] = maxSeedLabel + 1 + inverse
+    return mapping
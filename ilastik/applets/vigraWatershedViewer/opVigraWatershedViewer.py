@@ -24,6 +24,8 @@ from lazyflow.operators import OpSlicedBlockedArrayCache, OpMultiArraySlicer2, O
 
 from lazyflow.operators import OpVigraWatershed, OpColorizeLabels, OpVigraLabelVolume, OpFilterLabels
 
+from opBlockwiseWatershed import OpBlockwiseWatershed
+
 import numpy
 import vigra
 from functools import partial
@@ -45,6 +47,8 @@ class OpVigraWatershedViewer(Operator):
     OverrideLabels = InputSlot(stype='object') # opColorizer
     SeedThresholdValue = InputSlot(optional=True) # opThreshold
     MinSeedSize = InputSlot() # opSeedLabeler
+    BlockwiseWatershed = InputSlot(value=False) # Use opBlockwiseWatershed (3D, whole volume) instead of opWatershed
+    WatershedBlockShape = InputSlot(value=256) # opBlockwiseWatershed block edge length
     
     WatershedLabels = OutputSlot()  # Watershed labeled output
     SummedInput = OutputSlot()      # Watershed input (for gui display)
@@ -69,11 +73,14 @@ class OpVigraWatershedViewer(Operator):
         # SeedThresholdValue ---                   MinSeedSize ---                    /
         #                       \                                 \                  /
         # InputImage ----------> opThreshold --> opSeedLabeler --> opSeedFilter ----- ---> opSeedCache --> opSeedColorizer --> GUI
+        #
+        # If BlockwiseWatershed is set, opBlockwiseWatershed takes the place of opWatershed.
         
         # Create operators
         self.opChannelSlicer = OpMultiArraySlicer2(parent=self)
         self.opAverage = OpMultiArrayMerger(parent=self)
         self.opWatershed = OpVigraWatershed(parent=self)
+        self.opBlockwiseWatershed = OpBlockwiseWatershed(parent=self)
         self.opWatershedCache = OpSlicedBlockedArrayCache(parent=self)
         self.opColorizer = OpColorizeLabels(parent=self)
         
@@ -119,9 +126,13 @@ class OpVigraWatershedViewer(Operator):
         self.opWatershed.InputImage.connect( self.opAverage.Output )
         self.opWatershed.PaddingWidth.connect( self.WatershedPadding )
 
+        # Or compute them for the whole volume, block by block (see setupOutputs)
+        self.opBlockwiseWatershed.InputImage.connect( self.opAverage.Output )
+        self.opBlockwiseWatershed.Halo.connect( self.WatershedPadding )
+        self.opBlockwiseWatershed.BlockShape.connect( self.WatershedBlockShape )
+
         # Cache the watershed output
         self.opWatershedCache.fixAtCurrent.connect( self.FreezeCache )
-        self.opWatershedCache.Input.connect(self.opWatershed.Output)
 
         # Colorize the watershed labels for RGB display        
         self.opColorizer.Input.connect( self.opWatershedCache.Output )
@@ -134,6 +145,14 @@ class OpVigraWatershedViewer(Operator):
         self.ColoredSeeds.connect( self.opSeedColorizer.Output )
         
     def setupOutputs(self):
+        # The slice-wise watershed or the blockwise 3D watershed
+        if self.BlockwiseWatershed.value:
+            watershedOutput = self.opBlockwiseWatershed.Output
+        else:
+            watershedOutput = self.opWatershed.Output
+        if self.opWatershedCache.Input.partner is not watershedOutput:
+            self.opWatershedCache.Input.connect( watershedOutput )
+
         # User has control over cache block shape
         # Width and depth are applied to x,y, or z depending on which slicing view is being used.
         width, depth = self.CacheBlockShape.value
@@ -189,8 +208,10 @@ class OpVigraWatershedViewer(Operator):
                 
                 self.opThreshold.Function.setValue( lambda a: (a <= seedThreshold).astype(numpy.uint8) )
                 self.opWatershed.SeedImage.connect( self.opSeedFilter.Output )
+                self.opBlockwiseWatershed.SeedImage.connect( self.opSeedFilter.Output )
         else:
             self.opWatershed.SeedImage.disconnect()
+            self.opBlockwiseWatershed.SeedImage.disconnect()
             self.opThreshold.Function.disconnect()
 
     def propagateDirty(self, slot, subindex, roi):
@@ -222,12 +243,13 @@ if __name__ == "__main__":
     op.OverrideLabels.setValue({})
     op.SeedThresholdValue.setValue(0)
     op.MinSeedSize.setValue(5)
+    op.BlockwiseWatershed.setValue(True)
     
     assert op.WatershedLabels.ready()
     
     print "Computing watershed..."
     with Timer() as timer:
-        watershed_labels = op.opWatershed.Output[:].wait()
+        watershed_labels = op.opBlockwiseWatershed.Output[:].wait()
     print "Computing watershed took {} seconds".format( timer.seconds() )
     
     print "Saving watershed..."
@@ -37,7 +37,7 @@ class VigraWatershedViewerApplet( StandardApplet ):
 
     @property
     def broadcastingSlots(self):
-        return ['InputChannelIndexes', 'WatershedPadding', 'FreezeCache', 'CacheBlockShape', 'SeedThresholdValue', 'MinSeedSize' ]
+        return ['InputChannelIndexes', 'WatershedPadding', 'FreezeCache', 'CacheBlockShape', 'SeedThresholdValue', 'MinSeedSize', 'BlockwiseWatershed', 'WatershedBlockShape' ]
     
     @property
     def singleLaneGuiClass(self):
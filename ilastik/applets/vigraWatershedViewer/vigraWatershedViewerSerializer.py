@@ -31,7 +31,9 @@ class VigraWatershedViewerSerializer(AppletSerializer):
                  SerialSlot(operator.FreezeCache, selfdepends=True),
                  SerialSlot(operator.CacheBlockShape, selfdepends=True),
                  SerialSlot(operator.SeedThresholdValue, selfdepends=True),
-                 SerialSlot(operator.MinSeedSize, selfdepends=True) ]
+                 SerialSlot(operator.MinSeedSize, selfdepends=True),
+                 SerialSlot(operator.BlockwiseWatershed, selfdepends=True),
+                 SerialSlot(operator.WatershedBlockShape, selfdepends=True) ]
         
         super(VigraWatershedViewerSerializer, self).__init__(projectFileGroupName,
                                                              slots=slots)
@@ -35,6 +35,9 @@ ClusterConfigFields = \
     "task_parallel_subrequests" : AutoEval(int),
     "task_threadpool_size" : AutoEval(int),
     "task_timeout_secs" : AutoEval(int),
+    "task_max_retries" : AutoEval(int),
+    "task_poll_interval_secs" : AutoEval(float),
+    "num_local_workers" : AutoEval(int),
     "use_node_local_scratch" : bool,
     "use_master_local_scratch" : bool,
     "node_output_compression_cmd" :   FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
@@ -44,6 +47,7 @@ ClusterConfigFields = \
     "output_log_directory" : str,
     "server_working_directory" : str,
     "command_format" : FormattedField( requiredFields=["task_args"], optionalFields=["task_name"] ),
+    "task_launcher_detaches" : bool, # The command only submits the task (e.g. qsub) and exits right away
     "debug_option_use_previous_node_files" : bool
 }
 
@@ -20,10 +20,11 @@
 ###############################################################################
 import os
 import copy
+import time
+import signal
 import subprocess
 import collections
 import hashlib
-import functools
 
 import numpy
 
@@ -148,6 +149,175 @@ class OpTaskWorker(Operator):
             secondary_result = slot( *sub_block_roi ).wait()
             fileset.writeData( sub_block_roi, secondary_result )
 
+class ClusterTaskScheduler(object):
+    """
+    Launches one task per block and watches the tasks until every block is
+    finished, failed, or out of retries.
+
+    Tasks are launched via launchFunc(taskInfo), which returns either a
+    process handle (anything with poll() and kill(), e.g. subprocess.Popen)
+    or None if the task runs somewhere we can't watch (e.g. a queued cluster
+    job).  In either case, a block only counts as finished once
+    isBlockDone(roi) says so, i.e. once the worker has marked it AVAILABLE
+    in the output BlockwiseFileset.  A task whose process exits before that,
+    or which runs longer than timeoutSecs, is retried up to maxRetries times.
+
+    If launcherDetaches is set, the launched process only submits the task
+    (e.g. qsub) and exits right away.  Once it has exited successfully, the
+    task is watched like one without a handle.
+
+    The timeout of a task we can't watch is counted from the moment
+    isBlockStarted(roi) first says its block is being worked on, so a job
+    which waits in the cluster's queue doesn't time out.  (Without
+    isBlockStarted, it is counted from the launch.)
+
+    At most maxParallel tasks are in flight at once.  Whenever one of them
+    finishes, the next pending block is launched, so a slow block never
+    holds up the others.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    class TaskState(object):
+        def __init__(self, taskInfo):
+            self.taskInfo = taskInfo
+            self.status = ClusterTaskScheduler.PENDING
+            self.attempts = 0
+            self.handle = None
+            self.launchTime = None
+            self.startTime = None # When the block was first seen in progress (for tasks without a handle)
+
+    def __init__(self, launchFunc, isBlockDone, maxParallel=None, maxRetries=0, timeoutSecs=None, pollIntervalSecs=1.0,
+                 isBlockStarted=None, launcherDetaches=False):
+        self._launchFunc = launchFunc
+        self._isBlockDone = isBlockDone
+        self._isBlockStarted = isBlockStarted
+        self._launcherDetaches = launcherDetaches
+        self._maxParallel = maxParallel
+        self._maxRetries = maxRetries
+        self._timeoutSecs = timeoutSecs
+        self._pollIntervalSecs = pollIntervalSecs
+        self.progressSignal = OrderedSignal()
+        self.taskStates = collections.OrderedDict()
+
+    def run(self, taskInfos):
+        """
+        Run all tasks in taskInfos (a dict of roi : TaskInfo) to completion.
+        Returns True if all blocks were finished.
+        """
+        self.taskStates = collections.OrderedDict( (roi, ClusterTaskScheduler.TaskState(taskInfo))
+                                                   for roi, taskInfo in taskInfos.items() )
+        pending = collections.deque( self.taskStates.keys() )
+        running = []
+        maxParallel = self._maxParallel or len(pending)
+        numFinished = 0
+
+        while pending or running:
+            for roi in list(running):
+                state = self.taskStates[roi]
+                self._updateState( roi, state )
+                if state.status == ClusterTaskScheduler.RUNNING:
+                    continue
+                running.remove( roi )
+                if state.status == ClusterTaskScheduler.PENDING:
+                    pending.append( roi )
+                else:
+                    numFinished += 1
+                    self.progressSignal( 100 * numFinished / len(self.taskStates) )
+
+            while pending and len(running) < maxParallel:
+                roi = pending.popleft()
+                self._launch( self.taskStates[roi] )
+                running.append( roi )
+
+            if running:
+                time.sleep( self._pollIntervalSecs )
+
+        failed = self.failedRois()
+        for roi in failed:
+            logger.error( "Task {} for roi {} failed after {} attempts.".format( self.taskStates[roi].taskInfo.taskName, roi, self.taskStates[roi].attempts ) )
+        return len(failed) == 0
+
+    def failedRois(self):
+        return [roi for roi, state in self.taskStates.items() if state.status == ClusterTaskScheduler.FAILED]
+
+    def _launch(self, state):
+        state.attempts += 1
+        state.status = ClusterTaskScheduler.RUNNING
+        state.launchTime = time.time()
+        state.startTime = None
+        logger.info( "Launching node task (attempt {}): {}".format( state.attempts, state.taskInfo.command ) )
+        state.handle = self._launchFunc( state.taskInfo )
+
+    def _updateState(self, roi, state):
+        """
+        Check on a running task.  Changes its status to DONE, FAILED, or
+        back to PENDING (for a retry) if it isn't running any more.
+        """
+        exited = state.handle is not None and state.handle.poll() is not None
+        if exited and self._launcherDetaches and state.handle.poll() == 0:
+            # The task was submitted.  From now on, only its block tells us how it's doing.
+            state.handle = None
+            exited = False
+
+        if state.handle is None or exited:
+            # A local worker must exit before we count its block as done,
+            #  so it can't still be writing when we return.
+            if self._isBlockDone( roi ):
+                state.status = ClusterTaskScheduler.DONE
+                state.handle = None
+                logger.info( "Task {} finished.".format( state.taskInfo.taskName ) )
+                return
+
+        # The time a task we can't watch waits in a queue doesn't count
+        startTime = state.launchTime
+        if state.handle is None and self._isBlockStarted is not None:
+            if state.startTime is None and self._isBlockStarted( roi ):
+                state.startTime = time.time()
+            startTime = state.startTime
+
+        if exited:
+            reason = "exited with code {} before finishing its block".format( state.handle.poll() )
+        elif self._timeoutSecs is not None and startTime is not None and time.time() - startTime > self._timeoutSecs:
+            reason = "timed out after {} seconds".format( self._timeoutSecs )
+            if state.handle is not None:
+                killProcessGroup( state.handle )
+        else:
+            return
+
+        state.handle = None
+        if state.attempts <= self._maxRetries:
+            logger.warn( "Task {} {}.  Retrying.".format( state.taskInfo.taskName, reason ) )
+            state.status = ClusterTaskScheduler.PENDING
+        else:
+            logger.error( "Task {} {}.".format( state.taskInfo.taskName, reason ) )
+            state.status = ClusterTaskScheduler.FAILED
+
+def launchProcessGroup(command, cwd):
+    """
+    Launch a shell command in a new process group, so that killProcessGroup()
+    kills the command, and not only the shell which runs it.
+    """
+    if hasattr(os, 'setsid'):
+        return subprocess.Popen( command, shell=True, cwd=cwd, preexec_fn=os.setsid )
+    return subprocess.Popen( command, shell=True, cwd=cwd )
+
+def killProcessGroup(handle):
+    """
+    Kill a process (started by launchProcessGroup) and all of its children.
+    """
+    try:
+        pid = getattr(handle, 'pid', None)
+        if pid is not None and hasattr(os, 'killpg') and os.getpgid(pid) == pid:
+            os.killpg( pid, signal.SIGKILL )
+        else:
+            handle.kill()
+        handle.wait()
+    except OSError:
+        pass # It exited in the meantime.
+
 class OpClusterize(Operator):
     Input = InputSlot()
     OutputDatasetDescription = InputSlot()
@@ -163,7 +333,11 @@ class OpClusterize(Operator):
         taskName = None
         command = None
         subregion = None
-        
+
+    def __init__(self, *args, **kwargs):
+        super( OpClusterize, self ).__init__( *args, **kwargs )
+        self.progressSignal = OrderedSignal()
+
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
         self.ReturnCode.meta.shape = (1,)
@@ -211,10 +385,13 @@ class OpClusterize(Operator):
         try:
             # Figure out which work doesn't need to be recomputed (if any)
             unneeded_rois = []
+            locked_rois = []
             for roi in taskInfos.keys():
-                if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE \
-                or blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
+                if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE:
                     unneeded_rois.append( roi )
+                elif blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
+                    unneeded_rois.append( roi )
+                    locked_rois.append( roi )
     
             # Remove any tasks that we don't need to compute (they were finished in a previous run)
             for roi in unneeded_rois:
@@ -223,12 +400,11 @@ class OpClusterize(Operator):
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
             if self._config.task_launch_server == "localhost":
-                def localCommand( cmd ):
-                    cwd = os.getcwd()
-                    os.chdir( absWorkDir )
-                    subprocess.call( cmd, shell=True )
-                    os.chdir( cwd )
+                # Don't wait for the process here: the scheduler watches it.
+                def localCommand( taskInfo ):
+                    return launchProcessGroup( taskInfo.command, absWorkDir )
                 launchFunc = localCommand
+                maxParallel = self._config.num_local_workers or 1
             else:
                 # We use fabric for executing remote tasks
                 # Import it here because it isn't required that the nodes can use it.
@@ -237,15 +413,43 @@ class OpClusterize(Operator):
                 def remoteCommand( cmd ):
                     with fab.cd( absWorkDir ):
                         fab.run( cmd )
-                launchFunc = functools.partial( fab.execute, remoteCommand )
-    
-            # Spawn each task
-            for taskInfo in taskInfos.values():
-                logger.info("Launching node task: " + taskInfo.command )
-                launchFunc( taskInfo.command )
-        
-            # Return immediately.  We do not attempt to monitor the task progress.
-            result[0] = True
+                # The remote command only submits the task, so there is no
+                #  handle to watch.  The scheduler polls the block status instead.
+                def launchRemote( taskInfo ):
+                    fab.execute( remoteCommand, taskInfo.command )
+                    return None
+                launchFunc = launchRemote
+                maxParallel = None
+
+            def isBlockDone( roi ):
+                return blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE
+
+            def isBlockStarted( roi ):
+                # A worker locks its block while it writes it
+                return blockwiseFileset.isBlockLocked(roi[0]) or isBlockDone( roi )
+
+            scheduler = ClusterTaskScheduler( launchFunc,
+                                              isBlockDone,
+                                              maxParallel=maxParallel,
+                                              maxRetries=self._config.task_max_retries or 0,
+                                              timeoutSecs=self._config.task_timeout_secs,
+                                              pollIntervalSecs=self._config.task_poll_interval_secs or 1.0,
+                                              isBlockStarted=isBlockStarted,
+                                              launcherDetaches=bool(self._config.task_launcher_detaches) )
+            scheduler.progressSignal.subscribe( self.progressSignal )
+
+            # Blocks that were finished in a previous run were removed above,
+            #  so re-running an interrupted job only launches the remaining ones.
+            result[0] = scheduler.run( taskInfos )
+
+            # Another process may still be working on the blocks that were locked
+            #  when we started, or its lock may be left over from a crash.
+            #  Either way, we can't claim that those blocks are finished.
+            for roi in locked_rois:
+                if not isBlockDone( roi ):
+                    logger.error( "Block {} was locked when the job started and isn't finished.  "
+                                  "If no other process is working on it, remove its stale lock and run the job again.".format( roi ) )
+                    result[0] = False
             return result
         finally:
             blockwiseFileset.close()
@@ -30,12 +30,16 @@ Example:
 debug: false
 plugin_directories: ~/.ilastik/plugins,
 logging_config: ~/custom_ilastik_logging_config.json
+lazy_project_load: false
+blosc_compression: false
 """
 
 default_config = """
 [ilastik]
 debug: false
 plugin_directories: ~/.ilastik/plugins,
+lazy_project_load: false
+blosc_compression: false
 """
 
 cfg = ConfigParser.SafeConfigParser()
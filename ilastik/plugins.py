@@ -24,7 +24,7 @@ from yapsy.IPlugin import IPlugin
 from yapsy.PluginManager import PluginManager
 
 import os
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from functools import partial
 import numpy
 
@@ -93,6 +93,31 @@ class ObjectFeaturesPlugin(IPlugin):
         """
         return dict()
 
+    def compute_local_batch(self, images, binary_bboxes, features, axes):
+        """Calculate features on a batch of objects.
+
+        The default implementation calls compute_local() for each
+        object. Plugins which can share work between objects should
+        override it.
+
+        :param images: list of image[expanded bounding box], one per object
+        :param binary_bboxes: list of binarize(labels[expanded bounding box]),
+            one per object
+        :param features: which features to compute
+        :param axes: axis tags
+
+        :returns: a dictionary with one entry per feature.
+            dict[feature_name] is a list of numpy.ndarrays with ndim=1,
+            in the same order as the objects
+
+        """
+        result = defaultdict(list)
+        for image, binary_bbox in zip(images, binary_bboxes):
+            feats = self.compute_local(image, binary_bbox, features, axes)
+            for key, value in feats.iteritems():
+                result[key].append(value)
+        return dict(result)
+
     @staticmethod
     def combine_dicts(ds):
         return dict(sum((d.items() for d in ds), []))
@@ -23,6 +23,7 @@ import ilastik.applets.objectExtraction.opObjectExtraction
 #from ilastik.applets.objectExtraction.opObjectExtraction import make_bboxes, max_margin
 import vigra
 import numpy as np
+from collections import defaultdict
 from lazyflow.request import Request, RequestPool
 
 def cleanup_key(k):
@@ -63,6 +64,9 @@ class VigraObjFeats(ObjectFeaturesPlugin):
     local_out_suffixes = [local_suffix, " in object and neighborhood"]
 
     ndim = None
+
+    #upper bound for the image and labels of one batch canvas, in bytes
+    max_canvas_bytes = 64 * 2**20
     
     def availableFeatures(self, image, labels):
         names = vigra.analysis.supportedRegionFeatures(image, labels)
@@ -140,15 +144,14 @@ class VigraObjFeats(ObjectFeaturesPlugin):
             
         return self._do_4d(image, labels, features, axes)
 
-    def compute_local(self, image, binary_bbox, feature_dict, axes):
-        """helper that deals with individual objects"""
-        
+    def _local_featurenames(self, feature_dict):
         featurenames = feature_dict.keys()
         local = [x+self.local_suffix for x in self.local_features]
         featurenames = list(set(featurenames) & set(local))
-        featurenames = [x.split(' ')[0] for x in featurenames]
+        return [x.split(' ')[0] for x in featurenames]
+
+    def _compute_local(self, image, binary_bbox, featurenames, margin, axes):
         results = []
-        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({'': feature_dict})
         #FIXME: this is done globally as if all the features have the same margin
         #we should group features by their margins
         passed, excl = ilastik.applets.objectExtraction.opObjectExtraction.make_bboxes(binary_bbox, margin)
@@ -159,3 +162,112 @@ class VigraObjFeats(ObjectFeaturesPlugin):
             result = self._do_4d(image, label, featurenames, axes)
             results.append(self.update_keys(result, suffix=suffix))
         return self.combine_dicts(results)
+
+    def compute_local(self, image, binary_bbox, feature_dict, axes):
+        """helper that deals with individual objects"""
+        featurenames = self._local_featurenames(feature_dict)
+        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({'': feature_dict})
+        return self._compute_local(image, binary_bbox, featurenames, margin, axes)
+
+    def _batch_canvas(self, images, label_arrays, axes):
+        """lay the bounding boxes of a batch side by side along x, so
+        that vigra can compute the features of all objects in one call.
+
+        Object i gets label i+1, the padding is background. The pixels
+        of each object are visited in the same order as in its own
+        bounding box, so the features don't change."""
+        shapes = [label_array.shape for label_array in label_arrays]
+        canvas_shape = list(np.max(shapes, axis=0))
+        canvas_shape[axes.x] = sum(shape[axes.x] for shape in shapes)
+        labels = np.zeros(canvas_shape, dtype=np.uint32)
+        image_shape = list(canvas_shape)
+        image_shape.insert(axes.c, images[0].shape[axes.c])
+        image = np.zeros(image_shape, dtype=np.float32)
+
+        start = 0
+        for i, (img, label_array) in enumerate(zip(images, label_arrays)):
+            key = [slice(0, n) for n in label_array.shape]
+            key[axes.x] = slice(start, start + label_array.shape[axes.x])
+            labels[tuple(key)][np.asarray(label_array, dtype=np.bool)] = i + 1
+            key.insert(axes.c, slice(None))
+            image[tuple(key)] = img
+            start += label_array.shape[axes.x]
+        return image, labels
+
+    def _batch_groups(self, images, label_arrays, axes):
+        """split a batch into groups whose canvas stays below
+        max_canvas_bytes (a single object may exceed it).
+
+        The objects are sorted by the extent of their bounding boxes
+        across x, so that the boxes of a group are similar and little
+        padding is allocated."""
+        shapes = [np.array(label_array.shape) for label_array in label_arrays]
+        pixel_bytes = 4 * (1 + images[0].shape[axes.c])
+        across = [i for i in range(len(shapes[0])) if i != axes.x]
+        order = sorted(range(len(shapes)), key=lambda i: tuple(shapes[i][across]))
+
+        groups = []
+        group = []
+        for i in order:
+            if group:
+                canvas_shape = np.maximum(canvas_shape, shapes[i])
+                canvas_shape[axes.x] += shapes[i][axes.x]
+                if np.prod(canvas_shape) * pixel_bytes > self.max_canvas_bytes:
+                    groups.append(group)
+                    group = []
+            if not group:
+                canvas_shape = shapes[i].copy()
+            group.append(i)
+        if group:
+            groups.append(group)
+        return groups
+
+    def _compute_local_batch(self, images, binary_bboxes, featurenames, margin, axes):
+        """returns one feature dictionary per object, or None if some
+        neighborhood is empty: vigra would return fewer rows then."""
+        bboxes = [ilastik.applets.objectExtraction.opObjectExtraction.make_bboxes(binary_bbox, margin)
+                  for binary_bbox in binary_bboxes]
+        passed, excl = zip(*bboxes)
+        if not all(np.any(label_array) for label_array in passed + excl):
+            return None
+        nobj = len(images)
+        results = [[] for i in range(nobj)]
+        for label_arrays, suffix in zip([excl, passed],
+                                        self.local_out_suffixes):
+            for group in self._batch_groups(images, label_arrays, axes):
+                image, labels = self._batch_canvas([images[i] for i in group],
+                                                   [label_arrays[i] for i in group], axes)
+                result = self.update_keys(self._do_4d(image, labels, featurenames, axes),
+                                          suffix=suffix)
+                for j, i in enumerate(group):
+                    results[i].append(dict((k, v[j:j+1]) for k, v in result.iteritems()))
+        return [self.combine_dicts(r) for r in results]
+
+    def compute_local_batch(self, images, binary_bboxes, feature_dict, axes):
+        """like compute_local, but computes the features of the whole
+        batch with one vigra call per neighborhood type (and per group
+        of objects, if the canvas would exceed max_canvas_bytes).
+
+        Histograms are binned over the range of all pixels passed to
+        vigra, so they are still computed object by object. So is the
+        whole batch if any object has an empty neighborhood."""
+        featurenames = self._local_featurenames(feature_dict)
+        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({'': feature_dict})
+        batched = [f for f in featurenames if f != "Histogram"]
+        single = [f for f in featurenames if f == "Histogram"]
+
+        feats = None
+        if batched:
+            feats = self._compute_local_batch(images, binary_bboxes, batched, margin, axes)
+        if feats is None:
+            feats = [{} for i in range(len(images))]
+            single = featurenames
+        if single:
+            for i in range(len(images)):
+                feats[i].update(self._compute_local(images[i], binary_bboxes[i], single, margin, axes))
+
+        result = defaultdict(list)
+        for object_feats in feats:
+            for key, value in object_feats.iteritems():
+                result[key].append(value)
+        return dict(result)
@@ -35,7 +35,7 @@ import numpy
 
 # PyQt
 from PyQt4 import uic
-from PyQt4.QtCore import pyqtSignal, QObject, Qt, QUrl
+from PyQt4.QtCore import pyqtSignal, QObject, Qt, QUrl, QTimer
 from PyQt4.QtGui import QMainWindow, QWidget, QMenu, QApplication,\
                         QStackedWidget, qApp, QFileDialog, QKeySequence, QMessageBox, \
                         QProgressBar, QInputDialog, QIcon, QFont, QToolButton, \
@@ -60,6 +60,7 @@ from ilastik.applets.base.appletGuiInterface import AppletGuiInterface, VolumeVi
 from ilastik.applets.base.singleToMultiGuiAdapter import SingleToMultiGuiAdapter
 from ilastik.shell.projectManager import ProjectManager
 from ilastik.config import cfg as ilastik_config
+from ilastik.utility.cacheGeometry import applyPendingCachePlans
 from iconMgr import ilastikIcons
 from lazyflow.utility.pathHelpers import compressPathForDisplay
 from ilastik.shell.gui.errorMessageFilter import ErrorMessageFilter
@@ -242,6 +243,9 @@ class IlastikShell( QMainWindow ):
     The GUI's main window.  Simply a standard 'container' GUI for one or more applets.
     """
 
+    #: How often the new block shapes of the adaptive caches are applied
+    CACHE_PLAN_INTERVAL_MS = 2000
+
     def __init__( self, parent = None, workflow_cmdline_args=None, flags = Qt.WindowFlags(0) ):
         QMainWindow.__init__(self, parent = parent, flags = flags)
         #self.setFixedSize(1680,1050) #ilastik manuscript resolution
@@ -329,6 +333,18 @@ class IlastikShell( QMainWindow ):
 
         self._initShortcuts()
 
+        # The adaptive caches only change their block shapes when we tell them to,
+        #  i.e. from the GUI thread, in between the events it handles.
+        self._cachePlanTimer = QTimer(self)
+        self._cachePlanTimer.timeout.connect( self._applyPendingCachePlans )
+        self._cachePlanTimer.start( self.CACHE_PLAN_INTERVAL_MS )
+
+    def _applyPendingCachePlans(self):
+        try:
+            applyPendingCachePlans()
+        except:
+            log_exception( logger, "Failed to apply the new block shapes of a cache" )
+
     def _initShortcuts(self):
         mgr = ShortcutManager()
         ActionInfo = ShortcutManager.ActionInfo
@@ -1507,6 +1523,9 @@ class IlastikShell( QMainWindow ):
         except ValueError:
             pass
         else:
+            # Applets whose data is still being loaded in the background stay disabled
+            if self.projectManager is not None and applet in self.projectManager.loadingApplets:
+                enabled = False
             applet.getMultiLaneGui().setEnabled( enabled )
 
             # Apply to the applet bar drawer heading, too.
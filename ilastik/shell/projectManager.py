@@ -21,6 +21,7 @@
 import os
 import gc
 import copy
+import functools
 import platform
 import h5py
 import logging
@@ -31,8 +32,11 @@ import traceback
 
 import ilastik
 from ilastik import isVersionCompatible
+from ilastik.config import cfg as ilastik_config
 from ilastik.utility import log_exception
 from ilastik.workflow import getWorkflowFromName
+from ilastik.applets.base.appletSerializer import AppletSerializer
+from lazyflow.request import Request
 from lazyflow.utility.timer import Timer, timeLogged
 
 class ProjectManager(object):
@@ -46,8 +50,18 @@ class ProjectManager(object):
     
     Once the project manager has been instantiated, clients can access its ``workflow``
     member for direct access to its applets and their top-level operators.
+
+    If ``lazy_project_load`` is set in the ilastik config, bulk data (label blocks,
+    classifiers, ...) is not read while the project is opened, but afterwards, in the
+    background, for all applets concurrently. See ``waitForDeferredLoads()``.
+    The applets whose data is still being read are listed in ``loadingApplets``;
+    the shell keeps them disabled, so the user can't edit data which is about to be
+    overwritten by the load.
     """
 
+    #: When the project is closed, it is repacked if at least this fraction of the file is unused
+    REPACK_THRESHOLD = 0.25
+
     #########################
     ## Error types
     #########################    
@@ -170,6 +184,9 @@ class ProjectManager(object):
         self.currentProjectFile = None
         self.currentProjectPath = None
         self.currentProjectIsReadOnly = False
+        self.lazyLoad = ilastik_config.getboolean('ilastik', 'lazy_project_load')
+        self._deferredLoads = []
+        self.loadingApplets = set()
 
         # Instantiate the workflow.
         self._workflowClass = workflowClass
@@ -209,6 +226,16 @@ class ProjectManager(object):
                     dirtyAppletNames.append(applet.name)
         return dirtyAppletNames
 
+    def waitForDeferredLoads(self):
+        """
+        Block until all data whose loading was deferred by a lazy project load has been read.
+        This is done automatically before the project is saved or closed.
+        """
+        deferredLoads = self._deferredLoads
+        self._deferredLoads = []
+        for req in deferredLoads:
+            req.wait()
+
     def saveProject(self, force_all_save=False):
         """
         Update the project file with the state of the current workflow settings.
@@ -218,6 +245,7 @@ class ProjectManager(object):
         assert self.currentProjectFile != None
         assert self.currentProjectPath != None
         assert not self.currentProjectIsReadOnly, "Can't save a read-only project"
+        self.waitForDeferredLoads()
 
         # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
         #  the progress manager treats these tasks as a group instead of several sequential jobs.
@@ -259,6 +287,7 @@ class ProjectManager(object):
         Copy the project file as it is, then serialize any dirty state into the copy.
         Original serializers and project file should not be touched.
         """
+        self.waitForDeferredLoads()
         with h5py.File(snapshotPath, 'w') as snapshotFile:
             # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
             #  the progress manager treats these tasks as a group instead of several sequential jobs.
@@ -319,6 +348,8 @@ class ProjectManager(object):
             self._takeSnapshotAndLoadIt(newPath)
             return
 
+        self.waitForDeferredLoads()
+
         oldPath = self.currentProjectPath
         try:
             os.rename( oldPath, newPath )
@@ -381,24 +412,46 @@ class ProjectManager(object):
         self.currentProjectFile = hdf5File
         self.currentProjectPath = projectFilePath
         self.currentProjectIsReadOnly = readOnly
+        deferredApplets = set()
         try:
             # Applet serializable items are given the whole file (root group)
             for aplt in self._applets:
                 with Timer() as timer:
+                    # In a lazy load, the bulk data of each applet is read later, but
+                    # the serializers of an applet must still be run in order.
+                    deferred = []
                     for item in aplt.dataSerializers:
                         assert item.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
                         item.ignoreDirty = True
-                                            
-                        if item.caresOfHeadless:
-                            item.deserializeFromHdf5(self.currentProjectFile, projectFilePath, self._headless)
+                        if deferred:
+                            deferred.append( functools.partial(self._deserializeItem, item) )
+                            continue
+
+                        loadDeferred = None
+                        if self.lazyLoad and self._canDefer(item):
+                            loadDeferred = item.deserializeFromHdf5Deferred(self.currentProjectFile, projectFilePath, self._headless)
                         else:
-                            item.deserializeFromHdf5(self.currentProjectFile, projectFilePath)
-    
-                        item.ignoreDirty = False
+                            self._deserializeItem(item)
+
+                        if loadDeferred is not None:
+                            deferred.append( functools.partial(self._finishDeferredItem, item, loadDeferred) )
+                        else:
+                            item.ignoreDirty = False
                 logger.debug('Deserializing applet "{}" took {} seconds'.format( aplt.name, timer.seconds() ))
-            
+
+                if deferred:
+                    deferredApplets.add(aplt)
+                    self.loadingApplets.add(aplt)
+                    req = Request( functools.partial(self._runDeferredLoads, aplt, deferred) )
+                    req.submit()
+                    self._deferredLoads.append(req)
 
             self.closed = False
+
+            # Headless workflows do their work right away, so there is nothing to gain by deferring.
+            if self._headless:
+                self.waitForDeferredLoads()
+
             # Call the workflow's custom post-load initialization (if any)
             self.workflow.onProjectLoaded( self )
 
@@ -412,8 +465,57 @@ class ProjectManager(object):
         finally:
             gc.enable()
             for aplt in self._applets:
-                aplt.progressSignal.emit(100)
-                
+                if aplt not in deferredApplets:
+                    aplt.progressSignal.emit(100)
+
+    def _deserializeItem(self, item):
+        try:
+            if item.caresOfHeadless:
+                item.deserializeFromHdf5(self.currentProjectFile, self.currentProjectPath, self._headless)
+            else:
+                item.deserializeFromHdf5(self.currentProjectFile, self.currentProjectPath)
+        finally:
+            item.ignoreDirty = False
+
+    @staticmethod
+    def _canDefer(item):
+        """Only serializers which use the base class deserialization logic can be loaded lazily."""
+        return type(item).deserializeFromHdf5.__func__ is AppletSerializer.deserializeFromHdf5.__func__
+
+    @staticmethod
+    def _finishDeferredItem(item, loadDeferred):
+        try:
+            loadDeferred()
+        finally:
+            item.ignoreDirty = False
+
+    @timeLogged(logger, logging.DEBUG)
+    def _runDeferredLoads(self, aplt, deferred):
+        try:
+            for load in deferred:
+                load()
+        finally:
+            aplt.progressSignal.emit(100)
+            self._postToMainThread( functools.partial(self._deferredLoadFinished, aplt) )
+        logger.debug('Finished deferred loading of applet "{}"'.format( aplt.name ))
+
+    def _deferredLoadFinished(self, aplt):
+        """Called (in the main thread) when the deferred data of an applet has been read."""
+        if aplt not in self.loadingApplets:
+            # The project was closed in the meantime
+            return
+        self.loadingApplets.discard(aplt)
+        if not self.closed and not self._headless:
+            # Let the workflow re-enable the applet
+            self.workflow.handleAppletStateUpdateRequested()
+
+    def _postToMainThread(self, func):
+        """Run func in the GUI thread (if there is a GUI), and right away otherwise."""
+        thunkEventHandler = getattr(self._shell, 'thunkEventHandler', None)
+        if self._headless or thunkEventHandler is None:
+            func()
+        else:
+            thunkEventHandler.post(func)
 
     def _takeSnapshotAndLoadIt(self, newPath):
         """
@@ -475,7 +577,50 @@ class ProjectManager(object):
         if self.closed:
             return
         self.closed = True
+        try:
+            self.waitForDeferredLoads()
+        except:
+            log_exception( logger, "Deferred project loading failed." )
+        self.loadingApplets = set()
         if self.workflow is not None:
             self.workflow.cleanUp()
         if self.currentProjectFile is not None:
+            repackedPath = None
+            try:
+                repackedPath = self._repackIfNecessary()
+            except:
+                log_exception( logger, "Failed to repack the project file." )
             self.currentProjectFile.close()
+            if repackedPath is not None:
+                os.rename( repackedPath, self.currentProjectPath )
+
+    def _repackIfNecessary(self):
+        """
+        HDF5 can reuse the space of deleted datasets only while the file is open,
+        and a file never shrinks. So if much of the project file is unused
+        (e.g. after a serializer compacted its data), its contents are copied into
+        a fresh file, like h5repack does. Returns the path of the repacked file,
+        which replaces the project file once that is closed (or None).
+        """
+        if self.currentProjectIsReadOnly or platform.system() == 'Windows':
+            # Windows does not permit replacing the open file
+            return None
+        self.currentProjectFile.flush()
+        freeBytes = self.currentProjectFile.id.get_freespace()
+        fileBytes = os.path.getsize( self.currentProjectPath )
+        if fileBytes == 0 or freeBytes < self.REPACK_THRESHOLD * fileBytes:
+            return None
+
+        logger.info( "Repacking project file ({} of {} bytes unused)".format( freeBytes, fileBytes ) )
+        repackedPath = self.currentProjectPath + '.repack'
+        try:
+            with h5py.File(repackedPath, 'w') as repackedFile:
+                for key, value in self.currentProjectFile.attrs.items():
+                    repackedFile.attrs[key] = value
+                for key in self.currentProjectFile.keys():
+                    repackedFile.copy(self.currentProjectFile[key], key)
+        except:
+            if os.path.exists(repackedPath):
+                os.remove(repackedPath)
+            raise
+        return repackedPath
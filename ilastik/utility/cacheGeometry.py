@@ -0,0 +1,299 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Block shapes for the sliced array caches.
+
+OpSlicedBlockedArrayCache keeps three sets of blocks, each of which is thin
+along one spatial axis (x, y and z, in that order), so that the slices shown
+by the viewer touch as few blocks as possible. The shapes are derived from the
+cached slot's metadata: the blocks contain all channels, the in-plane edges
+are chosen so that an outer block stays within a memory budget (taking
+ram_usage_per_requested_pixel into account), and axes which are shorter than
+a block are not padded out.
+
+If request shapes have been observed, the in-plane edges of each set of
+blocks follow the typical request served by that set, instead of the defaults.
+"""
+import collections
+import math
+import threading
+import weakref
+
+import numpy
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.operators import OpSlicedBlockedArrayCache
+
+import logging
+logger = logging.getLogger(__name__)
+
+#: Memory budget for a single outer block
+MAX_BLOCK_BYTES = 64 * 2**20
+
+#: Default thickness of the blocks along their thin axis
+THIN_EDGE = 32
+
+#: In-plane edge length of the outer blocks, if no requests have been observed
+DEFAULT_EDGE = 256
+
+#: Bounds for the in-plane edge lengths of the outer blocks
+MIN_EDGE = 32
+MAX_EDGE = 1024
+
+#: Block extent along 'c' which covers all channels
+ALL_CHANNELS = 1000
+
+def _powerOfTwoBelow(n):
+    return 2**int(math.floor(math.log(max(n, 1), 2)))
+
+def _powerOfTwoAbove(n):
+    return 2**int(math.ceil(math.log(max(n, 1), 2)))
+
+def _planeEdges(planeSizes, budgetPixels, typical):
+    """
+    Edge lengths for the given in-plane axes, such that the product stays
+    within budgetPixels. Axes which are shorter than the edge are taken
+    completely, and the rest of the budget goes to the other axes.
+    """
+    edges = {}
+    remaining = dict(planeSizes)
+    while remaining:
+        edge = (budgetPixels / float( numpy.prod(edges.values()) )) ** (1.0 / len(remaining))
+        edge = min( MAX_EDGE, max( MIN_EDGE, _powerOfTwoBelow(edge) ) )
+        if typical is None:
+            targets = dict( (k, min( edge, DEFAULT_EDGE )) for k in remaining )
+        else:
+            targets = dict( (k, min( edge, max( MIN_EDGE, _powerOfTwoAbove(typical[k]) ) )) for k in remaining )
+        short = [ k for k, size in remaining.items() if size <= targets[k] ]
+        if not short:
+            edges.update( targets )
+            break
+        for k in short:
+            edges[k] = remaining.pop(k)
+    return edges
+
+def planBlockShapes(meta, thinEdge=THIN_EDGE, requestShapes=(), maxBlockBytes=MAX_BLOCK_BYTES):
+    """
+    Choose the block shapes of a sliced cache for a slot with the given metadata.
+
+    :param thinEdge: The extent of the blocks along their thin axis
+    :param requestShapes: Shapes of requests which were made to the cache (if any)
+    :returns: (innerBlockShapes, outerBlockShapes), each a tuple of three
+        block shapes (thin along x, y and z), as OpSlicedBlockedArrayCache expects them.
+    """
+    axiskeys = meta.getAxisKeys()
+    tagged = dict( zip(axiskeys, meta.shape) )
+
+    pixelBytes = numpy.dtype(meta.dtype).itemsize * tagged.get('c', 1)
+    if meta.ram_usage_per_requested_pixel is not None:
+        pixelBytes = max( pixelBytes, meta.ram_usage_per_requested_pixel )
+
+    spatial = [ k for k in 'xyz' if k in tagged ]
+
+    # Each request is served by the blocks which are thin along the
+    # request's thinnest spatial axis (for 2D data, that's the missing z axis).
+    requestsByThinAxis = collections.defaultdict(list)
+    for shape in requestShapes:
+        taggedRequest = dict( zip(axiskeys, shape) )
+        thinKey = min( 'xyz', key=lambda k: (taggedRequest.get(k, 1), 'zyx'.index(k)) )
+        requestsByThinAxis[thinKey].append( shape )
+
+    innerShapes = []
+    outerShapes = []
+    for thinKey in 'xyz':
+        outer = dict( (k, 1) for k in axiskeys )
+        if 'c' in tagged:
+            outer['c'] = tagged['c']
+        if thinKey in tagged:
+            outer[thinKey] = min( thinEdge, tagged[thinKey] )
+
+        planeSizes = dict( (k, tagged[k]) for k in spatial if k != thinKey )
+        budgetPixels = maxBlockBytes / float( pixelBytes * outer.get(thinKey, 1) )
+        typical = None
+        if requestsByThinAxis[thinKey]:
+            typical = dict( zip( axiskeys, numpy.median( numpy.array(requestsByThinAxis[thinKey]), axis=0 ) ) )
+        outer.update( _planeEdges( planeSizes, budgetPixels, typical ) )
+
+        # The inner blocks have half the in-plane extent of the outer blocks,
+        # except along axes which fit into a single block anyway
+        inner = dict(outer)
+        for k, size in planeSizes.items():
+            if outer[k] < size:
+                inner[k] = max( 1, outer[k] // 2 )
+
+        innerShapes.append( tuple( inner[k] for k in axiskeys ) )
+        outerShapes.append( tuple( outer[k] for k in axiskeys ) )
+    return tuple(innerShapes), tuple(outerShapes)
+
+def configureSlicedCache(cache, meta, thinEdge=THIN_EDGE, maxBlockBytes=MAX_BLOCK_BYTES, laneIndex=None):
+    """
+    Set the block shapes of an OpSlicedBlockedArrayCache according to
+    planBlockShapes, for caches which can't plan their own shapes (see
+    OpAdaptiveSlicedBlockedArrayCache). For a wrapper of several caches,
+    laneIndex selects the cache to configure.
+
+    The metadata may be that of a related slot (e.g. the raw data instead
+    of the predictions). Therefore, the blocks extend over all channels
+    of the cached data, no matter how many channels meta has.
+    """
+    inner, outer = planBlockShapes( meta, thinEdge, (), maxBlockBytes )
+    if 'c' in meta.getAxisKeys():
+        channelIndex = meta.getAxisKeys().index('c')
+        def allChannels(shapes):
+            # The cache clips the blocks to the size of the data
+            return tuple( shape[:channelIndex] + (ALL_CHANNELS,) + shape[channelIndex+1:] for shape in shapes )
+        inner, outer = allChannels(inner), allChannels(outer)
+    innerSlot, outerSlot = cache.innerBlockShape, cache.outerBlockShape
+    if laneIndex is not None:
+        innerSlot, outerSlot = laneSlot( innerSlot, laneIndex ), laneSlot( outerSlot, laneIndex )
+    innerSlot.setValue( inner )
+    outerSlot.setValue( outer )
+
+def laneSlot(multislot, laneIndex):
+    """
+    The subslot of a wrapped operator's input for the given lane,
+    which is added if the wrapper doesn't have that lane yet.
+    """
+    if len(multislot) <= laneIndex:
+        multislot.resize( laneIndex+1 )
+    return multislot[laneIndex]
+
+class OpCacheGeometryPlanner(Operator):
+    """
+    Outputs the block shapes for a sliced cache of its input (see planBlockShapes).
+    """
+    Input = InputSlot() # Only the metadata is used
+    ThinEdge = InputSlot(value=THIN_EDGE)
+    MaxBlockBytes = InputSlot(value=MAX_BLOCK_BYTES)
+    RequestShapes = InputSlot(value=()) # Shapes of requests which were made to the cache
+
+    InnerBlockShape = OutputSlot()
+    OuterBlockShape = OutputSlot()
+
+    def setupOutputs(self):
+        requestShapes = [ s for s in self.RequestShapes.value if len(s) == len(self.Input.meta.shape) ]
+        inner, outer = planBlockShapes( self.Input.meta, self.ThinEdge.value, requestShapes, self.MaxBlockBytes.value )
+        for slot, value in [(self.InnerBlockShape, inner), (self.OuterBlockShape, outer)]:
+            slot.meta.shape = (1,)
+            slot.meta.dtype = object
+            slot.setValue( value )
+
+    def execute(self, slot, subindex, roi, result):
+        assert False, "Shouldn't get here.  Output is assigned a value in setupOutputs()"
+
+    def propagateDirty(self, slot, subindex, roi):
+        # The block shapes depend on the input's metadata, not on its data.
+        pass
+
+#: The adaptive caches, whose pending plans applyPendingCachePlans() applies
+_adaptiveCaches = weakref.WeakSet()
+
+def applyPendingCachePlans():
+    """
+    Apply the block shapes planned by all OpAdaptiveSlicedBlockedArrayCaches
+    (see OpAdaptiveSlicedBlockedArrayCache.applyPendingPlan). This changes
+    the graph, so it must be called from the thread that sets it up, e.g. by
+    a timer of the GUI. Returns the number of caches which got new shapes.
+    """
+    return sum( 1 for cache in list(_adaptiveCaches) if cache.applyPendingPlan() )
+
+class OpAdaptiveSlicedBlockedArrayCache(OpSlicedBlockedArrayCache):
+    """
+    A sliced cache which plans its own block shapes, given the extent of the
+    blocks along their thin axis (ThinEdge) and the memory budget for a
+    single block (MaxBlockBytes).
+
+    The shapes of the requests to the cache are recorded, and the plan is
+    revised every REPLAN_INTERVAL requests. A new plan discards the cached
+    data, so it is only kept if it differs from the current one. It is not
+    applied while requests are being served: it waits until
+    applyPendingPlan() is called while the cache is idle. The shell's GUI
+    does that periodically for all adaptive caches (applyPendingCachePlans).
+    Without the GUI, i.e. in headless and batch mode, nothing calls it, and
+    the cache keeps the block shapes planned from the metadata of its input.
+    A frozen cache (fixAtCurrent) keeps its block shapes, too.
+    """
+    ThinEdge = InputSlot(value=THIN_EDGE)
+    MaxBlockBytes = InputSlot(value=MAX_BLOCK_BYTES)
+
+    REPLAN_INTERVAL = 100
+    REQUEST_HISTORY = 50
+
+    def __init__(self, *args, **kwargs):
+        super(OpAdaptiveSlicedBlockedArrayCache, self).__init__(*args, **kwargs)
+        self._planLock = threading.Lock()
+        self._requestShapes = collections.deque( maxlen=self.REQUEST_HISTORY )
+        self._requestCount = 0
+        self._activeRequests = 0
+        self._pendingRequestShapes = None
+
+        self._opPlanner = OpCacheGeometryPlanner( parent=self )
+        self._opPlanner.Input.connect( self.Input )
+        self._opPlanner.ThinEdge.connect( self.ThinEdge )
+        self._opPlanner.MaxBlockBytes.connect( self.MaxBlockBytes )
+        self.innerBlockShape.connect( self._opPlanner.InnerBlockShape )
+        self.outerBlockShape.connect( self._opPlanner.OuterBlockShape )
+        _adaptiveCaches.add( self )
+
+    def cleanUp(self):
+        _adaptiveCaches.discard( self )
+        super(OpAdaptiveSlicedBlockedArrayCache, self).cleanUp()
+
+    def hasPendingPlan(self):
+        with self._planLock:
+            return self._pendingRequestShapes is not None
+
+    def applyPendingPlan(self):
+        """
+        Switch to the block shapes planned from the recorded requests, if
+        there is such a plan, and the cache is neither frozen nor serving
+        a request. Must not be called from a request.
+        Returns True if the block shapes were changed.
+        """
+        if not self.fixAtCurrent.ready() or self.fixAtCurrent.value:
+            return False
+        with self._planLock:
+            if self._pendingRequestShapes is None or self._activeRequests > 0:
+                return False
+            requestShapes, self._pendingRequestShapes = self._pendingRequestShapes, None
+        logger.debug( "{}: re-planning the block shapes".format( self.name ) )
+        self._opPlanner.RequestShapes.setValue( requestShapes )
+        return True
+
+    def execute(self, slot, subindex, roi, result):
+        if slot != self.Output:
+            return super(OpAdaptiveSlicedBlockedArrayCache, self).execute(slot, subindex, roi, result)
+
+        # Only record a new plan here: the graph must not be changed from a request
+        with self._planLock:
+            self._activeRequests += 1
+            self._requestShapes.append( tuple( numpy.subtract(roi.stop, roi.start) ) )
+            self._requestCount += 1
+            if self._requestCount % self.REPLAN_INTERVAL == 0 and not self.fixAtCurrent.value:
+                requestShapes = tuple(self._requestShapes)
+                plan = planBlockShapes( self.Input.meta, self.ThinEdge.value, requestShapes, self.MaxBlockBytes.value )
+                if plan != (self.innerBlockShape.value, self.outerBlockShape.value):
+                    self._pendingRequestShapes = requestShapes
+        try:
+            return super(OpAdaptiveSlicedBlockedArrayCache, self).execute(slot, subindex, roi, result)
+        finally:
+            with self._planLock:
+                self._activeRequests -= 1
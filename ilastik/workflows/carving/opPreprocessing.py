@@ -19,19 +19,23 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 #Python
-import sys
+import threading
+import zlib
+from functools import partial
 
 #SciPy
 import numpy
 import vigra
 
 #lazyflow
-from lazyflow.roi import roiFromShape
+from lazyflow.roi import roiFromShape, roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpArrayCache
+from lazyflow.request import Request, RequestPool, RequestLock
 
 from lazyflow.utility.timer import Timer
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.unionFind import mergeLabels
 
 #carving Cython module
 from cylemon.segmentation import MSTSegmentor
@@ -39,6 +43,10 @@ from cylemon.segmentation import MSTSegmentor
 import logging
 logger = logging.getLogger(__name__)
 
+# The preprocessing is computed (and cached) in blocks of this shape (t,x,y,z,c),
+# so the volume never needs to be in memory more than once.
+DEFAULT_BLOCK_SHAPE = (1, 256, 256, 256, 1)
+
 class OpFilter(Operator):
     HESSIAN_BRIGHT = 0
     HESSIAN_DARK = 1
@@ -66,87 +74,107 @@ class OpFilter(Operator):
             assert ax[i].isSpatial()
         assert ax[4].key == "c" and sh[4] == 1
         
-        volume5d = self.Input.value
         sigma = self.Sigma.value
+
+        # Read the requested region plus a halo, so that the result does not
+        # depend on how the volume is divided into requests.
+        halo = int(numpy.ceil(3*sigma)) + 2
+        spatialShape = numpy.array(sh[1:4])
+        haloStart = numpy.maximum(numpy.subtract(roi.start[1:4], halo), 0)
+        haloStop = numpy.minimum(numpy.add(roi.stop[1:4], halo), spatialShape)
+        volume5d = self.Input((0,) + tuple(haloStart) + (0,), (1,) + tuple(haloStop) + (1,)).wait()
         volume = volume5d[0,:,:,:,0]
+        inner = roiToSlice(numpy.subtract(roi.start[1:4], haloStart), numpy.subtract(roi.stop[1:4], haloStart))
         result_view = result[0,:,:,:,0]
         
-        logger.info( "input volume shape: %r" %  (volume.shape,) )
-        logger.info( "input volume size: %r MB", (volume.nbytes / 1024**2,) )
+        logger.debug( "input volume shape: %r" %  (volume.shape,) )
+        logger.debug( "input volume size: %r MB", (volume.nbytes / 1024**2,) )
         fvol = numpy.asarray(volume, numpy.float32)
 
         #Choose filter selected by user
         volume_filter = self.Filter.value
 
-        logger.info( "applying filter on shape = %r" % (fvol.shape,) )
+        logger.debug( "applying filter on shape = %r" % (fvol.shape,) )
         with Timer() as filterTimer:        
-            if fvol.shape[2] > 1:
+            if sh[3] > 1:
                 # true 3D volume
                 if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                    logger.info( "lowest eigenvalue of Hessian of Gaussian" )
-                    result_view[...] = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,:,2]
-                    result_view[:] = numpy.max(result_view) - result_view
+                    logger.debug( "lowest eigenvalue of Hessian of Gaussian" )
+                    # Negated instead of subtracted from the (global) maximum:
+                    # the offset doesn't matter after OpNormalize255.
+                    result_view[...] = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[...,2][inner]
+                    result_view[:] *= -1
                 
                 elif volume_filter == OpFilter.HESSIAN_DARK:
-                    logger.info( "greatest eigenvalue of Hessian of Gaussian" )
-                    result_view[...] = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,:,0]
+                    logger.debug( "greatest eigenvalue of Hessian of Gaussian" )
+                    result_view[...] = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[...,0][inner]
                      
                 elif volume_filter == OpFilter.STEP_EDGES:
-                    logger.info( "Gaussian Gradient Magnitude" )
-                    result_view[...] = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
+                    logger.debug( "Gaussian Gradient Magnitude" )
+                    result_view[...] = vigra.filters.gaussianGradientMagnitude(fvol,sigma)[inner]
                     
                 elif volume_filter == OpFilter.RAW:
-                    logger.info( "Gaussian Smoothing" )
-                    result_view[...] = vigra.filters.gaussianSmoothing(fvol,sigma)
+                    logger.debug( "Gaussian Smoothing" )
+                    result_view[...] = vigra.filters.gaussianSmoothing(fvol,sigma)[inner]
                     
                 elif volume_filter == OpFilter.RAW_INVERTED:
-                    logger.info( "negative Gaussian Smoothing" )
-                    result_view[...] = vigra.filters.gaussianSmoothing(-fvol,sigma)
+                    logger.debug( "negative Gaussian Smoothing" )
+                    result_view[...] = vigra.filters.gaussianSmoothing(-fvol,sigma)[inner]
 
-                logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
+                logger.debug( "Filter took {} seconds".format( filterTimer.seconds() ) )
             else:
                 # 2D Image
                 fvol = fvol[:,:,0]
+                inner = inner[:2]
                 if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                    logger.info( "lowest eigenvalue of Hessian of Gaussian" )
-                    volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
-                    volume_feat[:] = numpy.max(volume_feat) - volume_feat
+                    logger.debug( "lowest eigenvalue of Hessian of Gaussian" )
+                    volume_feat = -vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
                 
                 elif volume_filter == OpFilter.HESSIAN_DARK:
-                    logger.info( "greatest eigenvalue of Hessian of Gaussian" )
+                    logger.debug( "greatest eigenvalue of Hessian of Gaussian" )
                     volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,0]
                      
                 elif volume_filter == OpFilter.STEP_EDGES:
-                    logger.info( "Gaussian Gradient Magnitude" )
+                    logger.debug( "Gaussian Gradient Magnitude" )
                     volume_feat = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW:
-                    logger.info( "Gaussian Smoothing" )
+                    logger.debug( "Gaussian Smoothing" )
                     volume_feat = vigra.filters.gaussianSmoothing(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW_INVERTED:
-                    logger.info( "negative Gaussian Smoothing" )
+                    logger.debug( "negative Gaussian Smoothing" )
                     volume_feat = vigra.filters.gaussianSmoothing(-fvol,sigma)
 
-                result_view[:,:,0] = volume_feat
-                logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
+                result_view[:,:,0] = volume_feat[inner]
+                logger.debug( "Filter took {} seconds".format( filterTimer.seconds() ) )
         return result
 
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty(slice(None))
 
 class OpNormalize255(Operator):
+    """
+    Rescale the input to [0,255] according to the min and max of the
+    whole volume, which are determined block by block.
+    """
     Input = InputSlot()
+    BlockShape = InputSlot(value=DEFAULT_BLOCK_SHAPE)
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super( OpNormalize255, self ).__init__(*args, **kwargs)
+        self._rangeLock = RequestLock()
+        self._range = None
+
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
+        self._range = None
     
     def execute(self, slot, subindex, roi, result):
         # Save memory: use result as a temporary
         self.Input( roi.start, roi.stop ).writeInto(result).wait()
-        volume_max = numpy.max(result)
-        volume_min = numpy.min(result)
+        volume_min, volume_max = self._getRange()
 
         # result[...] = (result - volume_min) * 255.0 / (volume_max-volume_min)
         # Avoid temporaries...
@@ -155,42 +183,272 @@ class OpNormalize255(Operator):
         result[:] /= (volume_max - volume_min)
         return result
 
+    def _getRange(self):
+        with self._rangeLock:
+            if self._range is None:
+                shape = self.Input.meta.shape
+                block_shape = numpy.minimum( self.BlockShape.value, shape )
+                block_ranges = []
+                def processBlock(block_start):
+                    block_roi = getBlockBounds( shape, block_shape, block_start )
+                    block = self.Input( *block_roi ).wait()
+                    block_ranges.append( (numpy.min(block), numpy.max(block)) )
+
+                pool = RequestPool()
+                for block_start in getIntersectingBlocks( block_shape, roiFromShape(shape) ):
+                    pool.add( Request( partial(processBlock, block_start) ) )
+                pool.wait()
+                pool.clean()
+
+                mins, maxs = zip(*block_ranges)
+                self._range = (min(mins), max(maxs))
+            return self._range
+
     def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty(roi.start, roi.stop)
+        # Any change may change the range, and thereby the whole output.
+        self._range = None
+        self.Output.setDirty(slice(None))
 
 class OpSimpleWatershed(Operator):
+    """
+    Watershed supervoxels of the whole volume, computed block by block.
+
+    Each block is segmented together with a halo, so the supervoxels in its
+    interior don't depend on the blocking.  Supervoxels which are cut by a
+    block face are stitched: a supervoxel on one side of a face is merged
+    with one on the other side if each is the other's best continuation,
+    i.e. if the halo of either block predicts the other's label there.
+
+    The stitching tables are computed the first time any part of the
+    output is requested.  Each block is segmented only then: its labels
+    are kept (compressed, in memory) for the output.  If the computation
+    is cancelled, the finished blocks are kept too, so the next request
+    continues with the remaining ones.  Nothing of this is stored in the
+    project file.
+    """
     Input = InputSlot()
+    BlockShape = InputSlot(value=DEFAULT_BLOCK_SHAPE)
+    Halo = InputSlot(value=16)
     Output = OutputSlot()
 
+    #: zlib compression level of the block labels kept in memory
+    COMPRESSION_LEVEL = 1
+
+    def __init__(self, *args, **kwargs):
+        super( OpSimpleWatershed, self ).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._tablesLock = RequestLock()
+        self._generation = 0
+        self._resetTables()
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Input.meta)
         
         # Use a SIGNED int32 becacuse that's what cylemon.segmentation expects. (Unfortunately.)
         self.Output.meta.dtype = numpy.int32
+        self._resetTables()
+
+    def _resetTables(self):
+        with self._lock:
+            # Blocks still being processed for an older generation are discarded
+            self._generation += 1
+            self._blockLabels = {}      # block start : (shape, compressed labels) of the block
+            self._blockLabelCounts = {} # block start : number of supervoxels in the block
+            self._openFaces = {}        # interface : faces of the first block that got there
+            self._faceMatches = []      # (lower block start, upper block start, matched label pairs)
+            self._tables = None
 
     def execute(self, slot, subindex, roi, result):
-        assert roi.stop - roi.start == self.Output.meta.shape, "Watershed must be run on the entire volume."
-        input_image = self.Input(roi.start, roi.stop).wait()
-        volume_feat = input_image[0,...,0]
-        result_view = result[0,...,0]
-        with Timer() as watershedTimer:
-            if self.Input.meta.getTaggedShape()['z'] > 1:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                #result_view[...] = vigra.analysis.watersheds(volume_feat[:,:])[0].astype(numpy.int32)
-                result_view[...] = vigra.analysis.watersheds(volume_feat[:,:].astype(numpy.uint8))[0]
-                logger.info( "done {}".format(numpy.max(result[...]) ) )
-            else:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                
-                labelVolume = vigra.analysis.watersheds(volume_feat[:,:,0])[0].view(dtype=numpy.int32)
-                result_view[...] = labelVolume[:,:,numpy.newaxis]
-                logger.info( "done {}".format(numpy.max(labelVolume)) )
-
-        logger.info( "Watershed took {} seconds".format( watershedTimer.seconds() ) )
+        offsets, lut, blockLabels = self._getTables()
+        spatialShape = self.Input.meta.shape[1:4]
+        blockShape = self._blockShape()
+        spatialRoi = (roi.start[1:4], roi.stop[1:4])
+
+        def writeBlock(block_start):
+            block_roi = getBlockBounds( spatialShape, blockShape, block_start )
+            shape, compressed = blockLabels[tuple(block_start)]
+            labels = numpy.fromstring( zlib.decompress( compressed ), dtype=numpy.uint32 ).reshape( shape )
+            offset = offsets[tuple(block_start)]
+            block_lut = numpy.concatenate( ([0], lut[offset+1:offset+labels.max()+1]) )
+
+            intersection = getIntersection( block_roi, spatialRoi )
+            source = roiToSlice( *numpy.subtract(intersection, block_roi[0]) )
+            dest = roiToSlice( *numpy.subtract(intersection, spatialRoi[0]) )
+            result[(0,) + dest + (0,)] = block_lut[labels[source]]
+
+        pool = RequestPool()
+        for block_start in getIntersectingBlocks( blockShape, spatialRoi ):
+            pool.add( Request( partial(writeBlock, block_start) ) )
+        pool.wait()
+        pool.clean()
         return result
 
+    def _blockShape(self):
+        return tuple( numpy.minimum( self.BlockShape.value[1:4], self.Input.meta.shape[1:4] ) )
+
+    def _segmentBlock(self, block_roi):
+        """
+        Compute the watershed of a block and its halo.
+
+        Returns the labels of the block (numbered consecutively from 1) and
+        the labels of the block plus halo.  In the latter, supervoxels which
+        don't reach into the block itself are 0.
+        """
+        spatialShape = self.Input.meta.shape[1:4]
+        # The stitching needs at least one layer of halo
+        halo = max( 1, self.Halo.value )
+        start, stop = block_roi
+        halo_start = numpy.maximum( numpy.subtract(start, halo), 0 )
+        halo_stop = numpy.minimum( numpy.add(stop, halo), spatialShape )
+        volume_feat = self.Input( (0,) + tuple(halo_start) + (0,), (1,) + tuple(halo_stop) + (1,) ).wait()[0,...,0]
+
+        if spatialShape[2] > 1:
+            labels = vigra.analysis.watersheds(volume_feat.astype(numpy.uint8))[0]
+        else:
+            labels = vigra.analysis.watersheds(volume_feat[:,:,0])[0][:,:,numpy.newaxis]
+        labels = numpy.asarray(labels)
+
+        inner = roiToSlice( numpy.subtract(start, halo_start), numpy.subtract(stop, halo_start) )
+        ids = numpy.unique( labels[inner] )
+        mapping = numpy.zeros( (labels.max()+1,), dtype=numpy.uint32 )
+        mapping[ids] = numpy.arange( 1, len(ids)+1 )
+        halo_labels = mapping[labels]
+        return halo_labels[inner], (halo_labels, halo_start)
+
+    def _getTables(self):
+        """
+        Returns the offsets of the blocks' labels in the lut, the lut, and the
+        (compressed) labels of the blocks, which belong together.
+        """
+        with self._tablesLock:
+            while True:
+                with self._lock:
+                    tables, generation = self._tables, self._generation
+                if tables is not None:
+                    return tables
+                tables = self._computeTables( generation )
+                with self._lock:
+                    if generation == self._generation:
+                        self._tables = tables
+                        return tables
+                # The input changed in the meantime: start over
+
+    def _computeTables(self, generation):
+        spatialShape = self.Input.meta.shape[1:4]
+        blockShape = self._blockShape()
+        block_starts = map( tuple, getIntersectingBlocks( blockShape, roiFromShape(spatialShape) ) )
+
+        with self._lock:
+            remaining = [start for start in block_starts if start not in self._blockLabelCounts]
+        if len(remaining) < len(block_starts):
+            logger.info( "Continuing watershed: {} of {} blocks left".format( len(remaining), len(block_starts) ) )
+
+        with Timer() as watershedTimer:
+            pool = RequestPool()
+            for block_start in remaining:
+                pool.add( Request( partial(self._processBlock, block_start, generation) ) )
+            pool.wait()
+            pool.clean()
+        logger.debug( "Watershed of {} blocks took {} seconds".format( len(remaining), watershedTimer.seconds() ) )
+
+        with self._lock:
+            if generation != self._generation:
+                return None
+            assert not self._openFaces
+            blockLabels = dict( self._blockLabels )
+            offsets = {}
+            total = 0
+            for block_start in block_starts:
+                offsets[block_start] = total
+                total += self._blockLabelCounts[block_start]
+
+            edges = [(0, 0)]
+            for lower, upper, pairs in self._faceMatches:
+                for a, b in pairs:
+                    edges.append( (offsets[lower] + a, offsets[upper] + b) )
+
+        roots = mergeLabels( total+1, edges )
+        # number the stitched supervoxels consecutively
+        unique_roots, lut = numpy.unique( roots, return_inverse=True )
+        lut = lut.astype(numpy.int32)
+        logger.info( "Watershed: {} supervoxels in {} blocks".format( len(unique_roots)-1, len(block_starts) ) )
+        return offsets, lut, blockLabels
+
+    def _processBlock(self, block_start, generation):
+        spatialShape = self.Input.meta.shape[1:4]
+        block_roi = getBlockBounds( spatialShape, self._blockShape(), block_start )
+        labels, (halo_labels, halo_start) = self._segmentBlock( block_roi )
+        labels = numpy.ascontiguousarray( labels )
+        compressed = zlib.compress( labels.data, self.COMPRESSION_LEVEL )
+        start, stop = map( tuple, block_roi )
+
+        # For each face: the block's own labels at the face, and the labels
+        # its halo predicts just across the face.
+        faces = []
+        for axis in range(3):
+            def face(index):
+                key = list( roiToSlice( numpy.subtract(start, halo_start), numpy.subtract(stop, halo_start) ) )
+                key[axis] = index - halo_start[axis]
+                return halo_labels[tuple(key)]
+            if start[axis] > 0:
+                faces.append( ((start, axis), True, face(start[axis]), face(start[axis]-1)) )
+            if stop[axis] < spatialShape[axis]:
+                upper_start = list(start)
+                upper_start[axis] = stop[axis]
+                faces.append( ((tuple(upper_start), axis), False, face(stop[axis]-1), face(stop[axis])) )
+
+        with self._lock:
+            if generation != self._generation:
+                return
+            for interface, is_upper, own, predicted in faces:
+                other = self._openFaces.pop( interface, None )
+                if other is None:
+                    self._openFaces[interface] = (start, own, predicted)
+                    continue
+                other_start, other_own, other_predicted = other
+                if is_upper:
+                    lower, upper = other_start, start
+                    matches = _mutualMatches( other_predicted, own, predicted, other_own )
+                else:
+                    lower, upper = start, other_start
+                    matches = _mutualMatches( predicted, other_own, other_predicted, own )
+                self._faceMatches.append( (lower, upper, matches) )
+            self._blockLabelCounts[start] = int(labels.max())
+            self._blockLabels[start] = (labels.shape, compressed)
+
     def propagateDirty(self, slot, subindex, roi):
+        self._resetTables()
         self.Output.setDirty(slice(None))
+
+def _bestMatches(a, b):
+    """
+    For each label in a (except 0), find the label in b which it overlaps
+    most (except 0).  Returns a set of (a-label, b-label) pairs.
+    """
+    mask = (a != 0) & (b != 0)
+    keys = numpy.sort( (a[mask].astype(numpy.int64) << 32) | b[mask].astype(numpy.int64) )
+    if len(keys) == 0:
+        return set()
+    starts = numpy.concatenate( ([0], numpy.flatnonzero(numpy.diff(keys)) + 1) )
+    counts = numpy.diff( numpy.concatenate( (starts, [len(keys)]) ) )
+    keys = keys[starts]
+    alabels, blabels = keys >> 32, keys & 0xFFFFFFFF
+
+    # sort by a-label, then by count; the last entry of each a-label wins
+    order = numpy.lexsort( (counts, alabels) )
+    alabels, blabels = alabels[order], blabels[order]
+    last = numpy.concatenate( (numpy.flatnonzero(numpy.diff(alabels)), [len(alabels)-1]) )
+    return set( zip( alabels[last].tolist(), blabels[last].tolist() ) )
+
+def _mutualMatches(lower_predicted, upper_own, upper_predicted, lower_own):
+    """
+    Label pairs (lower, upper) across a block face which are each other's
+    best match: lower_predicted are the lower block's labels extrapolated
+    onto the upper block's face layer (upper_own), and vice versa.
+    """
+    forward = _bestMatches( lower_predicted, upper_own )
+    backward = _bestMatches( upper_predicted, lower_own )
+    return sorted( forward & set( (a, b) for b, a in backward ) )
     
 class OpMstSegmentorProvider(Operator):
     Image = InputSlot()
@@ -352,7 +610,11 @@ class OpPreprocessing(Operator):
         self.PreprocessedData.meta.shape = (1,)
         self.PreprocessedData.meta.dtype = object
 
-        self._opFilterCache.blockShape.setValue( self.InputData.meta.shape )
+        # All caches are blockwise: the filters, the normalization and the
+        # watershed can all be computed block by block.
+        block_shape = tuple( numpy.minimum( DEFAULT_BLOCK_SHAPE, self.InputData.meta.shape ) )
+
+        self._opFilterCache.blockShape.setValue( block_shape )
         self._opFilterCache.Input.connect( self._opFilterNormalize.Output )
 
         # If the user's boundaries are dark, then invert the special watershed sources
@@ -376,12 +638,12 @@ class OpPreprocessing(Operator):
         else:
             assert False, "Unknown Watershed source option: {}".format( ws_source )
 
-        self._opWatershedSourceCache.blockShape.setValue( self.InputData.meta.shape )
+        self._opWatershedSourceCache.blockShape.setValue( block_shape )
         self._opWatershedSourceCache.Input.connect( self._opWatershed.Input )
 
         self.WatershedSourceImage.connect( self._opWatershedSourceCache.Output )
 
-        self._opWatershedCache.blockShape.setValue( self._opWatershed.Output.meta.shape )
+        self._opWatershedCache.blockShape.setValue( block_shape )
         self._opWatershedCache.Input.connect( self._opWatershed.Output )
 
 
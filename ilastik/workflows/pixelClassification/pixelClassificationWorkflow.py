@@ -36,6 +36,7 @@ from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.featureSelection import FeatureSelectionApplet
 
 from ilastik.applets.featureSelection.opFeatureSelection import OpFeatureSelectionNoCache
+from ilastik.applets.dataExport.batchExport import ResumableBatchExport, projectFingerprint
 from ilastik.applets.pixelClassification.opPixelClassification import OpPredictionPipelineNoCache
 
 from lazyflow.roi import TinyVector, fullSlicing
@@ -79,6 +80,7 @@ class PixelClassificationWorkflow(Workflow):
         parser.add_argument('--random-label-value', help="The label value to use injecting random labels", default=1, type=int)
         parser.add_argument('--random-label-count', help="The number of random labels to inject via --generate-random-labels", default=2000, type=int)
         parser.add_argument('--retrain', help="Re-train the classifier based on labels stored in project file", action="store_true")
+        parser.add_argument('--restart-export', help="Export all batch results again, even those which were completed by an earlier run", action="store_true")
 
         # Parse the creation args: These were saved to the project file when this project was first created.
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
@@ -92,6 +94,7 @@ class PixelClassificationWorkflow(Workflow):
         self.random_label_value = parsed_args.random_label_value
         self.random_label_count = parsed_args.random_label_count
         self.retrain = parsed_args.retrain
+        self.restart_export = parsed_args.restart_export
 
         if parsed_args.filter and parsed_args.filter != parsed_creation_args.filter:
             logger.error("Ignoring new --filter setting.  Filter implementation cannot be changed after initial project creation.")
@@ -374,28 +377,30 @@ class PixelClassificationWorkflow(Workflow):
             self.pcApplet.topLevelOperator.FreezePredictions.setValue(False)
         
             # Now run the batch export and report progress....
+            # (Outputs which were completed by an earlier run with the same project
+            #  and input files are skipped, unless the classifier is retrained.)
             opBatchDataExport = self.batchResultsApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opBatchDataExport):
-                logger.info( "Exporting result {} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result {}/{} Progress: ".format( i, len( opBatchDataExport ) ) )
+            sys.stdout.write( "Exporting {} results. Progress: ".format( len( opBatchDataExport ) ) )
+            sys.stdout.flush()
+            def print_progress( progress ):
+                sys.stdout.write( "{} ".format( progress ) )
                 sys.stdout.flush()
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-                    sys.stdout.flush()
-    
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
-                opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
+
+            restart = self.restart_export or self.retrain
+            fingerprint = projectFingerprint( projectManager.currentProjectPath )
+            failures = ResumableBatchExport( opBatchDataExport, restart=restart, fingerprint=fingerprint ).run( print_progress )
+
+            # Finished.
+            sys.stdout.write("\n")
 
             if self.retrain:
                 # store re-trained classifier to file
                 projectManager.saveProject(force_all_save=False)
 
+            if failures:
+                raise RuntimeError( "{} of {} batch exports failed: {}"
+                                    .format( len(failures), len(opBatchDataExport), [path for _, path, _ in failures] ) )
+
     def _print_labels_by_slice(self, search_value):
         """
         Iterate over each label image in the project and print the number of labels present on each Z-slice of the image.
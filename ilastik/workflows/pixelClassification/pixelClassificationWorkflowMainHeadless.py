@@ -27,26 +27,20 @@ import sys
 import argparse
 import logging
 import traceback
-import hashlib
 import glob
-import pickle
 import functools
 import tempfile
 
-# Third-party
-import h5py
-
 # HCI
-from lazyflow.graph import Graph
-from lazyflow.operators.ioOperators import OpStackToH5Writer
+from lazyflow.utility import PathComponents
 
 # ilastik
 import ilastik.utility.monkey_patches
 from ilastik.shell.headless.headlessShell import HeadlessShell
 from pixelClassificationWorkflow import PixelClassificationWorkflow
 from ilastik.applets.dataSelection.opDataSelection import DatasetInfo
+from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.batchIo.opBatchIo import ExportFormat
-from lazyflow.utility import PathComponents
 import ilastik.utility.globals
 
 import ilastik.ilastik_logging
@@ -79,7 +73,8 @@ def getArgParser():
     parser.add_argument('--batch_output_suffix', default='_prediction', help='Suffix for batch output filenames (before extension).')
     parser.add_argument('--batch_output_dataset_name', default='/volume/prediction', help='HDF5 internal dataset path')
     parser.add_argument('--assume_old_ilp_axes', action='store_true', help='When importing 0.5 project files, assume axes are in the wrong order and need to be transposed.')
-    parser.add_argument('--stack_volume_cache_dir', help='The preprocessing step converts image stacks to hdf5 volumes.  The volumes will be saved to this directory.', required=False)
+    parser.add_argument('--preconvert_stacks', action='store_true', help='Convert image stacks to hdf5 volumes before processing them. (By default, stacks are read directly from the slice files.)')
+    parser.add_argument('--stack_volume_cache_dir', help='With --preconvert_stacks, the converted volumes will be saved to this directory.', required=False)
     parser.add_argument('batch_inputs', nargs='*', help='List of input files to process. Supported filenames: .h5, .npy, or globstring for stacks (e.g. *.png)')
     return parser
 
@@ -87,7 +82,7 @@ def runWorkflow(parsed_args):
     args = parsed_args
     
     # Use a temporary cache dir
-    if args.stack_volume_cache_dir is None:
+    if args.preconvert_stacks and args.stack_volume_cache_dir is None:
         args.stack_volume_cache_dir = tempfile.gettempdir()
     
     # Make sure project file exists.
@@ -140,7 +135,7 @@ def runWorkflow(parsed_args):
                                                   args.batch_export_dir,
                                                   args.batch_output_suffix,
                                                   args.batch_output_dataset_name,
-                                                  args.stack_volume_cache_dir)
+                                                  args.stack_volume_cache_dir if args.preconvert_stacks else None)
                 assert result
     finally:
         logger.info("Closing project...")
@@ -169,13 +164,16 @@ def generateProjectPredictions(shell):
     
     shell.workflow.pcApplet.dataSerializers[0].predictionStorageEnabled = False
 
-def generateBatchPredictions(workflow, batchInputPaths, batchExportDir, batchOutputSuffix, exportedDatasetName, stackVolumeCacheDir):
+def generateBatchPredictions(workflow, batchInputPaths, batchExportDir, batchOutputSuffix, exportedDatasetName, stackVolumeCacheDir=None):
     """
     Compute the predictions for each of the specified batch input files,
     and export them to corresponding h5 files.
+    If stackVolumeCacheDir is given, image stacks are converted to hdf5 volumes
+    in that directory first.  Otherwise, they are read directly.
     """
     originalBatchInputPaths = list(batchInputPaths)
-    batchInputPaths = convertStacksToH5(batchInputPaths, stackVolumeCacheDir)
+    if stackVolumeCacheDir is not None:
+        batchInputPaths = convertStacksToH5(batchInputPaths, stackVolumeCacheDir)
 
     batchInputInfos = []
     for p in batchInputPaths:
@@ -240,48 +238,7 @@ def convertStacksToH5(filePaths, stackVolumeCacheDir):
     convert the given stack to hdf5 format.  
     Return the filePaths list with globstrings replaced by the paths to the new hdf5 volumes.
     """
-    filePaths = list(filePaths)
-    for i, path in enumerate(filePaths):
-        if '*' in path:
-            globstring = path
-
-            # Embrace paranoia:
-            # We want to make sure we never re-use a stale cache file for a new dataset,
-            #  even if the dataset is located in the same location as a previous one and has the same globstring!
-            # Create a sha-1 of the file name and modification date.
-            sha = hashlib.sha1()
-            files = [k.replace('\\', '/') for k in glob.glob( path )]
-            for f in files:
-                sha.update(f)
-                sha.update(pickle.dumps(os.stat(f).st_mtime))
-            stackFile = sha.hexdigest() + '.h5'
-            stackPath = os.path.join( stackVolumeCacheDir, stackFile ).replace('\\', '/')
-            
-            # Overwrite original path
-            filePaths[i] = stackPath + "/volume/data"
-
-            # Generate the hdf5 if it doesn't already exist
-            if os.path.exists(stackPath):
-                logger.info( "Using previously generated hdf5 volume for stack {}".format(path) )
-                logger.info( "Volume path: {}".format(filePaths[i]) )
-            else:
-                logger.info( "Generating hdf5 volume for stack {}".format(path) )
-                logger.info( "Volume path: {}".format(filePaths[i]) )
-
-                if not os.path.exists( stackVolumeCacheDir ):
-                    os.makedirs( stackVolumeCacheDir )
-                
-                with h5py.File(stackPath) as f:
-                    # Configure the conversion operator
-                    opWriter = OpStackToH5Writer( graph=Graph() )
-                    opWriter.hdf5Group.setValue(f)
-                    opWriter.hdf5Path.setValue("volume/data")
-                    opWriter.GlobString.setValue(globstring)
-                    
-                    # Initiate the write
-                    success = opWriter.WriteImage.value
-        
-    return filePaths
+    return DataSelectionApplet.convertStacksToH5(filePaths, stackVolumeCacheDir)
 
 if __name__ == "__main__":
     # DEBUG ARGS
@@ -0,0 +1,100 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.autocontextClassification.opAutocontextBatch import OpAutocontextBatch
+
+class OpCountingPiper(OpArrayPiper):
+    """
+    Counts the requests for its output.
+    """
+    def __init__(self, *args, **kwargs):
+        super(OpCountingPiper, self).__init__(*args, **kwargs)
+        self.requestCount = 0
+
+    def execute(self, slot, subindex, roi, result):
+        self.requestCount += 1
+        return super(OpCountingPiper, self).execute(slot, subindex, roi, result)
+
+class TestOpAutocontextBatch(object):
+
+    def setUp(self):
+        # Wider than the largest context radius (40 pixels along x and y), so the blocks' halos are clipped
+        shape = (1, 96, 90, 8, 2)
+        features = numpy.random.random(shape).astype(numpy.float32)
+
+        graph = Graph()
+        self.opFeatures = OpCountingPiper( graph=graph )
+        self.opFeatures.Input.setValue( vigra.taggedView(features, 'txyzc') )
+
+        op = OpAutocontextBatch( graph=graph )
+        op.FeatureImage.connect( self.opFeatures.Output )
+        op.MaxLabelValue.setValue( 2 )
+        op.AutocontextIterations.setValue( 2 )
+        op.Classifiers.resize( 2 )
+        op.setupOperators()
+
+        # Each stage's classifier is trained on that stage's features, as soon as they are known
+        for stage, predictor in enumerate(op.predictors):
+            nfeatures = predictor.Image.meta.shape[-1]
+            samples = numpy.random.random( (200, nfeatures) ).astype(numpy.float32)
+            labels = (samples[:,0] > 0.5).astype(numpy.uint32)[:,None] + 1
+            forest = vigra.learning.RandomForest( treeCount=10 )
+            forest.learnRF( samples, labels )
+            op.Classifiers[stage].setValue( numpy.array([forest]) )
+        self.op = op
+
+    def testBlockwiseMatchesWholeVolume(self):
+        op = self.op
+        op.BlockEdge = 32
+        op.BlockDepth = 4
+
+        # The output is the last stage, predicted from the whole volume at once
+        expected = op.predictors[-1].PMaps[:].wait()
+        assert op.PredictionProbabilities.meta.shape == expected.shape
+
+        result = op.PredictionProbabilities[:].wait()
+        assert numpy.allclose( result, expected )
+
+        # A region which cuts through the blocks
+        result = op.PredictionProbabilities[:, 20:70, 10:80, 2:7, :].wait()
+        assert numpy.allclose( result, expected[:, 20:70, 10:80, 2:7, :] )
+
+    def testFeaturesReadOncePerBlock(self):
+        op = self.op
+        op.BlockEdge = 32
+        op.BlockDepth = 4
+
+        self.opFeatures.requestCount = 0
+        op.PredictionProbabilities[:].wait()
+
+        # 3 x 3 x 2 blocks, and all stages share each block's features
+        assert self.opFeatures.requestCount == 18, self.opFeatures.requestCount
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
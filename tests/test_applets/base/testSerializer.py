@@ -207,6 +207,29 @@ class TestSerializer(unittest.TestCase):
         ss = self.serializer.TestSerialListSlot
         self._testList(slot, ss, [7, 8, 9], [10, 11, 12])
 
+    def testDeferredLoad(self):
+        # Pretend the list holds bulk data
+        self.serializer.TestSerialListSlot.deferrable = True
+        value = randArray()
+        self.operator.TestSlot.setValue(value)
+        self.operator.TestListSlot.setValue([1, 2, 3])
+        self.serializer.serializeToHdf5(self.projectFile, self.projectFilePath)
+
+        self.operator.TestSlot.setValue(randArray())
+        self.operator.TestListSlot.setValue([4, 5])
+        self.serializer.ignoreDirty = True # (As the project manager does while loading)
+        loadDeferred = self.serializer.deserializeFromHdf5Deferred(self.projectFile, self.projectFilePath)
+        self.assertTrue(numpy.all(self.operator.TestSlot.value == value))
+        self.assertEqual(self.operator.TestListSlot.value, [4, 5])
+
+        # Changes of the slots which have been read are tracked right away
+        self.assertFalse(self.serializer.TestSerialSlot.ignoreDirty)
+        self.assertTrue(self.serializer.TestSerialListSlot.ignoreDirty)
+
+        loadDeferred()
+        self.assertEqual(self.operator.TestListSlot.value, [1, 2, 3])
+        self.assertFalse(self.serializer.TestSerialListSlot.ignoreDirty)
+
 class TestSerialDictSlot(unittest.TestCase):
     
     class OpWithDictSlot(Operator):
@@ -318,5 +341,113 @@ class TestSerialBlockSlot(unittest.TestCase):
         assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
         assert ( opLabelArrays.Output[0][11:12, 10:20, 10:20, 0:1].wait() == 2 ).all()
 
+    def testStorageLayout(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+
+        # All blocks of a subslot end up in a single dataset
+        with h5py.File(h5_filepath, 'r') as f:
+            subgroup = f['label_data/Output/0']
+            assert set(subgroup.keys()) == set(['blockdata', 'blockindex'])
+            assert len(subgroup['blockindex']) == 2
+
+    def testIncrementalSave(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            assert len(label_group['Output/0/blockindex']) == 2
+
+            # Only the changed block is appended
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 3*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            slotSerializer.serialize( label_group )
+            assert len(label_group['Output/0/blockindex']) == 3
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 3 ).all()
+
+    def testDeletionsAndCompaction(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+
+            # Erasing a block appends a deletion
+            slotSerializer.COMPACTION_THRESHOLD = 1.0
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            slotSerializer.serialize( label_group )
+            blockindex = label_group['Output/0/blockindex'][...]
+            assert len(blockindex) == 3
+            assert blockindex[-1]['nbytes'] == -1
+            assert tuple(blockindex[-1]['blockstart']) == (50, 50, 50, 0)
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0 ).all()
+
+        # Rewrite a block until most of the journal is superseded
+        with h5py.File(h5_filepath, 'a') as f:
+            label_group = f['label_data']
+            for value in range(3, 10):
+                opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = value*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+                slotSerializer.serialize( label_group )
+                if len(label_group['Output/0/blockindex']) == 1:
+                    break
+            else:
+                assert False, "The journal was never compacted"
+
+            # Only the live block is left
+            blockindex = label_group['Output/0/blockindex'][...]
+            assert tuple(blockindex[0]['blockstart']) == (10, 10, 10, 0)
+            assert len(label_group['Output/0/blockdata']) == blockindex[0]['nbytes']
+
+            # The compacted journal can be appended to
+            opLabelArrays.Input[0][20:21, 20:30, 20:30, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            slotSerializer.serialize( label_group )
+            assert len(label_group['Output/0/blockindex']) == 2
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == value ).all()
+        assert ( opLabelArrays.Output[0][20:21, 20:30, 20:30, 0:1].wait() == 2 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0 ).all()
+
+    def testOldFormat(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+
+        # Write one dataset per block, as older versions did
+        with h5py.File(h5_filepath, 'w') as f:
+            subgroup = f.create_group('label_data/Output/0')
+            subgroup.create_dataset('block0000', data=numpy.ones((1,10,10,1), dtype=numpy.uint32))
+            subgroup['block0000'].attrs['blockSlice'] = '[10:11,10:20,10:20,0:1]'
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][11:12, 10:20, 10:20, 0:1].wait() == 0 ).all()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
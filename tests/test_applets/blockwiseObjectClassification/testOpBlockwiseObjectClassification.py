@@ -28,6 +28,7 @@ import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import Op5ifyer
 
+from ilastik.utility import bind
 from ilastik.applets import objectExtraction
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
@@ -105,6 +106,51 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
  
+    def testMemoryBudget(self):
+        # A tiny budget allows only a single cached pipeline, so blocks are
+        # discarded and re-created, but the result must not change.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.MaxConcurrentBlocks.setValue( 1 )
+        self.op.MemoryBudgetMb.setValue( 1 )
+        assert self.op._maxWorkers == 1
+        assert self.op._maxPipelines == 1
+
+        pred = self.op.PredictionImage[:].wait()
+        assert len(self.op._blockPipelines) <= 1
+        if not (pred == self.prediction_volume).all():
+            self.logImage(pred, "memory_budget_failed_prediction_")
+            assert False, \
+                "Blockwise prediction operator did not produce the same prediction image" \
+                "as the non-blockwise prediction operator!"
+
+    def testDirtyAfterEviction(self):
+        # Blocks whose pipelines were discarded must still be marked dirty
+        # when the classifier changes.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.MaxConcurrentBlocks.setValue( 1 )
+        self.op.MemoryBudgetMb.setValue( 1 )
+        self.op.PredictionImage[:].wait()
+        assert len(self.op._blockPipelines) <= 1
+
+        dirty_rois = { 'prediction' : [], 'probabilities' : [] }
+        def handleDirty(key, slot, roi):
+            dirty_rois[key].append( (tuple(roi.start), tuple(roi.stop)) )
+        self.op.PredictionImage.notifyDirty( bind(handleDirty, 'prediction') )
+        self.op.ProbabilityChannelImage.notifyDirty( bind(handleDirty, 'probabilities') )
+
+        self.classifier.Classifier.setDirty( slice(None) )
+        full_roi = ( (0,)*5, self.op.PredictionImage.meta.shape )
+        assert full_roi in dirty_rois['prediction'], dirty_rois['prediction']
+        assert len(dirty_rois['probabilities']) > 0
+
+        # A raw data change marks the blocks whose halo it touches
+        dirty_rois['prediction'] = []
+        self.op.RawImage.setDirty( (0, 45, 5, 5, 0), (1, 46, 6, 6, 1) )
+        expected = ( (0, 0, 0, 0, 0), (1, 80, 40, 40, 1) )
+        assert expected in dirty_rois['prediction'], dirty_rois['prediction']
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
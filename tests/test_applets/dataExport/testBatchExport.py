@@ -0,0 +1,135 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import json
+import tempfile
+import shutil
+
+import numpy
+import vigra
+import h5py
+
+from lazyflow.graph import Graph, OperatorWrapper
+
+from ilastik.applets.dataExport.opDataExport import OpDataExport
+from ilastik.applets.dataExport.batchExport import ResumableBatchExport, JOURNAL_SUFFIX
+
+class TestBatchExport(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class MockDatasetInfo(object): pass
+
+        self.opExport = OperatorWrapper( OpDataExport, graph=Graph(),
+                                         promotedSlotNames=set(['RawData', 'Inputs', 'RawDatasetInfo']) )
+        self.opExport.TransactionSlot.setValue(True)
+        self.opExport.WorkingDirectory.setValue( self.tmpdir )
+        self.opExport.SelectionNames.setValue( ['Mock Export Data'] )
+        self.opExport.OutputFormat.setValue( 'hdf5' )
+        self.opExport.OutputFilenameFormat.setValue( '{dataset_dir}/{nickname}_export' )
+        self.opExport.OutputInternalPath.setValue( 'volume/data' )
+
+        self.data = []
+        self.opExport.RawDatasetInfo.resize(3)
+        self.opExport.Inputs.resize(3)
+        for i in range(3):
+            rawInfo = MockDatasetInfo()
+            rawInfo.nickname = 'image{}'.format(i)
+            rawInfo.filePath = './image{}.h5'.format(i)
+            self.opExport.RawDatasetInfo[i].setValue( rawInfo )
+
+            data = numpy.random.random( (256,64,64,1) ).astype( numpy.float32 )
+            data = vigra.taggedView( data, 'xyzc' )
+            self.data.append( data )
+            self.opExport.Inputs[i].resize(1)
+            self.opExport.Inputs[i][0].setValue( data )
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def _export(self, **kwargs):
+        # Blocks of a single chunk, so each image is written in four blocks
+        return ResumableBatchExport( self.opExport, blockBytes=64**3 * 4, **kwargs ).run()
+
+    def _read(self, i):
+        with h5py.File( os.path.join( self.tmpdir, 'image{}_export.h5'.format(i) ), 'r' ) as f:
+            return f['volume/data'][:]
+
+    def testExportAndResume(self):
+        assert self._export() == []
+        for i in range(3):
+            assert (self._read(i) == self.data[i]).all()
+
+        # Simulate an interrupted export of the second image:
+        #  Drop the last two blocks (and the completion) from its journal, and erase their data.
+        path = os.path.join( self.tmpdir, 'image1_export.h5' )
+        with open( path + JOURNAL_SUFFIX, 'r' ) as f:
+            records = f.readlines()
+        assert json.loads( records[-1] ) == { 'complete' : True }
+        droppedBlocks = [ json.loads(line)['block'] for line in records[-3:-1] ]
+        with open( path + JOURNAL_SUFFIX, 'w' ) as f:
+            f.writelines( records[:-3] )
+        with h5py.File( path, 'r+' ) as f:
+            for start in droppedBlocks:
+                f['volume/data'][ start[0]:start[0]+64 ] = 0
+
+        # Also modify a complete image, which must not be exported again.
+        with h5py.File( os.path.join( self.tmpdir, 'image0_export.h5' ), 'r+' ) as f:
+            f['volume/data'][0,0,0] = 42
+
+        assert self._export() == []
+        assert (self._read(1) == self.data[1]).all()
+        assert self._read(0)[0,0,0] == 42
+
+    def testExportAgainIfChanged(self):
+        def modifyOutput():
+            with h5py.File( os.path.join( self.tmpdir, 'image0_export.h5' ), 'r+' ) as f:
+                f['volume/data'][0,0,0] = 42
+
+        assert self._export( fingerprint={'classifier' : 1} ) == []
+        modifyOutput()
+        assert self._export( fingerprint={'classifier' : 1} ) == []
+        assert self._read(0)[0,0,0] == 42
+
+        # A different fingerprint (e.g. a modified project) invalidates the results
+        assert self._export( fingerprint={'classifier' : 2} ) == []
+        assert (self._read(0) == self.data[0]).all()
+
+        # So does a modified input file
+        modifyOutput()
+        inputPath = os.path.join( self.tmpdir, 'image0.h5' )
+        with h5py.File( inputPath, 'w' ) as f:
+            f.create_dataset( 'data', data=self.data[0] )
+        assert self._export( fingerprint={'classifier' : 2} ) == []
+        assert (self._read(0) == self.data[0]).all()
+
+        # And an explicit restart
+        modifyOutput()
+        assert self._export( fingerprint={'classifier' : 2}, restart=True ) == []
+        assert (self._read(0) == self.data[0]).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
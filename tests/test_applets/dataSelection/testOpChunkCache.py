@@ -0,0 +1,104 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import threading
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.dataSelection.internalStorage import OpChunkCache
+
+class OpSlowPiper(OpArrayPiper):
+    """Counts the requests to its output, and takes a while to serve them."""
+    def __init__(self, *args, **kwargs):
+        super(OpSlowPiper, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.requestCount = 0
+
+    def execute(self, slot, subindex, roi, result):
+        with self.lock:
+            self.requestCount += 1
+        time.sleep(0.2)
+        return super(OpSlowPiper, self).execute(slot, subindex, roi, result)
+
+class TestOpChunkCache(object):
+
+    def setUp(self):
+        self.data = numpy.random.randint(0, 255, (40, 50, 2)).astype(numpy.uint8)
+        self.data = vigra.taggedView(self.data, 'xyc')
+
+        graph = Graph()
+        self.opPiper = OpArrayPiper( graph=graph )
+        self.opPiper.Input.setValue( self.data )
+
+        self.opCache = OpChunkCache( graph=graph )
+        self.opCache.Input.connect( self.opPiper.Output )
+        self.opCache.ChunkShape.setValue( (20, 25, 2) )
+
+    def testRead(self):
+        assert (self.opCache.Output[:].wait() == self.data).all()
+        assert (self.opCache.Output[5:30, 10:20, 1:2].wait() == self.data[5:30, 10:20, 1:2]).all()
+        assert len(self.opCache._chunks) == 4
+
+    def testEvictConsumed(self):
+        self.opCache.EvictConsumed.setValue( True )
+
+        # The first chunk is read in two halves, and dropped after the second one
+        assert (self.opCache.Output[0:10, 0:25, :].wait() == self.data[0:10, 0:25, :]).all()
+        assert (0,0,0) in self.opCache._chunks
+        assert (self.opCache.Output[10:20, 0:25, :].wait() == self.data[10:20, 0:25, :]).all()
+        assert (0,0,0) not in self.opCache._chunks
+
+        # Reading it again still works
+        assert (self.opCache.Output[0:20, 0:25, :].wait() == self.data[0:20, 0:25, :]).all()
+        assert len(self.opCache._chunks) == 0
+
+    def testEvictConsumedOverlapping(self):
+        self.opCache.EvictConsumed.setValue( True )
+
+        # Reading the same half of the chunk twice doesn't count as reading all of it
+        for _ in range(2):
+            assert (self.opCache.Output[0:10, 0:25, :].wait() == self.data[0:10, 0:25, :]).all()
+        assert (0,0,0) in self.opCache._chunks
+        assert (self.opCache.Output[5:20, 0:25, :].wait() == self.data[5:20, 0:25, :]).all()
+        assert (0,0,0) not in self.opCache._chunks
+
+    def testConcurrentMisses(self):
+        opSlow = OpSlowPiper( graph=self.opPiper.graph )
+        opSlow.Input.setValue( self.data )
+        self.opCache.Input.connect( opSlow.Output )
+
+        # Requests for the same chunk which arrive while it is being read share that read
+        requests = [ self.opCache.Output[0:5*i, 0:25, :] for i in range(1, 5) ]
+        for request in requests:
+            request.submit()
+        for i, request in enumerate(requests):
+            assert (request.wait() == self.data[0:5*(i+1), 0:25, :]).all()
+        assert opSlow.requestCount == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
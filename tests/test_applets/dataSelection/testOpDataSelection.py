@@ -24,6 +24,7 @@ import vigra
 import lazyflow
 import h5py
 from lazyflow.graph import OperatorWrapper
+from lazyflow.operators.ioOperators import OpStackLoader
 from ilastik.applets.dataSelection.opDataSelection import OpDataSelection, DatasetInfo
 
 import tempfile
@@ -51,18 +52,28 @@ class TestOpDataSelection_Basic():
                     cls.pngData[x,y,c] = (x+y) % 256
         vigra.impex.writeImage(cls.pngData, cls.testPngFileName)
 
+        # An image stack (one slice per file)
+        cls.stackGlobString = os.path.join(cls.tmpdir, 'testStack*.png')
+        cls.stackFileNames = []
+        for z in range(6):
+            cls.stackFileNames.append( os.path.join(cls.tmpdir, 'testStack{}.png'.format(z)) )
+            vigra.impex.writeImage((cls.pngData + z) % 256, cls.stackFileNames[-1])
+
         # Create a 'project' file and give it some data
         cls.projectFile = h5py.File(cls.projectFileName)
         cls.projectFile.create_group('DataSelection')
         cls.projectFile['DataSelection'].create_group('local_data')
         # Use the same data as the png data (above)
         cls.projectFile['DataSelection/local_data'].create_dataset('dataset1', data=cls.pngData)
+        # ...and again, compressed (as the DataSelectionSerializer stores it)
+        cls.projectFile['DataSelection/local_data'].create_dataset('dataset2', data=cls.pngData,
+                                                                   chunks=(32,64,3), compression='lzf')
         cls.projectFile.flush()
     
     @classmethod
     def teardownClass(cls):
         cls.projectFile.close()
-        for path in [ cls.testNpyFileName, cls.testPngFileName, cls.projectFileName ]:
+        for path in [ cls.testNpyFileName, cls.testPngFileName, cls.projectFileName ] + cls.stackFileNames:
             try:
                 os.remove(path)
             except:
@@ -252,6 +263,48 @@ class TestOpDataSelection_Basic():
         assert projectInternalData.shape == self.pngData.shape
         assert (projectInternalData == self.pngData).all()
 
+    def testCompressedProjectLocalData(self):
+        graph = lazyflow.graph.Graph()
+        reader = OperatorWrapper( OpDataSelection, graph=graph )
+        reader.ProjectFile.setValue(self.projectFile)
+        reader.WorkingDirectory.setValue( os.getcwd() )
+        reader.ProjectDataGroup.setValue( 'DataSelection/local_data' )
+
+        info = DatasetInfo()
+        info.location = DatasetInfo.Location.ProjectInternal
+        info.filePath = "This string should be ignored..."
+        info._datasetId = 'dataset2' # (Cheating a bit here...)
+        reader.Dataset.setValues([info])
+
+        # Read a slice which isn't aligned to the chunks twice (the second time from the chunk cache)
+        for _ in range(2):
+            projectInternalData = reader.Image[0][10:50, 30:31, :].wait()
+            assert (projectInternalData == self.pngData[10:50, 30:31, :]).all()
+
+        projectInternalData = reader.Image[0][...].wait()
+        assert (projectInternalData == self.pngData).all()
+
+    def testStack(self):
+        graph = lazyflow.graph.Graph()
+        reader = OperatorWrapper( OpDataSelection, graph=graph )
+        reader.WorkingDirectory.setValue( os.getcwd() )
+
+        info = DatasetInfo()
+        info.location = DatasetInfo.Location.FileSystem
+        info.filePath = self.stackGlobString
+        reader.Dataset.setValues([info])
+
+        opLoader = OpStackLoader( graph=graph )
+        opLoader.globstring.setValue( self.stackGlobString )
+        expected = opLoader.stack[:].wait()
+        opLoader.cleanUp()
+
+        # Read the stack slice by slice (with read-ahead), then a roi across slices
+        for z in range(expected.shape[0]):
+            assert (reader.Image[0][z:z+1, ...].wait() == expected[z:z+1]).all()
+        assert (reader.Image[0][1:4, 10:20, 5:50, :].wait() == expected[1:4, 10:20, 5:50, :]).all()
+        assert (reader.Image[0][...].wait() == expected).all()
+
 if __name__ == "__main__":
     import nose
     nose.run(defaultTest=__file__, env={'NOSE_NOCAPTURE' : 1})
@@ -0,0 +1,79 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import vigra
+import h5py
+
+from lazyflow.graph import Graph
+from lazyflow.operators.ioOperators import OpStackLoader
+from ilastik.applets.dataSelection.stackImport import importStack
+
+class TestStackImport(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.globstring = os.path.join(self.tmpdir, 'slice*.png')
+        for z in range(5):
+            self._writeSlice(z, z)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _writeSlice(self, z, value):
+        data = numpy.zeros((20, 30), dtype=numpy.uint8)
+        data[:] = value
+        data[z, :] = 255
+        vigra.impex.writeImage(data, os.path.join(self.tmpdir, 'slice{:02d}.png'.format(z)))
+
+    def _readStack(self):
+        opLoader = OpStackLoader( graph=Graph() )
+        opLoader.globstring.setValue( self.globstring )
+        data = opLoader.stack[:].wait()
+        opLoader.cleanUp()
+        return data
+
+    def testImportAndUpdate(self):
+        h5_path = os.path.join(self.tmpdir, 'volume.h5')
+        with h5py.File(h5_path, 'w') as f:
+            index = f.create_group('index')
+            dataset = importStack( self.globstring, f.create_group('volume'), 'data', indexGroup=index )
+            assert (dataset[...] == self._readStack()).all()
+            assert 'data' in index
+
+        # Change one slice (and make sure its modification time changes, too)
+        self._writeSlice(3, 100)
+        path = os.path.join(self.tmpdir, 'slice03.png')
+        os.utime(path, (os.stat(path).st_atime, os.stat(path).st_mtime + 10))
+
+        with h5py.File(h5_path, 'a') as f:
+            dataset = importStack( self.globstring, f['volume'], 'data', indexGroup=f['index'] )
+            assert (dataset[...] == self._readStack()).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -20,6 +20,7 @@
 ###############################################################################
 import os
 import numpy
+import h5py
 from lazyflow.roi import sliceToRoi
 from lazyflow.graph import Graph, OperatorWrapper
 from lazyflow.operators.ioOperators import OpInputDataReader
@@ -127,6 +128,47 @@ class TestOpFeatureSelection(object):
         assert len(dirtyRois) == 1
         assert (dirtyRois[0].start, dirtyRois[0].stop) == sliceToRoi( slice(None), self.opFeatures.OutputImage[0].meta.shape )
 
+    def testPrecomputedFeatures(self):
+        tmpdir = os.path.dirname(self.filePath)
+        shape = self.opReader.Output.meta.shape[:-1]
+
+        # One single-channel float feature and a chunked two-channel uint8 feature
+        feature1 = numpy.random.random(shape).astype(numpy.float32)
+        feature2 = numpy.random.randint(0, 255, size=shape+(2,)).astype(numpy.uint8)
+        paths = [ os.path.join(tmpdir, 'feature1.h5'), os.path.join(tmpdir, 'feature2.h5') ]
+        with h5py.File(paths[0], 'w') as f:
+            f.create_dataset('data', data=feature1)
+        with h5py.File(paths[1], 'w') as f:
+            f.create_dataset('data', data=feature2, chunks=(1,32,32,32,2))
+
+        listPath = os.path.join(tmpdir, 'features.txt')
+        with open(listPath, 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+
+        opFeatures = self.opFeatures
+        opFeatures.FeatureListFilename.setValue( listPath )
+
+        assert opFeatures.OutputImage[0].meta.shape == shape + (3,)
+        assert len(opFeatures.FeatureLayers[0]) == 2
+
+        # Read twice (the second time from the cache)
+        for _ in range(2):
+            result = opFeatures.OutputImage[0][1:2, 10:50, 20:30, 5:70, 0:3].wait()
+            assert (result[...,0] == feature1[1:2, 10:50, 20:30, 5:70]).all()
+            assert (result[...,1:] == feature2[1:2, 10:50, 20:30, 5:70]).all()
+
+        cached = opFeatures.CachedOutputImage[0][1:2, 10:50, 20:30, 5:70, 1:2].wait()
+        assert (cached[...,0] == feature2[1:2, 10:50, 20:30, 5:70, 0]).all()
+
+        layer = opFeatures.FeatureLayers[0][0][0:1, 0:10, 0:10, 0:10, :].wait()
+        assert (layer[...,0] == feature1[0:1, 0:10, 0:10, 0:10]).all()
+
+        # Without a feature list, the feature files are closed again
+        opFeatures.FeatureListFilename.setValue( '' )
+        assert len(opFeatures.innerOperators[0].opPrecomputedFeatures._files) == 0
+        for path in paths + [listPath]:
+            os.remove(path)
+
 if __name__ == "__main__":
     import sys
     import nose
@@ -25,6 +25,7 @@ import unittest
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
+from lazyflow.rtype import List
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
@@ -233,6 +234,27 @@ class TestOpObjectPredict(unittest.TestCase):
         
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
+
+    def test_timestep_invalidation(self):
+        ###
+        # dirty features for one time step must not discard the predictions of the others
+        ###
+        probs = self.op.Probabilities([0, 1]).wait()
+        cached = self.op.CachedProbabilities([0, 1]).wait()
+        self.assertEqual( set(cached.keys()), set([0, 1]) )
+
+        features = self._opRegFeatsAdaptOutput.Output
+        features.setDirty(List(features, [1]))
+        cached = self.op.CachedProbabilities([0, 1]).wait()
+        self.assertEqual( set(cached.keys()), set([0]) )
+
+        newprobs = self.op.Probabilities([0, 1]).wait()
+        self.assertTrue( np.all(newprobs[1]==probs[1]) )
+
+        # a new classifier invalidates everything
+        self.trainop.Classifier.setDirty()
+        cached = self.op.CachedProbabilities([0, 1]).wait()
+        self.assertEqual( len(cached), 0 )
         
 
  
@@ -24,6 +24,7 @@ import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import OpLabelImage
 from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpObjectExtraction
+from ilastik.applets.objectExtraction import opObjectExtraction
 from ilastik.plugins import pluginManager
 
 import warnings
@@ -203,6 +204,153 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     assert abs(coord-center_good)<0.01
 
 
+class TestLocalFeatureBatches(object):
+    def setUp(self):
+        g = Graph()
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Mean in neighborhood" : {"margin" : (30, 30, 1)},
+                "Sum in neighborhood" : {"margin" : (30, 30, 1)}
+            }
+        }
+        self.labelop = OpLabelImage(graph=g)
+        self.labelop.Input.setValue(binaryImage())
+        self.op = OpRegionFeatures(graph=g)
+        self.op.LabelImage.connect(self.labelop.Output)
+        self.op.RawImage.setValue(rawImage())
+        self.op.Features.setValue(self.features)
+        self.opAdapt = OpAdaptTimeListRoi(graph=g)
+        self.opAdapt.Input.connect(self.op.Output)
+        self.batch_size = opObjectExtraction.LOCAL_FEATURES_BATCH_SIZE
+
+    def tearDown(self):
+        opObjectExtraction.LOCAL_FEATURES_BATCH_SIZE = self.batch_size
+
+    def test_batch_size_does_not_change_result(self):
+        expected = self.opAdapt.Output([0, 1]).wait()
+
+        # one object per batch
+        opObjectExtraction.LOCAL_FEATURES_BATCH_SIZE = 1
+        self.op.Features.setDirty(slice(None))
+        feats = self.opAdapt.Output([0, 1]).wait()
+
+        for t in expected:
+            for key, value in expected[t][NAME].iteritems():
+                assert np.all(feats[t][NAME][key] == value), key
+
+    def test_compute_local_batch_matches_compute_local(self):
+        plugin = pluginManager.getPluginByName(NAME, "ObjectFeatures").plugin_object
+        plugin.ndim = 3
+        raw = rawImage()[0]
+        binary = np.asarray(binaryImage()[0]) > 0
+        feature_dict = self.features[NAME]
+
+        class Axes(object):
+            x = 0
+            y = 1
+            z = 2
+            c = 3
+        axes = Axes()
+
+        rawbboxes = [raw[0:20, 0:20, 0:11, :], raw[10:40, 10:40, 19:31, :]]
+        bboxes = [binary[0:20, 0:20, 0:11, 0], binary[10:40, 10:40, 19:31, 0]]
+        batch = plugin.compute_local_batch(rawbboxes, bboxes, feature_dict, axes)
+        for i in range(len(bboxes)):
+            single = plugin.compute_local(rawbboxes[i], bboxes[i], feature_dict, axes)
+            for key, value in single.iteritems():
+                assert np.all(batch[key][i] == value), key
+
+        # a canvas budget below the size of two boxes: the batch is split
+        rawbboxes.append(raw[5:25, 30:45, 5:16, :])
+        bboxes.append(binary[5:25, 30:45, 5:16, 0])
+        plugin.max_canvas_bytes = 40 * 40 * 12 * 4 * (1 + raw.shape[3])
+        try:
+            assert len(plugin._batch_groups(rawbboxes, bboxes, axes)) == 2
+            batch = plugin.compute_local_batch(rawbboxes, bboxes, feature_dict, axes)
+        finally:
+            del plugin.max_canvas_bytes
+        for i in range(len(bboxes)):
+            single = plugin.compute_local(rawbboxes[i], bboxes[i], feature_dict, axes)
+            for key, value in single.iteritems():
+                assert np.all(batch[key][i] == value), key
+
+
+class TestStreamingRegionFeatures(object):
+    def setUp(self):
+        g = Graph()
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Mean" : {},
+                "Sum" : {},
+                "Variance" : {},
+                "Skewness" : {},
+                "Kurtosis" : {},
+                "Minimum" : {},
+                "Maximum" : {},
+                "RegionCenter" : {},
+            }
+        }
+        self.labelop = OpLabelImage(graph=g)
+        self.labelop.Input.setValue(binaryImage())
+        self.op = OpRegionFeatures(graph=g)
+        self.op.LabelImage.connect(self.labelop.Output)
+        self.op.RawImage.setValue(rawImage())
+        self.op.Features.setValue(self.features)
+        self.opAdapt = OpAdaptTimeListRoi(graph=g)
+        self.opAdapt.Input.connect(self.op.Output)
+
+    def test_streaming_matches_whole_volume(self):
+        expected = self.opAdapt.Output([0, 1]).wait()
+
+        # blocks that cut through the objects
+        self.op.StreamingBlockShape.setValue({'x' : 7, 'y' : 13, 'z' : 25})
+        feats = self.opAdapt.Output([0, 1]).wait()
+
+        for t in expected:
+            for plugin in (NAME, opObjectExtraction.default_features_key):
+                assert set(feats[t][plugin].keys()) == set(expected[t][plugin].keys())
+                for key, value in expected[t][plugin].iteritems():
+                    assert feats[t][plugin][key].shape == value.shape, key
+                    assert np.allclose(feats[t][plugin][key], value, rtol=1e-4), key
+
+    def test_region_statistics_merge(self):
+        from ilastik.applets.objectExtraction.regionStatistics import RegionStatistics
+
+        labels = np.random.randint(0, 5, size=(20, 30))
+        # a large mean, compared to the spread, must not cancel out the higher moments
+        raw = 1e6 + np.random.random((20, 30, 2))
+
+        whole = RegionStatistics(2, 2)
+        whole.add_block(raw, labels, (0, 0))
+
+        left = RegionStatistics(2, 2)
+        left.add_block(raw[:, :11], labels[:, :11], (0, 0))
+        right = RegionStatistics(2, 2)
+        right.add_block(raw[:, 11:], labels[:, 11:], (0, 11))
+        left.merge(right)
+
+        names = ["Count", "Mean", "Variance", "Skewness", "Kurtosis",
+                 "Coord<Minimum>", "Coord<Maximum>"]
+        feats = left.features(names)
+        for name, value in whole.features(names).iteritems():
+            assert np.allclose(feats[name], value), name
+
+        for label in range(1, 5):
+            values = raw[labels == label]
+            assert feats["Count"][label-1, 0] == len(values)
+            assert np.allclose(feats["Mean"][label-1], values.mean(axis=0))
+            assert np.allclose(feats["Variance"][label-1], values.var(axis=0))
+            deviations = values - values.mean(axis=0)
+            m2, m3, m4 = [(deviations**k).mean(axis=0) for k in (2, 3, 4)]
+            assert np.allclose(feats["Skewness"][label-1], m3 / m2**1.5)
+            assert np.allclose(feats["Kurtosis"][label-1], m4 / m2**2 - 3.0)
+            coords = np.transpose(np.nonzero(labels == label))
+            assert np.all(feats["Coord<Minimum>"][label-1] == coords.min(axis=0))
+            assert np.all(feats["Coord<Maximum>"][label-1] == coords.max(axis=0))
+
+
 if __name__ == '__main__':
     import sys
     import nose
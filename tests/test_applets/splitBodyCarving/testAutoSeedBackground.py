@@ -0,0 +1,163 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.splitBodyCarving.opSplitBodyCarving import OpSplitBodyCarving, OpLabelBoundingBoxes, \
+                                                               _blockBoundingBoxes, _groupExtrema
+
+def referenceBoundingBoxes( labels ):
+    boxes = {}
+    for label in numpy.unique( labels ):
+        if label != 0:
+            coords = numpy.nonzero( labels == label )
+            boxes[int(label)] = ( tuple( c.min() for c in coords ), tuple( c.max()+1 for c in coords ) )
+    return boxes
+
+class TestBoundingBoxes(object):
+
+    def setUp(self):
+        # Sparse labels, so that some labels don't occur in some blocks
+        labels = numpy.random.randint( 0, 30, size=(1, 50, 40, 30, 1) ).astype( numpy.uint32 )
+        labels[ labels > 8 ] = 0
+        labels[0, 45:48, 2:5, 20:22, 0] = 9 # Within a single block
+        self.labels = labels
+
+    def testGroupExtrema(self):
+        labels = numpy.array( [3, 1, 3, 2, 1] )
+        mins = numpy.array( [[5, 1], [2, 2], [1, 7], [0, 0], [4, 0]] )
+        maxs = numpy.array( [[6, 3], [2, 9], [3, 8], [1, 1], [5, 1]] )
+        labels, mins, maxs = _groupExtrema( labels, mins, maxs )
+        assert list(labels) == [1, 2, 3]
+        assert mins.tolist() == [[2, 0], [0, 0], [1, 1]]
+        assert maxs.tolist() == [[5, 9], [1, 1], [6, 8]]
+
+    def testBlockBoundingBoxes(self):
+        block = self.labels[0, 5:30, 7:29, 3:19, 0]
+        labels, mins, maxs = _blockBoundingBoxes( block )
+        expected = referenceBoundingBoxes( block )
+        assert sorted( labels.tolist() ) == sorted( expected.keys() )
+        for label, start, stop in zip( labels, mins, maxs ):
+            assert expected[label] == ( tuple(start), tuple(stop+1) )
+
+    def testOpLabelBoundingBoxes(self):
+        op = OpLabelBoundingBoxes( graph=Graph() )
+        op.BLOCK_SIZE = 16
+        op.Input.setValue( vigra.taggedView( self.labels, 'txyzc' ) )
+        assert op.BoundingBoxes.value == referenceBoundingBoxes( self.labels )
+
+class ArrayAccess(object):
+    """
+    Stands in for the label array of the carving lane: reads and writes a numpy array.
+    """
+    class Result(object):
+        def __init__(self, data):
+            self._data = data
+        def wait(self):
+            return self._data
+
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, slicing):
+        return ArrayAccess.Result( self.array[slicing].copy() )
+
+    def __setitem__(self, slicing, value):
+        self.array[slicing] = value
+
+class LaneView(object):
+    """
+    The slots of an OpSplitBodyCarving lane which autoSeedBackground uses.
+    """
+    def __init__(self, labels, seeds):
+        graph = Graph()
+        self._opLabels = OpArrayPiper( graph=graph )
+        self._opLabels.Input.setValue( vigra.taggedView( labels, 'txyzc' ) )
+        self.RavelerLabels = self._opLabels.Output
+
+        self._opBoundingBoxes = OpLabelBoundingBoxes( graph=graph )
+        self._opBoundingBoxes.Input.connect( self.RavelerLabels )
+        self.RavelerBodyBoundingBoxes = self._opBoundingBoxes.BoundingBoxes
+
+        self.WriteSeeds = ArrayAccess( seeds )
+        self.opLabelArray = self
+        self.Output = self.WriteSeeds
+
+class OpSplitBodyCarvingSmallBlocks(OpSplitBodyCarving):
+    # Seeds the bounding box of the body in several blocks
+    BLOCK_SIZE = 16
+
+class TestAutoSeedBackground(object):
+
+    def setUp(self):
+        shape = (1, 70, 60, 50, 1)
+        labels = numpy.random.randint( 1, 4, size=shape ).astype( numpy.uint32 )
+        # An irregular body, at least SEED_MARGIN away from the volume border
+        labels[0, 25:40, 20:32, 18:30, 0] = 7
+        labels[0, 38:45, 30:38, 25:28, 0] = 7
+        self.labels = labels
+
+        # Some seeds exist already: the body (label 2) and a background seed in the hull's region.
+        self.seeds = numpy.zeros( shape, dtype=numpy.uint8 )
+        self.seeds[0, 30:33, 22:25, 20:25, 0] = 2
+        self.seeds[0, 20:23, 16:19, 14:17, 0] = 1
+        self.seeds[0, 5:7, 5:7, 5:7, 0] = 1 # Far away from the body
+
+    def _wholeVolumeHull(self):
+        """
+        The hull as computed formerly: from a distance transform of the entire
+        volume (a single block).
+        """
+        background = numpy.where( self.labels[0,...,0] == 7, 0, 1 ).astype( numpy.float32 )
+        background = vigra.taggedView( background, 'xyz' )
+        distances = vigra.filters.distanceTransform3D( background, background=False ).astype( numpy.uint8 )
+        return numpy.asarray( distances == OpSplitBodyCarving.SEED_MARGIN )
+
+    def _checkSeeds(self, opClass):
+        seeds = self.seeds.copy()
+        opClass.autoSeedBackground( LaneView( self.labels, seeds ), 7 )
+
+        hull = self._wholeVolumeHull()
+        assert hull.any()
+        expected = self.seeds[0,...,0].copy()
+        expected[hull] = 1
+        assert (seeds[0,...,0] == expected).all()
+
+    def testSingleBlock(self):
+        assert max( self.labels.shape ) <= OpSplitBodyCarving.BLOCK_SIZE
+        self._checkSeeds( OpSplitBodyCarving )
+
+    def testSeveralBlocks(self):
+        self._checkSeeds( OpSplitBodyCarvingSmallBlocks )
+
+    def testMissingLabel(self):
+        seeds = self.seeds.copy()
+        OpSplitBodyCarving.autoSeedBackground( LaneView( self.labels, seeds ), 8 )
+        assert (seeds == self.seeds).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
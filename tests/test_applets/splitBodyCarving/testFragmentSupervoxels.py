@@ -0,0 +1,85 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from ilastik.applets.splitBodyCarving.opSplitBodyCarving import FragmentSupervoxels
+
+class TestFragmentSupervoxels(object):
+
+    def setUp(self):
+        # As listed by OpFragmentSetLut: in reverse order, so fragment 1 comes last.
+        # Fragments 1 and 2 share supervoxels 7 and 1000.
+        self.lists = [ (numpy.array([5, 7, 1000, 200000], dtype=numpy.uint32), 2),
+                       (numpy.array([7, 8, 1000], dtype=numpy.uint32), 1) ]
+        self.fragments = FragmentSupervoxels.fromLists( self.lists )
+
+        # The dense LUT, as OpFragmentSetLut computes it
+        self.lut = numpy.zeros( (400001,), dtype=numpy.uint8 )
+        for supervoxels, number in self.lists:
+            self.lut[supervoxels] = number
+
+    def testFirstFragmentWins(self):
+        assert list(self.fragments.supervoxels) == [5, 7, 8, 1000, 200000]
+        assert list(self.fragments.numbers) == [2, 1, 1, 1, 2]
+
+    def _checkLookup(self, regionIds):
+        result = self.fragments.lookup( regionIds )
+        assert result.dtype == numpy.uint8
+        assert result.shape == regionIds.shape
+        assert (result == self.lut[regionIds]).all()
+
+    def testDenseLookup(self):
+        # A compact id range goes through a small LUT
+        regionIds = numpy.arange( 0, 1200, dtype=numpy.uint32 ).reshape( (30, 40) )
+        assert regionIds.max() - regionIds.min() < FragmentSupervoxels.MAX_LUT_RATIO * regionIds.size
+        self._checkLookup( regionIds )
+        # A smaller tile afterwards (reusing the buffer), and one that starts above 0
+        self._checkLookup( regionIds[5:10, 3:7] + 6 )
+
+    def testSparseLookup(self):
+        # A wide id range, compared to the number of ids, goes through a binary search
+        regionIds = numpy.array( [[0, 5, 6, 7], [999, 1000, 150000, 200000]], dtype=numpy.uint32 )
+        assert regionIds.max() - regionIds.min() >= FragmentSupervoxels.MAX_LUT_RATIO * regionIds.size
+        self._checkLookup( regionIds )
+        # Beyond the last supervoxel
+        self._checkLookup( numpy.array( [[6, 200000], [300000, 400000]], dtype=numpy.uint32 ) )
+
+    def testIntersects(self):
+        assert self.fragments.intersects( numpy.array( [3, 5], dtype=numpy.uint32 ) )
+        # Only the range matters: 6 and 9 aren't fragment supervoxels, but 7 and 8 are in between
+        assert self.fragments.intersects( numpy.array( [6, 9], dtype=numpy.uint32 ) )
+        assert not self.fragments.intersects( numpy.array( [9, 999], dtype=numpy.uint32 ) )
+        assert not self.fragments.intersects( numpy.array( [300000], dtype=numpy.uint32 ) )
+        assert not self.fragments.intersects( numpy.zeros( (0,), dtype=numpy.uint32 ) )
+        assert (self.fragments.lookup( numpy.array( [9, 999], dtype=numpy.uint32 ) ) == 0).all()
+
+    def testNoFragments(self):
+        fragments = FragmentSupervoxels.fromLists( [] )
+        regionIds = numpy.arange( 10, dtype=numpy.uint32 )
+        assert not fragments.intersects( regionIds )
+        assert (fragments.lookup( regionIds ) == 0).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,116 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.splitBodyPostprocessing.opSplitBodyPostprocessing import OpAccumulateFragmentSegmentations
+
+class OpSelectedLabelPiper(OpArrayPiper):
+    """
+    Passes a fragment image through, tagged with the raveler body it belongs to
+    (as OpSelectLabel tags the body masks).
+    """
+    def __init__(self, selected_label, *args, **kwargs):
+        super(OpSelectedLabelPiper, self).__init__(*args, **kwargs)
+        self.selected_label = selected_label
+
+    def setupOutputs(self):
+        super(OpSelectedLabelPiper, self).setupOutputs()
+        self.Output.meta.selected_label = self.selected_label
+
+def accumulateWholeVolume( raveler_labels, fragment_images, body_ids ):
+    """
+    The former algorithm of OpAccumulateFragmentSegmentations, which
+    assembled the entire volume at once.
+    """
+    result = raveler_labels.copy()
+    max_label = result.max()
+    mapping = collections.OrderedDict()
+    mapping[(0,max_label+1)] = -1
+    for fragments, body_id in zip( fragment_images, body_ids ):
+        fragment_image = fragments.astype( numpy.int32 )
+        fragment_image[:] = numpy.where( fragment_image, fragment_image, -max_label )
+        numpy.add( fragment_image, max_label, out=fragment_image )
+        result[:] = numpy.where( fragment_image, fragment_image, result )
+        max_label = result.max()
+        old_max = mapping.keys()[-1][1]
+        mapping[(old_max,max_label+1)] = body_id
+    return result, mapping
+
+class TestOpAccumulateFragmentSegmentations(object):
+
+    def setUp(self):
+        shape = (1, 40, 30, 20, 1)
+        raveler_labels = numpy.random.randint( 1, 10, size=shape ).astype( numpy.uint32 )
+
+        # Body 5 is split, but has no fragments
+        self.body_ids = [3, 5, 7]
+        self.fragment_images = []
+        for body_id, nfragments in zip( self.body_ids, [3, 0, 2] ):
+            fragments = numpy.random.randint( 0, nfragments+1, size=shape ).astype( numpy.uint32 )
+            fragments[raveler_labels != body_id] = 0
+            self.fragment_images.append( fragments )
+        self.raveler_labels = raveler_labels
+
+        graph = Graph()
+        self.pipers = []
+        for fragments, body_id in zip( self.fragment_images, self.body_ids ):
+            opPiper = OpSelectedLabelPiper( body_id, graph=graph )
+            opPiper.Input.setValue( vigra.taggedView( fragments, 'txyzc' ) )
+            self.pipers.append( opPiper )
+
+        op = OpAccumulateFragmentSegmentations( graph=graph )
+        # Smaller than the volume, and not a divisor of its shape
+        op.BlockEdge = 16
+        op.RavelerLabels.setValue( vigra.taggedView( raveler_labels, 'txyzc' ) )
+        op.FragmentSegmentations.resize( len(self.pipers) )
+        for slot, opPiper in zip( op.FragmentSegmentations, self.pipers ):
+            slot.connect( opPiper.Output )
+        self.op = op
+
+    def testBlockwiseMatchesWholeVolume(self):
+        expected, expected_mapping = accumulateWholeVolume( self.raveler_labels, self.fragment_images, self.body_ids )
+
+        result = self.op.Output[:].wait()
+        assert (result == expected).all()
+
+        mapping = self.op.Mapping.value
+        assert mapping.items() == expected_mapping.items(), "{} != {}".format( mapping, expected_mapping )
+
+        # A region which cuts through the blocks
+        result = self.op.Output[:, 5:35, 10:27, 3:19, :].wait()
+        assert (result == expected[:, 5:35, 10:27, 3:19, :]).all()
+
+    def testMappingBeforeOutput(self):
+        expected, expected_mapping = accumulateWholeVolume( self.raveler_labels, self.fragment_images, self.body_ids )
+        mapping = self.op.Mapping.value
+        assert mapping.items() == expected_mapping.items(), "{} != {}".format( mapping, expected_mapping )
+        assert (self.op.Output[:].wait() == expected).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,121 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import collections
+
+import numpy
+import h5py
+
+from ilastik.applets.splitBodySupervoxelExport.opSplitBodySupervoxelExport import writeTransforms, copyOriginalDatasets
+
+def _loopTransforms(mapping):
+    """
+    The transforms table, as it used to be generated (label by label).
+    """
+    num_labels = mapping.keys()[-1][1]
+    transform = numpy.zeros( shape=(num_labels, 2), dtype=numpy.uint32 )
+    for (start, stop), body_id in mapping.items():
+        for supervoxel_label in range(start, stop):
+            transform[supervoxel_label][0] = supervoxel_label
+            if body_id == -1:
+                transform[supervoxel_label][1] = supervoxel_label
+            else:
+                transform[supervoxel_label][1] = body_id
+    return transform
+
+class TestWriteTransforms(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.f = h5py.File( os.path.join(self.tmpDir, 'transforms.h5'), 'w' )
+
+    def tearDown(self):
+        self.f.close()
+        shutil.rmtree(self.tmpDir)
+
+    def _check(self, mapping, chunkRows):
+        name = 'transforms{}'.format( len(self.f) )
+        dataset = writeTransforms( self.f, name, mapping, chunkRows=chunkRows )
+        assert dataset.dtype == numpy.uint32
+        assert (dataset[...] == _loopTransforms(mapping)).all()
+
+    def testMatchesLoop(self):
+        # Untouched bodies (-1), split bodies, and empty ranges (also at the end)
+        mapping = collections.OrderedDict( [ ((0, 20), -1),
+                                             ((20, 34), 7),
+                                             ((34, 34), 8),
+                                             ((34, 48), 9),
+                                             ((48, 53), -1),
+                                             ((53, 53), 10) ] )
+        # Chunks which cut through the ranges, end exactly at a range, or hold the whole table
+        for chunkRows in (1, 5, 17, 20, 53, 1000):
+            self._check( mapping, chunkRows )
+
+    def testSingleRange(self):
+        self._check( collections.OrderedDict( [ ((0, 12), 3) ] ), 5 )
+        self._check( collections.OrderedDict( [ ((0, 12), -1) ] ), 5 )
+
+class TestCopyOriginalDatasets(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.originalPath = os.path.join(self.tmpDir, 'original.h5')
+        self.stack = numpy.random.randint( 0, 100, size=(10, 20, 30) ).astype(numpy.uint32)
+        self.bodies = numpy.arange( 50, dtype=numpy.uint32 )
+        with h5py.File(self.originalPath, 'w') as f:
+            f.create_dataset( 'stack', data=self.stack, chunks=(5, 10, 10), compression='gzip' )
+            f.create_dataset( 'transforms', data=numpy.zeros((3,2), dtype=numpy.uint32) )
+            f.create_dataset( 'bodies', data=self.bodies )
+            f.create_group( 'metadata' ).create_dataset( 'note', data=numpy.arange(3) )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testCopy(self):
+        with h5py.File( os.path.join(self.tmpDir, 'copy.h5'), 'w' ) as f:
+            copyOriginalDatasets( f, self.originalPath, exclude=('transforms',) )
+            assert set(f.keys()) == set(['stack', 'bodies', 'metadata'])
+            assert isinstance( f.get('stack', getlink=True), h5py.HardLink )
+            # The storage layout is copied as it is
+            assert f['stack'].chunks == (5, 10, 10)
+            assert f['stack'].compression == 'gzip'
+            assert (f['stack'][...] == self.stack).all()
+            assert (f['bodies'][...] == self.bodies).all()
+            assert (f['metadata/note'][...] == numpy.arange(3)).all()
+
+    def testLink(self):
+        with h5py.File( os.path.join(self.tmpDir, 'link.h5'), 'w' ) as f:
+            copyOriginalDatasets( f, self.originalPath, exclude=('transforms', 'stack'), link=True )
+            assert set(f.keys()) == set(['bodies', 'metadata'])
+            link = f.get('bodies', getlink=True)
+            assert isinstance( link, h5py.ExternalLink )
+            assert link.filename == self.originalPath and link.path == 'bodies'
+            assert (f['bodies'][...] == self.bodies).all()
+            assert (f['metadata/note'][...] == numpy.arange(3)).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
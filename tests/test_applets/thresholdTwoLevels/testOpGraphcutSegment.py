@@ -161,6 +161,21 @@ class TestOpObjectsSegment(unittest.TestCase):
         assert_array_equal(out[45:75, 55:85, 3] > 0, vol[45:75, 55:85, 3] > .5)
         assert np.all(out[:40, ...] == 0)
 
+    def testMemoryBudget(self):
+        graph = Graph()
+        op = OpObjectsSegment(graph=graph)
+        piper = OpArrayPiper(graph=graph)
+        piper.Input.setValue(self.vol)
+        op.Prediction.connect(piper.Output)
+        op.LabelImage.setValue(self.labels)
+
+        expected = op.Output[0:1, ..., 0:1].wait()
+
+        # too small for even a single object, so they are processed one by one
+        op.MemoryBudgetMb.setValue(1)
+        out = op.Output[0:1, ..., 0:1].wait()
+        assert_array_equal(out, expected)
+
     def testFaulty(self):
         vec = vigra.taggedView(np.zeros((500,), dtype=np.float32),
                                axistags=vigra.defaultAxistags('x'))
@@ -31,6 +31,8 @@ from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdOneLevel as OpThresholdOneLevel
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdTwoLevels as OpThresholdTwoLevels5d
+from ilastik.applets.thresholdTwoLevels.thresholdingTools\
+    import OpBlockwiseHysteresis
 from ilastik.applets.thresholdTwoLevels.opGraphcutSegment import haveGraphCut
 
 import ilastik.ilastik_logging
@@ -621,6 +623,24 @@ class TestThresholdTwoLevels(Generator2):
         print(output2[idx])
         numpy.testing.assert_array_almost_equal(ref, output)
 
+    def testBlockwiseHysteresis(self):
+        # objects span several blocks, the result must not depend on that
+        oper = OpBlockwiseHysteresis(graph=Graph())
+        oper.Input.setValue(self.data5d)
+        oper.MinSize.setValue(self.minSize)
+        oper.MaxSize.setValue(self.maxSize)
+        oper.HighThreshold.setValue(self.highThreshold)
+        oper.LowThreshold.setValue(self.lowThreshold)
+        oper.BlockShape.setValue((1, 7, 8, 9, 1))
+
+        output = oper.Output[0:1, ..., 0:1].wait()[0, ..., 0]
+        output2 = self.thresholdTwoLevels(self.data5d[0, ..., 0])
+        numpy.testing.assert_array_equal(output != 0, output2 != 0)
+
+        # a request for part of the volume gives the same labels
+        part = oper.Output[0:1, 10:40, 5:30, 15:25, 0:1].wait()[0, ..., 0]
+        numpy.testing.assert_array_equal(part, output[10:40, 5:30, 15:25])
+
     def testPropagateDirty(self):
         g = Graph()
         oper = OpThresholdTwoLevels(graph=g)
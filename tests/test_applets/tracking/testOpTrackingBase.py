@@ -0,0 +1,166 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+import vigra
+from nose import SkipTest
+
+from lazyflow.graph import Graph
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+
+try:
+    import pgmlink
+    from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
+    have_pgmlink = True
+except ImportError:
+    have_pgmlink = False
+
+def makeLabels(ndim):
+    """Two timesteps of boxes, in txyzc order."""
+    labels = np.zeros((2, 40, 30, 12 if ndim == 3 else 1, 1), dtype=np.uint32)
+    labels[0, 2:6, 3:9, 0:1] = 1
+    labels[0, 10:30, 5:25, 0:1] = 2 # too big
+    labels[0, 32:35, 20:28, 0:1] = 3
+    labels[0, 36:40, 0:2, 0:1] = 4 # outside the x range
+    labels[1, 5:9, 5:9, 0:1] = 1
+    if ndim == 3:
+        labels[0, 2:6, 3:9, 4:8] = 5
+        labels[1, 20:23, 10:14, 6:12] = 2
+    return vigra.taggedView(labels, 'txyzc')
+
+def makeFeatures(labels, t, ndim):
+    """The default features at timestep t, including the background object."""
+    frame = np.asarray(labels[t, ..., 0])
+    if ndim == 2:
+        frame = frame[..., 0]
+    n_objects = frame.max() + 1
+    rc = np.zeros((n_objects, ndim), dtype=np.float32)
+    lower = np.zeros((n_objects, ndim), dtype=np.float32)
+    upper = np.zeros((n_objects, ndim), dtype=np.float32)
+    count = np.zeros((n_objects, 1), dtype=np.float32)
+    for label in range(1, n_objects):
+        coords = np.array(np.nonzero(frame == label)).T
+        rc[label] = coords.mean(axis=0)
+        lower[label] = coords.min(axis=0)
+        upper[label] = coords.max(axis=0)
+        count[label] = len(coords)
+    return { default_features_key : { 'RegionCenter' : rc,
+                                      'Coord<Minimum>' : lower,
+                                      'Coord<Maximum>' : upper,
+                                      'Count' : count } }
+
+def prepareObjectByObject(labels, t, feats_at, x_range, y_range, z_range, size_range):
+    """The per-object loop _prepare_traxels_at replaces."""
+    rc = feats_at[default_features_key]['RegionCenter'][1:]
+    lower = feats_at[default_features_key]['Coord<Minimum>'][1:]
+    upper = feats_at[default_features_key]['Coord<Maximum>'][1:]
+    ct = feats_at[default_features_key]['Count'][1:]
+    ids, com, sizes, filtered_labels, excerpts = [], [], [], [], []
+    for idx in range(rc.shape[0]):
+        if len(rc[idx]) == 2:
+            x, y = rc[idx]
+            z = 0
+        else:
+            x, y, z = rc[idx]
+        size = ct[idx][0]
+        if (x < x_range[0] or x >= x_range[1] or
+            y < y_range[0] or y >= y_range[1] or
+            z < z_range[0] or z >= z_range[1] or
+            size < size_range[0] or size >= size_range[1]):
+            filtered_labels.append(int(idx + 1))
+            continue
+        ids.append(int(idx + 1))
+        com.append([float(x), float(y), float(z)])
+        sizes.append(float(size))
+
+        n_dim = len(rc[idx])
+        roi = [slice(t, t+1), slice(None), slice(None), slice(0, 1), slice(None)]
+        for i in range(n_dim):
+            roi[i+1] = slice(int(lower[idx][i]), int(upper[idx][i] + 1))
+        image_excerpt = np.asarray(labels[tuple(roi)])
+        if n_dim == 2:
+            image_excerpt = image_excerpt[0, ..., 0, 0]
+        else:
+            image_excerpt = image_excerpt[0, ..., 0]
+        excerpts.append((image_excerpt, lower[idx].astype(np.int64)))
+    return ids, com, sizes, filtered_labels, rc.shape[0], excerpts
+
+class TestPrepareTraxels(object):
+    def setUp(self):
+        if not have_pgmlink:
+            raise SkipTest
+
+    def _checkTimesteps(self, ndim):
+        labels = makeLabels(ndim)
+        op = OpTrackingBase(graph=Graph())
+        op.LabelImage.setValue(labels)
+
+        x_range = (0, 35)
+        y_range = (0, 30)
+        z_range = (0, 12)
+        size_range = (1, 200)
+        for t in range(labels.shape[0]):
+            feats_at = makeFeatures(labels, t, ndim)
+            ids, com, com_corr, sizes, filtered_labels, n_traxels, frame = \
+                op._prepare_traxels_at(t, feats_at, x_range, y_range, z_range, size_range,
+                                       with_coordinate_list=True)
+            expected = prepareObjectByObject(labels, t, feats_at, x_range, y_range, z_range, size_range)
+            expected_ids, expected_com, expected_sizes, expected_filtered, expected_n, excerpts = expected
+
+            assert ids == expected_ids, (ids, expected_ids)
+            assert filtered_labels == expected_filtered, (filtered_labels, expected_filtered)
+            assert n_traxels == expected_n
+            assert sizes == expected_sizes
+            # com is always padded to 3 coordinates, z=0 for 2d data
+            assert all(len(c) == 3 for c in com)
+            assert np.allclose(com, expected_com)
+            assert com_corr == []
+
+            frame_labels, origin, lower, upper = frame
+            for idx, (expected_excerpt, expected_lower) in enumerate(excerpts):
+                assert (lower[idx] == expected_lower).all()
+                excerpt = frame_labels[tuple(slice(a, b) for a, b in zip(lower[idx] - origin, upper[idx] - origin))]
+                assert excerpt.shape == expected_excerpt.shape, (excerpt.shape, expected_excerpt.shape)
+                assert (excerpt == expected_excerpt).all()
+
+    def test2d(self):
+        self._checkTimesteps(2)
+
+    def test3d(self):
+        self._checkTimesteps(3)
+
+    def testEmptyTimestep(self):
+        op = OpTrackingBase(graph=Graph())
+        op.LabelImage.setValue(makeLabels(2))
+        feats_at = { default_features_key : { 'RegionCenter' : np.zeros((1, 2)),
+                                              'Coord<Minimum>' : np.zeros((1, 2)),
+                                              'Coord<Maximum>' : np.zeros((1, 2)),
+                                              'Count' : np.zeros((1, 1)) } }
+        result = op._prepare_traxels_at(0, feats_at, (0, 10), (0, 10), (0, 10), (0, 10),
+                                        with_coordinate_list=True)
+        assert result == ([], [], [], [], [], 0, None)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,113 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.vigraWatershedViewer.opBlockwiseWatershed import OpBlockwiseWatershed
+
+class TestOpBlockwiseWatershed(object):
+
+    def setUp(self):
+        # Cells around the points of a regular grid, which cross the block boundaries
+        shape = (56, 48, 40)
+        centers = numpy.mgrid[8:56:16, 8:48:16, 8:40:16].reshape(3, -1).transpose()
+        coords = numpy.indices(shape).reshape(3, -1).transpose()
+        distances = numpy.sqrt( ((coords[:,None,:] - centers[None,:,:])**2).sum(-1) )
+        self.image = distances.min(axis=1).reshape(shape).astype(numpy.float32)
+
+        self.seeds = numpy.zeros(shape, dtype=numpy.uint32)
+        for label, center in enumerate(centers):
+            self.seeds[tuple(center)] = label+1
+
+        self.opWatershed = OpBlockwiseWatershed( graph=Graph() )
+        self.opWatershed.InputImage.setValue( vigra.taggedView(self.image[...,None], 'xyzc') )
+        self.opWatershed.BlockShape.setValue( 20 )
+        self.opWatershed.Halo.setValue( 15 ) # Reaches the centers of all cells which touch a block
+
+    def _checkLabels(self, labels, expected):
+        """
+        Each expected label must correspond to one label of the result
+        (disregarding a few pixels on the ridges between the cells).
+        """
+        assert len(numpy.unique(labels)) == len(numpy.unique(expected))
+        agreement = 0
+        matches = set()
+        for label in numpy.unique(expected):
+            found = numpy.bincount( labels[expected == label] )
+            matches.add( found.argmax() )
+            agreement += found.max()
+        assert len(matches) == len(numpy.unique(expected))
+        assert agreement > 0.95 * expected.size
+        return matches
+
+    def testUnseeded(self):
+        labels = self.opWatershed.Output[:].wait()[...,0]
+        expected, _ = vigra.analysis.watershedsNew( vigra.taggedView(self.image, 'xyz') )
+        self._checkLabels( labels, expected.view(numpy.ndarray) )
+
+        # Consecutive labels
+        assert set(numpy.unique(labels)) == set(range(1, labels.max()+1))
+
+        # Parts of the volume have the same labels
+        assert (self.opWatershed.Output[10:30, 5:45, 0:40].wait()[...,0] == labels[10:30, 5:45, 0:40]).all()
+
+    def testSeeded(self):
+        self.opWatershed.SeedImage.setValue( vigra.taggedView(self.seeds[...,None], 'xyzc') )
+        labels = self.opWatershed.Output[:].wait()[...,0]
+        expected, _ = vigra.analysis.watershedsNew( vigra.taggedView(self.image, 'xyz'),
+                                                    seeds=vigra.taggedView(self.seeds, 'xyz') )
+        matches = self._checkLabels( labels, expected.view(numpy.ndarray) )
+
+        # The labels are the seed labels
+        assert matches == set(range(1, self.seeds.max()+1))
+
+    def testRecomputedBlocks(self):
+        self.opWatershed.SeedImage.setValue( vigra.taggedView(self.seeds[...,None], 'xyzc') )
+        expected = self.opWatershed.Output[:].wait()
+        seams, _ = self.opWatershed._getMapping()
+
+        # Keep the labels of only some of the blocks
+        self.opWatershed.MAX_KEPT_BYTES = max( s.compressedSize() for s in seams.values() )
+        self.opWatershed.SeedImage.setDirty( slice(None) )
+        labels = self.opWatershed.Output[:].wait()
+        seams, _ = self.opWatershed._getMapping()
+        kept = [ s.compressedSize() > 0 for s in seams.values() ]
+        assert any(kept) and not all(kept), kept
+        assert (labels == expected).all()
+
+    def testRecomputedUnseededBlocks(self):
+        expected = self.opWatershed.Output[:].wait()
+
+        # Keep no labels at all
+        self.opWatershed.MAX_KEPT_BYTES = 0
+        self.opWatershed.InputImage.setDirty( slice(None) )
+        labels = self.opWatershed.Output[:].wait()
+        seams, _ = self.opWatershed._getMapping()
+        assert all( s.compressedSize() == 0 for s in seams.values() )
+        assert (labels == expected).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
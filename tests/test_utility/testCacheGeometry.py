@@ -0,0 +1,107 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.utility.cacheGeometry import planBlockShapes, OpAdaptiveSlicedBlockedArrayCache, applyPendingCachePlans
+
+class TestCacheGeometry(object):
+
+    def _source(self, shape, axes, dtype=numpy.float32):
+        data = numpy.random.random(shape).astype(dtype)
+        data = vigra.taggedView( data, axes )
+        opSource = OpArrayPiper( graph=Graph() )
+        opSource.Input.setValue( data )
+        return opSource
+
+    def testVolume(self):
+        opSource = self._source( (300, 400, 500, 3), 'zyxc' )
+        inner, outer = planBlockShapes( opSource.Output.meta, thinEdge=32 )
+        # Thin along x, y and z, respectively, with all channels
+        assert outer[0][2] == 32 and outer[1][1] == 32 and outer[2][0] == 32
+        for shape in inner + outer:
+            assert shape[-1] == 3
+        # The inner blocks are no larger than the outer blocks
+        for innerShape, outerShape in zip(inner, outer):
+            assert (numpy.array(innerShape) <= numpy.array(outerShape)).all()
+
+    def testThinSlab(self):
+        # Axes which are shorter than a block aren't split
+        opSource = self._source( (5, 2000, 2000, 1), 'zyxc' )
+        inner, outer = planBlockShapes( opSource.Output.meta, thinEdge=32 )
+        for shape in inner + outer:
+            assert shape[0] == 5
+
+    def testTimeLapse(self):
+        opSource = self._source( (10, 1000, 1000, 1), 'txyc', numpy.uint8 )
+        inner, outer = planBlockShapes( opSource.Output.meta, thinEdge=1 )
+        for shape in inner + outer:
+            assert shape[0] == 1
+
+        # Large tiles lead to large blocks
+        _, outerWithTiles = planBlockShapes( opSource.Output.meta, thinEdge=1, requestShapes=[(1, 1000, 1000, 1)] )
+        assert outerWithTiles[2][1] > outer[2][1]
+
+    def testMemoryBudget(self):
+        opSource = self._source( (300, 400, 500, 3), 'zyxc' )
+        meta = opSource.Output.meta
+        _, outer = planBlockShapes( meta, thinEdge=32 )
+        meta.ram_usage_per_requested_pixel = 10000
+        _, outerExpensive = planBlockShapes( meta, thinEdge=32 )
+        assert numpy.prod(outerExpensive[2]) < numpy.prod(outer[2])
+
+    def testAdaptiveCache(self):
+        opSource = self._source( (50, 300, 400, 2), 'zyxc' )
+        opCache = OpAdaptiveSlicedBlockedArrayCache( graph=opSource.graph )
+        opCache.Input.connect( opSource.Output )
+        opCache.fixAtCurrent.setValue( False )
+        opCache.REPLAN_INTERVAL = 10
+
+        assert opCache.innerBlockShape.ready()
+        outerShapes = opCache.outerBlockShape.value
+        expected = opSource.Output[:].wait()
+        for z in range(30):
+            data = opCache.Output[z:z+1, 10:200, 20:300, :].wait()
+            assert (data == expected[z:z+1, 10:200, 20:300, :]).all()
+        assert (opCache.Output[:].wait() == expected).all()
+
+        # The new plan is only applied on demand, and not while the cache is frozen
+        assert opCache.hasPendingPlan()
+        assert opCache.outerBlockShape.value == outerShapes
+        opCache.fixAtCurrent.setValue( True )
+        assert not opCache.applyPendingPlan()
+        assert opCache.outerBlockShape.value == outerShapes
+        opCache.fixAtCurrent.setValue( False )
+        assert opCache.outerBlockShape.value == outerShapes
+        assert applyPendingCachePlans() >= 1
+        assert not opCache.hasPendingPlan()
+        assert opCache.outerBlockShape.value != outerShapes
+        assert (opCache.Output[:].wait() == expected).all()
+        assert not opCache.applyPendingPlan()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,138 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from ilastik.clusterOps import ClusterTaskScheduler, OpClusterize, launchProcessGroup
+
+class TestClusterTaskScheduler(object):
+    """
+    Runs the scheduler with local subprocesses.  Instead of a BlockwiseFileset,
+    each 'block' is a marker file that the task creates when it succeeds.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _makeTasks(self, scripts):
+        taskInfos = {}
+        for i, script in enumerate(scripts):
+            taskInfo = OpClusterize.TaskInfo()
+            taskInfo.taskName = "J{:02}".format(i)
+            taskInfo.command = "{} -c \"{}\"".format( sys.executable, script.format( marker=self._marker(i), tmp=self.tmpdir ) )
+            taskInfos[(i,)] = taskInfo
+        return taskInfos
+
+    def _marker(self, i):
+        return os.path.join(self.tmpdir, "block{}".format(i))
+
+    def _launch(self, taskInfo):
+        return launchProcessGroup(taskInfo.command, self.tmpdir)
+
+    def _isBlockDone(self, roi):
+        return os.path.exists(self._marker(roi[0]))
+
+    def testAllTasksFinish(self):
+        succeed = "open(r'{marker}', 'w').close()"
+        taskInfos = self._makeTasks( [succeed]*5 )
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=2, pollIntervalSecs=0.05 )
+        assert scheduler.run( taskInfos )
+        assert all( state.status == ClusterTaskScheduler.DONE for state in scheduler.taskStates.values() )
+        assert all( state.attempts == 1 for state in scheduler.taskStates.values() )
+
+    def testRetryFailedTask(self):
+        # Fails on the first attempt, succeeds on the second
+        flaky = "import os, sys\n" \
+                "if not os.path.exists(r'{marker}.tried'):\n" \
+                "    open(r'{marker}.tried', 'w').close(); sys.exit(1)\n" \
+                "open(r'{marker}', 'w').close()"
+        taskInfos = self._makeTasks( [flaky, flaky] )
+
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=2, maxRetries=0, pollIntervalSecs=0.05 )
+        assert not scheduler.run( taskInfos )
+        assert sorted( scheduler.failedRois() ) == [(0,), (1,)]
+
+        for marker in map( self._marker, range(2) ):
+            os.remove( marker + ".tried" )
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=2, maxRetries=1, pollIntervalSecs=0.05 )
+        assert scheduler.run( taskInfos )
+        assert all( state.attempts == 2 for state in scheduler.taskStates.values() )
+
+    def testTimeout(self):
+        hang = "import time; time.sleep(60)"
+        taskInfos = self._makeTasks( [hang] )
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=1, maxRetries=1, timeoutSecs=0.5, pollIntervalSecs=0.05 )
+        assert not scheduler.run( taskInfos )
+        assert scheduler.taskStates[(0,)].attempts == 2
+        assert scheduler.taskStates[(0,)].status == ClusterTaskScheduler.FAILED
+
+    def testTimeoutKillsWholeTask(self):
+        # The task starts a child process (as a shell command would)
+        spawn = "import os, subprocess, sys, time\n" \
+                "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])\n" \
+                "open(r'{marker}.pid', 'w').write(str(child.pid))\n" \
+                "time.sleep(60)"
+        taskInfos = self._makeTasks( [spawn] )
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=1, timeoutSecs=1.0, pollIntervalSecs=0.05 )
+        assert not scheduler.run( taskInfos )
+
+        with open(self._marker(0) + ".pid") as f:
+            childPid = int(f.read())
+        for _ in range(100):
+            try:
+                os.kill(childPid, 0)
+            except OSError:
+                break # It's gone
+            time.sleep(0.05)
+        else:
+            assert False, "The task's child process is still running."
+
+    def testDetachedLauncher(self):
+        # The launch command only 'submits' the task, which finishes later
+        submit = "import subprocess, sys\n" \
+                 "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.5); open(r\\'{marker}\\', \\'w\\').close()'])"
+        taskInfos = self._makeTasks( [submit]*2 )
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=2, pollIntervalSecs=0.05, launcherDetaches=True )
+        assert scheduler.run( taskInfos )
+        assert all( state.attempts == 1 for state in scheduler.taskStates.values() )
+
+    def testTimeoutCountsFromStart(self):
+        # The task is 'queued' for a while before it starts (and marks its block as started)
+        queued = "import subprocess, sys\n" \
+                 "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(1.5); open(r\\'{marker}.started\\', \\'w\\').close(); time.sleep(0.5); open(r\\'{marker}\\', \\'w\\').close()'])"
+        taskInfos = self._makeTasks( [queued] )
+        isBlockStarted = lambda roi: os.path.exists(self._marker(roi[0]) + ".started")
+        scheduler = ClusterTaskScheduler( self._launch, self._isBlockDone, maxParallel=1, timeoutSecs=1.0, pollIntervalSecs=0.05,
+                                          isBlockStarted=isBlockStarted, launcherDetaches=True )
+        assert scheduler.run( taskInfos )
+        assert scheduler.taskStates[(0,)].attempts == 1
+
+if __name__ == "__main__":
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)